@@ -0,0 +1,117 @@
+﻿###########################################################################
+# (C) 2016 Elettra - Sincrotrone Trieste S.C.p.A.. All rights reserved.   #
+#                                                                         #
+#                                                                         #
+# This file is part of STP-Core, the Python core of SYRMEP Tomo Project,  #
+# a software tool for the reconstruction of experimental CT datasets.     #
+#                                                                         #
+# STP-Core is free software: you can redistribute it and/or modify it     #
+# under the terms of the GNU General Public License as published by the   #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# STP-Core is distributed in the hope that it will be useful, but WITHOUT #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License    #
+# for more details.                                                       #
+#                                                                         #
+# You should have received a copy of the GNU General Public License       #
+# along with STP-Core. If not, see <http://www.gnu.org/licenses/>.        #
+#                                                                         #
+###########################################################################
+
+import os
+import os.path
+import time
+
+from sys import argv, exit
+
+# pystp-specific:
+import stp_core.io.vds as vds
+
+
+def main(argv):
+	"""Assemble several TDF files into a single TDF file without copying the images: 
+	the projections, flat and dark images found in several files are exposed as HDF5 
+	virtual datasets (the images of the files are stacked in the specified order) and 
+	the ones found in a single file are linked. The assembled file is read as any other 
+	TDF file by the pre-processing and reconstruction tools, but it requires the source 
+	files to stay in the same folder relative to it.
+
+	Parameters
+	----------
+	argv[0] : string
+		The absolute path of the output (assembled) TDF file (overwritten if it exists).
+
+	argv[1] : boolean string
+		"True" to stack the sinograms, e.g. for the rings of a vertical multi-ring scan, 
+		"False" to stack the projections, e.g. for projections, flat and dark images 
+		acquired in separate files.
+
+	argv[2] : string
+		The absolute paths of the input TDF files separated by semicolons, in the order 
+		the images have to be stacked.
+
+	argv[3] : string
+		The absolute path of the log file.
+
+	Example
+	-------
+	exec_assemble "S:\\sample.tdf" True "S:\\ring_0.tdf;S:\\ring_1.tdf" "R:\\Temp\\log.txt"
+
+	"""
+	# Get input parameters:
+	outfile = argv[0]
+	along = 'sino' if (argv[1] == "True") else 'tomo'
+	infiles = [name for name in argv[2].split(';') if (name.strip() != '')]
+	logfilename = argv[3]
+
+	# Log input parameters:
+	log = open(logfilename,"w")
+	for infile in infiles:
+		log.write(os.linesep + "\tInput TDF file: %s" % (infile))
+	log.write(os.linesep + "\tOutput TDF file: %s" % (outfile))
+	log.write(os.linesep + "\t--------------")
+	if (along == 'sino'):
+		log.write(os.linesep + "\tSinograms stacked.")
+	else:
+		log.write(os.linesep + "\tProjections stacked.")
+	log.write(os.linesep + "\t--------------")
+	log.close()
+
+	if not vds.is_available():
+		log = open(logfilename,"a")
+		log.write(os.linesep + "\tError: virtual datasets require HDF5 1.10 or later. Process will end.")
+		log.close()
+		exit()
+
+	for infile in infiles:
+		if not os.path.exists(infile):
+			log = open(logfilename,"a")
+			log.write(os.linesep + "\tError: input TDF file %s not found. Process will end." % (infile))
+			log.close()
+			exit()
+
+	# Remove a previous copy of output:
+	if os.path.exists(outfile):
+		log = open(logfilename,"a")
+		log.write(os.linesep + "\tWarning: an output file with the same name was overwritten.")
+		log.close()
+		os.remove(outfile)
+
+	t0 = time.time()
+	try:
+		vds.assemble(outfile, infiles, along, logfilename)
+	except ValueError as e:
+		log = open(logfilename,"a")
+		log.write(os.linesep + "\tError: %s Process will end." % (str(e)))
+		log.close()
+		exit()
+
+	log = open(logfilename,"a")
+	log.write(os.linesep + "\t--------------")
+	log.write(os.linesep + "\tTDF files assembled successfully in %0.3f sec." % (time.time() - t0))
+	log.close()
+
+if __name__ == "__main__":
+	main(argv[1:])
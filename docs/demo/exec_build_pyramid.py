@@ -0,0 +1,95 @@
+﻿###########################################################################
+# (C) 2016 Elettra - Sincrotrone Trieste S.C.p.A.. All rights reserved.   #
+#                                                                         #
+#                                                                         #
+# This file is part of STP-Core, the Python core of SYRMEP Tomo Project,  #
+# a software tool for the reconstruction of experimental CT datasets.     #
+#                                                                         #
+# STP-Core is free software: you can redistribute it and/or modify it     #
+# under the terms of the GNU General Public License as published by the   #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# STP-Core is distributed in the hope that it will be useful, but WITHOUT #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License    #
+# for more details.                                                       #
+#                                                                         #
+# You should have received a copy of the GNU General Public License       #
+# along with STP-Core. If not, see <http://www.gnu.org/licenses/>.        #
+#                                                                         #
+###########################################################################
+
+import os
+import os.path
+import time
+
+from sys import argv, exit
+
+# pystp-specific:
+import stp_core.io.pyramid as pyramid
+
+
+def main(argv):
+	"""Add to a TDF file a multi-resolution pyramid of its projections, flat and dark 
+	images, i.e. copies binned by the specified factors (blocks of factor x factor 
+	detector pixels are averaged) stored in the 'pyramid' group of the same file. Each 
+	dataset is read once and all the levels are computed in the same pass. The preview 
+	tools read the coarsest level compatible with the requested binning.
+
+	Parameters
+	----------
+	argv[0] : string
+		The absolute path of the TDF file (modified).
+
+	argv[1] : string
+		The binning factors separated by semicolons (e.g. "2;4;8").
+
+	argv[2] : int
+		Memory budget in MB for the slabs read at full resolution (e.g. 256).
+
+	argv[3] : string
+		The absolute path of the log file.
+
+	Example
+	-------
+	exec_build_pyramid "S:\\sample1.tdf" "2;4;8" 256 "R:\\Temp\\log.txt"
+
+	"""
+	# Get input parameters:
+	infile = argv[0]
+	levels = sorted(set([int(s) for s in argv[1].split(';') if (s.strip() != '') and (int(s) > 1)]))
+	max_bytes = int(argv[2]) * 1048576
+	logfilename = argv[3]
+
+	# Log input parameters:
+	log = open(logfilename,"w")
+	log.write(os.linesep + "\tTDF file: %s" % (infile))
+	log.write(os.linesep + "\t--------------")
+	log.write(os.linesep + "\tBinning factors: %s" % (", ".join([str(level) for level in levels])))
+	log.write(os.linesep + "\tMemory budget: %d MB" % (max_bytes // 1048576))
+	log.write(os.linesep + "\t--------------")
+	log.close()
+
+	if not os.path.exists(infile):
+		log = open(logfilename,"a")
+		log.write(os.linesep + "\tError: TDF file not found. Process will end.")
+		log.close()
+		exit()
+
+	if (len(levels) == 0):
+		log = open(logfilename,"a")
+		log.write(os.linesep + "\tError: no binning factor greater than 1 specified. Process will end.")
+		log.close()
+		exit()
+
+	t0 = time.time()
+	pyramid.build(infile, levels, max_bytes, logfilename)
+
+	log = open(logfilename,"a")
+	log.write(os.linesep + "\t--------------")
+	log.write(os.linesep + "\tPyramid written successfully in %0.3f sec." % (time.time() - t0))
+	log.close()
+
+if __name__ == "__main__":
+	main(argv[1:])
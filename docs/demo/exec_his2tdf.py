@@ -34,185 +34,93 @@ import time
 from time import strftime
 from sys import argv, exit
 from glob import glob
+from math import ceil
+from multiprocessing import Process, Lock, cpu_count
 from h5py import File as getHDF5
 import stp_core.io.tdf as tdf
+import stp_core.io.his as his
+import stp_core.io.compression as compression
+import stp_core.io.stats as stats
+import stp_core.io.writer as writer
+import stp_core.io.chunks as chunks
 
-def _getHISdim ( HISfilename ):
-	
-	dim1 = 0
-	dim2 = 0
-	dimz = 0	
-	bytecode = numpy.uint16
-	
-	# Open file:
-	try:
-		infile = open(HISfilename, "rb")
-
-		# Get file infos:
-		tot_bytes = os.path.getsize(HISfilename)
-
-		# Read header:
-		Image_tag = infile.read(2)
-		Comment_len = numpy.fromstring(infile.read(2), numpy.uint16)[0].astype(numpy.int_)
-		dim1 = numpy.fromstring(infile.read(2), numpy.uint16)[0].astype(numpy.int_)
-		dim2 = numpy.fromstring(infile.read(2), numpy.uint16)[0].astype(numpy.int_)	
-		dim1_offset = numpy.fromstring(infile.read(2), numpy.uint16)[0].astype(numpy.int_)
-		dim2_offset = numpy.fromstring(infile.read(2), numpy.uint16)[0].astype(numpy.int_)
-		HeaderType = numpy.fromstring(infile.read(2), numpy.uint16)[0]
-		Dump = infile.read(50)
-		Comment = infile.read(Comment_len)	
-
-		# Set total number of bytes read so far:
-		bytes_read = 64 + Comment_len	
-
-		# Set image type:
-		bpp = len(numpy.array(0, bytecode).tostring())
-		
-		# Define chunk size:
-		chunksize = dim1 * dim2 * bpp
-		
-		# Determine number of expected projections:
-		dimz = (tot_bytes - bytes_read) / (chunksize + 64) + 1	
-		
-	finally:
-		# Close file:
-		infile.close()	
-		
-	return (dim1, dim2, dimz, bytecode)
-	
+STACK_BYTES = 268435456  # Max size in bytes of the chunks buffered by each process
 
+def _get_chunk_info ( dset, order ):
+	"""Get what the workers need to compress the chunks of the dataset by themselves 
+	(None if the filters of the dataset are not supported, e.g. for fast codecs).
 
-def _processHIS( HISfilename, dset, dset_offset, provenance_dset, provenance_offset, time_offset, prefix, crop_top, crop_bottom, crop_left, crop_right, logfilename, int_from=0, int_to=-1):
+	"""
+	if not chunks.is_supported(dset):
+		return None
+	axis = 0 if (order == 0) else 1
+	return (dset.shape, dset.chunks, dset.dtype, axis, chunks.get_pipeline(dset))
 
-	# Open file:
-	infile = open(HISfilename, "rb")
+def _split ( start, stop, nr_parts, step=1 ):
+	"""Split the range [start, stop) into at most nr_parts contiguous ranges whose size is 
+	a multiple of step (so that the workers do not share chunks).
 
-	# Get file infos:
-	tot_bytes = os.path.getsize(HISfilename)
+	"""
+	size = int(ceil((stop - start) / float(max(nr_parts, 1)) / step)) * step
+	size = max(size, 1)
+	return [(i, min(i + size, stop)) for i in range(start, stop, size)]
 
-	# Read header:
-	Image_tag = infile.read(2)
-	Comment_len = numpy.fromstring(infile.read(2), numpy.uint16)[0].astype(numpy.int_)
-	dim1 = numpy.fromstring(infile.read(2), numpy.uint16)[0].astype(numpy.int_)
-	dim2 = numpy.fromstring(infile.read(2), numpy.uint16)[0].astype(numpy.int_)	
-	dim1_offset = numpy.fromstring(infile.read(2), numpy.uint16)[0].astype(numpy.int_)
-	dim2_offset = numpy.fromstring(infile.read(2), numpy.uint16)[0].astype(numpy.int_)
-	HeaderType = numpy.fromstring(infile.read(2), numpy.uint16)[0]
-	Dump = infile.read(50)
-	Comment = infile.read(Comment_len)	
+def _process( queue, HISfilename, frame_from, frame_to, dset_offset, dsetname, provenance_offset, timestamp, 
+			  first_index, prefix, crop_top, crop_bottom, crop_left, crop_right, chunk_info ):
+	"""Convert the frames [frame_from, frame_to) of a HIS file: the frames are read from 
+	a memory map and sent to the writer process. The first frame is stored at position 
+	dset_offset of the dataset and its provenance at position provenance_offset. All the 
+	frames get the specified timestamp in their provenance (jobs run concurrently, so the 
+	time of the conversion cannot tell flat/dark images before and after the projections).
 
-	# Set total number of bytes read so far:
-	bytes_read = 64 + Comment_len	
+	"""
+	# Statistics of the images (merged by the writer process):
+	im_stats = stats.RunningStats()
 
-	# Set image type:
-	bytecode = numpy.uint16
-	bpp = len(numpy.array(0, bytecode).tostring())
-	
-	# Define chunk size:
-	chunksize = dim1 * dim2 * bpp
-	
-	# Determine number of expected projections:
-	num_proj = (tot_bytes - bytes_read) / (chunksize + 64) + 1	
-	
-	# Read first projection:
-	t1 = time.time()
-	block = infile.read(chunksize)
-	
-	# Convert as numpy array:
-	data = numpy.fromstring(block, bytecode)
-	im = numpy.reshape( data, [dim2, dim1])	
-	im = im[crop_top:im.shape[0]-crop_bottom,crop_left:im.shape[1]-crop_right]	
-	
-	print numpy.amax(im[:])
-	print dset.attrs['max']
-	
-	# Set minimum and maximum:
-	if ( numpy.amin(im[:]) < float(dset.attrs['min']) ):
-		dset.attrs['min'] = str(numpy.amin(im[:]))
-	if ( numpy.amax(im[:]) > float(dset.attrs['max'])):
-		dset.attrs['max'] = str(numpy.amax(im[:]))
-		
-	print numpy.amax(im[:])
-	print dset.attrs['max']
-		
-	# Check extrema (int_to == -1 means all files) for the projections:
-	if ( (int_to >= num_proj) or (int_to <= 0) ):
-		int_to = num_proj - 1
-	if ( (int_from >= num_proj) or (int_from < 0) ):
-		int_from = 0	
-		
-	# Process first projection (fill HDF5):
-	i = 0
-	first_index = int(provenance_dset.attrs['first_index'])	
-						
-	# Save processed image to HDF5 file:												
-	#tifffile.imsave('tomo_' + str(i).zfill(4) + '.tif', data)
-	if (i >= int_from) and (i <= int_to):	
-		tdf.write_tomo(dset, i + dset_offset  - int_from,im)	
-		
-		# Save provenance metadata:
-		t = time.time()	+ time_offset*3600			
-		provenance_dset["filename", provenance_offset + i  - int_from] = prefix + '_' + str(i + dset_offset + first_index).zfill(4) 
-		provenance_dset["timestamp", provenance_offset + i  - int_from] = numpy.string_(datetime.datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3])
-				
-		# Print out execution time:	
-		t2 = time.time()
-		log = open(logfilename,"a")		
-		log.write(os.linesep + "\t%s converted in %0.3f sec." % (provenance_dset["filename", provenance_offset + i  - int_from], t2 - t1))			
-		log.close()		
-	
-	# Read all the other projections:	
+	# The writer process waits for producer_done even if the conversion fails:
 	try:
-		while block:		
-				
-			# Skip a few bytes:
+		# Frames are read from disk only when accessed:
+		frames = his.get_frames(HISfilename)['image']
+
+		# Whole chunks are compressed here and stored as they are by the writer process (if 
+		# a row of chunks fits the memory budget):
+		stacker = None
+		if chunk_info is not None:
+			shape, chunk_shape, dtype, axis, pipeline = chunk_info
+			stacker = chunks.ChunkStacker(shape, chunk_shape, dtype, axis, dset_offset, dset_offset + frame_to - frame_from, 
+				STACK_BYTES)
+
+		for i in range(frame_from, frame_to):
+
+			# Read (and crop) the frame:
 			t1 = time.time()
-			dump = infile.read(64)
-			
-			# Read the meaningful data:
-			block = infile.read(chunksize)						
-			
-			# Convert as numpy array:
-			data  = numpy.fromstring(block, bytecode)
-			im    = numpy.reshape( data, [dim2, dim1])			
-			im    = im[crop_top:im.shape[0]-crop_bottom,crop_left:im.shape[1]-crop_right]	
-									
-			# Set minimum and maximum:
-			if ( float(numpy.amin(im[:])) < float(dset.attrs['min']) ):				
-				dset.attrs['min'] = str(numpy.amin(im[:]))				
-			if ( float(numpy.amax(im[:])) > float(dset.attrs['max'])):				
-				dset.attrs['max'] = str(numpy.amax(im[:]))				
-			
-			# Process first projection (fill HDF5):
-			i = i + 1
-								
-			# Save processed image to HDF5 file:												
-			#tifffile.imsave('tomo_' + str(i).zfill(4) + '.tif', data)
-			if (i >= int_from) and (i <= int_to):				
-				tdf.write_tomo( dset, i + dset_offset - int_from,im )	
-				
-				# Save provenance metadata:
-				t = time.time()	+ time_offset*3600			
-				provenance_dset["filename", provenance_offset + i  - int_from] = prefix + '_' + str(i + dset_offset + first_index  - int_from).zfill(4)
-				provenance_dset["timestamp", provenance_offset + i  - int_from] = numpy.string_(datetime.datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3])
-							
-				# Print out execution time:	
-				t2 = time.time()
-				log = open(logfilename,"a")		
-				log.write(os.linesep + "\t%s converted in %0.3f sec." % (provenance_dset["filename", provenance_offset + i  - int_from], t2 - t1))			
-				log.close()	
-			
-	except  Exception, e:	
-		#log = open(logfilename,"a")		
-		#log.write(str(e))			
-		#log.close()
-		pass
-	
-	finally: 
-		# Close file:
-		infile.close()
+			im = numpy.array(frames[i, crop_top:frames.shape[1] - crop_bottom, crop_left:frames.shape[2] - crop_right])
+			im_stats.update(im)
 
-	return provenance_offset + i + 1
+			# Send the projection (or the completed chunks) to the writer process:
+			index = dset_offset + i - frame_from
+			row = None if stacker is None else stacker.add(index, im)
+			if row is None:
+				writer.put_image(queue, dsetname, 'tomo', index, im)
+			else:
+				for chunk_offsets, data in chunks.encode_chunks(row, pipeline):
+					writer.put_chunk(queue, dsetname, chunk_offsets, data)
+
+			# Provenance metadata (the log line is written after both image and metadata):
+			t = timestamp
+			filename = prefix + '_' + str(index + first_index).zfill(4)
+			t2 = time.time()
+			writer.put_row(queue, 'provenance/detector_output', provenance_offset + i - frame_from, (numpy.string_(filename), 
+				numpy.string_(datetime.datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3])), 
+				"%s converted in %0.3f sec." % (filename, t2 - t1))
+
+		# Images of incomplete chunks (if any):
+		if stacker is not None:
+			for index, im in stacker.flush():
+				writer.put_image(queue, dsetname, 'tomo', index, im)
+	finally:
+		writer.put_stats(queue, dsetname, im_stats)
+		writer.producer_done(queue)
 
 
 def main(argv):          
@@ -272,14 +180,22 @@ def main(argv):
 		specify the string "True" if the TDF will privilege a fast read/write of sinograms (the most common 
 		case), "False" for fast read/write of projections.
 		
-	compression : scalar, integer
+	compression : scalar, integer or string
 		an integer value in the range of [1,9] to be used as GZIP compression factor in the HDF5 file, where
 		1 is the minimum compression (and maximum speed) and 9 is the maximum (and slow) compression.
-		The value 0 can be specified with the meaning of no compression.
+		The value 0 can be specified with the meaning of no compression. Faster lossless codecs can be 
+		specified as well (they require the hdf5plugin package or the HDF5 filters in HDF5_PLUGIN_PATH): 
+		"lz4", "zstd:<level>", "bitshuffle" (with LZ4), "bitshuffle:zstd:<level>" and "blosc:<compressor>:<level>" 
+		(e.g. "blosc:zstd:5"). See stp_core.io.compression.
 		
 	log_file : string
 		path with filename of a log file (e.g. "R:\\log.txt") where info about the conversion is reported.
 
+	nr_threads : int, optional
+		number of multiple threads (actually processes) to consider to speed up the conversion of the 
+		projections (default: the number of cores). Flat and dark files are converted by one additional
+		process each.
+
 	Returns
 	-------
 	no return value
@@ -332,16 +248,24 @@ def main(argv):
 	else:
 		privilege_sino = False
 
-	# Get compression factor:
-	compr_opts = int(argv[14])
-	compressionFlag = True;
-	if (compr_opts <= 0):
-		compressionFlag = False;
-	elif (compr_opts > 9):
-		compr_opts = 9		
+	# Get compression setting (GZIP factor or fast codec, e.g. "lz4" or "zstd:3"):
+	compr_spec = argv[14]
 		
 	logfilename = argv[15]		
 
+	nr_threads = int(argv[16]) if (len(argv) > 16) else cpu_count()
+	lock = Lock()
+
+	# Check the compression setting:
+	try:
+		compr_args = compression.get_compression_args(compr_spec)
+		compressionFlag = (len(compr_args) > 0)
+	except ValueError as e:
+		log = open(logfilename,"w")
+		log.write(os.linesep + "\tError: %s Process will end." % (str(e)))
+		log.close()
+		exit()
+
 	# Get the files in inpath:
 	log = open(logfilename,"w")	
 	log.write(os.linesep + "\tInput HIS files:")	
@@ -371,7 +295,7 @@ def main(argv):
 		log.write(os.linesep + "\tFast I/O for projections privileged.")
 	
 	if (compressionFlag):
-		log.write(os.linesep + "\tTDF compression factor: %d" % (compr_opts))
+		log.write(os.linesep + "\tTDF compression: %s" % (compression.describe(compr_spec)))
 	else:
 		log.write(os.linesep + "\tTDF compression: none.")
 
@@ -397,40 +321,45 @@ def main(argv):
 	log.write(os.linesep + "\tPreparing the work plan...")	
 	log.close()
 			
-	# Get info from projection file:
-	dim1, dim2, dimz, dtype = _getHISdim ( tomo_file )	
-	
-	
-	if ( ((int_to - int_from + 1) > 0) and ((int_to - int_from + 1) < dimz) ):
-		dimz = int_to - int_from + 1
+	# Get info from projection file (int_to == -1 means all files):
+	header = his.read_header( tomo_file )
+	dim1 = header['dim1']
+	dim2 = header['dim2']
+	dtype = his.DTYPE
+	if ( (int_to >= header['nr_frames']) or (int_to <= 0) ):
+		int_to = header['nr_frames'] - 1
+	if ( (int_from >= header['nr_frames']) or (int_from < 0) ):
+		int_from = 0	
+	dimz = int_to - int_from + 1
+
+	# Sinograms or projections stored contiguously (according to the axes attribute):
+	order = 1 if privilege_sino else 0
 						
 	#dsetshape = (num_files,) + im.shape
 	if projorder:			
 		#dsetshape = tdf.get_dset_shape(privilege_sino, im.shape[1], im.shape[0], num_files)
-		dsetshape = tdf.get_dset_shape(dim1 - crop_left - crop_right, dim2 - crop_top - crop_bottom, dimz)
+		dsetshape = tdf.get_dset_shape(dim1 - crop_left - crop_right, dim2 - crop_top - crop_bottom, dimz, order)
 	else:
 		#dsetshape = tdf.get_dset_shape(privilege_sino, im.shape[1], num_files, im.shape[0])
-		dsetshape = tdf.get_dset_shape(dim1 - crop_left - crop_right, dim2 - crop_top - crop_bottom, dimz)
+		dsetshape = tdf.get_dset_shape(dim1 - crop_left - crop_right, dim2 - crop_top - crop_bottom, dimz, order)
 		
 	f = getHDF5( outfile, 'w' )
-	print dsetshape
 		
 	f.attrs['version'] = '1.0'
 	f.attrs['implements'] = "exchange:provenance"
 	echange_group  = f.create_group( 'exchange' )			
 			
 	if (compressionFlag):
-		dset = f.create_dataset('exchange/data', dsetshape, dtype, chunks=tdf.get_dset_chunks(dim1 - crop_left - crop_right), compression="gzip", compression_opts=compr_opts, shuffle=True, fletcher32=True)
+		dset = f.create_dataset('exchange/data', dsetshape, dtype, chunks=tdf.get_dset_chunks(dim1 - crop_left - crop_right, dsetshape, 
+			dtype, True, 'sino' if privilege_sino else 'tomo', order), **compr_args)
 	else:
 		dset = f.create_dataset('exchange/data', dsetshape, dtype)		
 
-	if privilege_sino:			
-		dset.attrs['axes'] = "y:theta:x"
-	else:
-		dset.attrs['axes'] = "theta:y:x"
+	tdf.set_axes_attr(dset, order)
 			
 	dset.attrs['min'] = str(numpy.iinfo(dtype).max)
 	dset.attrs['max'] = str(numpy.iinfo(dtype).min)
+	tomo_chunks = _get_chunk_info(dset, order) if (compressionFlag) else None
 
 	# Get the total number of files to consider:
 	num_darks = 0
@@ -439,13 +368,13 @@ def main(argv):
 	num_postflats = 0
 			
 	if os.path.exists(dark_file):	
-		dim1, dim2, num_darks, dtype = _getHISdim ( dark_file )	
+		num_darks = his.read_header( dark_file )['nr_frames']
 	if os.path.exists(flat_file):	
-		dim1, dim2, num_flats, dtype = _getHISdim ( flat_file )	
+		num_flats = his.read_header( flat_file )['nr_frames']
 	if os.path.exists(darkpost_file):	
-		dim1, dim2, num_postdarks, dtype = _getHISdim ( darkpost_file )		
+		num_postdarks = his.read_header( darkpost_file )['nr_frames']
 	if os.path.exists(flatpost_file):	
-		dim1, dim2, num_postflats, dtype = _getHISdim ( flatpost_file )	
+		num_postflats = his.read_header( flatpost_file )['nr_frames']
 			
 	tot_files = dimz + num_darks + num_flats + num_postdarks + num_postflats
 				
@@ -458,6 +387,7 @@ def main(argv):
 	provenance_dset.attrs['dark_prefix'] = 'dark';
 	provenance_dset.attrs['flat_prefix'] = 'flat';
 	provenance_dset.attrs['first_index'] = 1;
+	first_index = int(provenance_dset.attrs['first_index'])
 			
 	# Handle the metadata:
 	if (os.path.isfile(os.path.dirname(tomo_file) + os.sep + 'logfile.xml')):
@@ -477,23 +407,22 @@ def main(argv):
 		#dsetshape = (num_files,) + im.shape
 		if projorder:			
 			#dsetshape = tdf.get_dset_shape(privilege_sino, im.shape[1], im.shape[0], num_files)
-			dsetshape = tdf.get_dset_shape(dim1 - crop_left - crop_right, dim2 - crop_top - crop_bottom, num_darks + num_postdarks)
+			dsetshape = tdf.get_dset_shape(dim1 - crop_left - crop_right, dim2 - crop_top - crop_bottom, num_darks + num_postdarks, order)
 		else:
 			#dsetshape = tdf.get_dset_shape(privilege_sino, im.shape[1], num_files, im.shape[0])
-			dsetshape = tdf.get_dset_shape(dim1 - crop_left - crop_right, dim2 - crop_top - crop_bottom, num_darks + num_postdarks)
+			dsetshape = tdf.get_dset_shape(dim1 - crop_left - crop_right, dim2 - crop_top - crop_bottom, num_darks + num_postdarks, order)
 		
 		if (compressionFlag):
-			darkdset = f.create_dataset('exchange/data_dark', dsetshape, dtype, chunks=tdf.get_dset_chunks(dim1 - crop_left - crop_right), compression="gzip", compression_opts=compr_opts, shuffle=True, fletcher32=True)
+			darkdset = f.create_dataset('exchange/data_dark', dsetshape, dtype, chunks=tdf.get_dset_chunks(dim1 - crop_left - crop_right, dsetshape, 
+				dtype, True, 'tomo', order), **compr_args)
 		else:
 			darkdset = f.create_dataset('exchange/data_dark', dsetshape, dtype)		
 
-		if privilege_sino:			
-			darkdset.attrs['axes'] = "y:theta:x"
-		else:
-			darkdset.attrs['axes'] = "theta:y:x"
+		tdf.set_axes_attr(darkdset, order)
 			
 		darkdset.attrs['min'] = str(numpy.iinfo(dtype).max)
 		darkdset.attrs['max'] = str(numpy.iinfo(dtype).min)
+		dark_chunks = _get_chunk_info(darkdset, order) if (compressionFlag) else None
 	else:
 		log = open(logfilename,"a")
 		log.write(os.linesep + "\tWarning: dark images (if any) not considered.")		
@@ -504,52 +433,68 @@ def main(argv):
 		#dsetshape = (num_files,) + im.shape
 		if projorder:			
 			#dsetshape = tdf.get_dset_shape(privilege_sino, im.shape[1], im.shape[0], num_files)
-			dsetshape = tdf.get_dset_shape(dim1 - crop_left - crop_right, dim2 - crop_top - crop_bottom, num_flats + num_postflats)
+			dsetshape = tdf.get_dset_shape(dim1 - crop_left - crop_right, dim2 - crop_top - crop_bottom, num_flats + num_postflats, order)
 		else:
 			#dsetshape = tdf.get_dset_shape(privilege_sino, im.shape[1], num_files, im.shape[0])
-			dsetshape = tdf.get_dset_shape(dim1 - crop_left - crop_right, dim2 - crop_top - crop_bottom, num_flats + num_postflats)
+			dsetshape = tdf.get_dset_shape(dim1 - crop_left - crop_right, dim2 - crop_top - crop_bottom, num_flats + num_postflats, order)
 		
 		if (compressionFlag):
-			flatdset = f.create_dataset('exchange/data_white', dsetshape, dtype, chunks=tdf.get_dset_chunks(dim1 - crop_left - crop_right), compression="gzip", compression_opts=compr_opts, shuffle=True, fletcher32=True)
+			flatdset = f.create_dataset('exchange/data_white', dsetshape, dtype, chunks=tdf.get_dset_chunks(dim1 - crop_left - crop_right, dsetshape, 
+				dtype, True, 'tomo', order), **compr_args)
 		else:
 			flatdset = f.create_dataset('exchange/data_white', dsetshape, dtype)		
 
-		if privilege_sino:			
-			flatdset.attrs['axes'] = "y:theta:x"
-		else:
-			flatdset.attrs['axes'] = "theta:y:x"
+		tdf.set_axes_attr(flatdset, order)
 			
 		flatdset.attrs['min'] = str(numpy.iinfo(dtype).max)
 		flatdset.attrs['max'] = str(numpy.iinfo(dtype).min)
+		flat_chunks = _get_chunk_info(flatdset, order) if (compressionFlag) else None
 		
 	else:
 		log = open(logfilename,"a")
 		log.write(os.linesep + "\tWarning: flat images (if any) not considered.")		
 		log.close()
 			
-	# Process the HIS:
-	provenance_offset = 0
-		
+	f.close()
+
+	# Timestamps of the provenance: flat/dark images before the projections at t_base, projections 
+	# one second later and flat/dark images after the projections 7 hours later:
+	t_base = time.time()
+	t_tomo = t_base + 1
+	t_post = t_base + 7*3600
+
+	# Frames to convert as (file, first frame, last frame + 1, dataset, position within the dataset, 
+	# timestamp, prefix, chunk info):
+	jobs = []
 	if num_flats > 0:
-		provenance_offset = _processHIS( flat_file, flatdset, 0, provenance_dset, provenance_offset, 
-			0, 'flat', crop_top, crop_bottom, crop_left, crop_right, logfilename )	
+		jobs.append((flat_file, 0, num_flats, 'exchange/data_white', 0, t_base, 'flat', flat_chunks))
 	if num_postflats > 0:
-		provenance_offset = _processHIS( flatpost_file, flatdset, num_flats, provenance_dset, provenance_offset, 
-			7, 'flat', crop_top, crop_bottom, crop_left, crop_right, logfilename )
-
+		jobs.append((flatpost_file, 0, num_postflats, 'exchange/data_white', num_flats, t_post, 'flat', flat_chunks))
 	if num_darks > 0:
-		provenance_offset = _processHIS( dark_file, darkdset, 0, provenance_dset, provenance_offset,  
-			0, 'dark', crop_top, crop_bottom, crop_left, crop_right, logfilename )	
+		jobs.append((dark_file, 0, num_darks, 'exchange/data_dark', 0, t_base, 'dark', dark_chunks))
 	if num_postdarks > 0:
-		provenance_offset = _processHIS( darkpost_file, darkdset, num_darks, provenance_dset, provenance_offset, 
-			7, 'dark', crop_top, crop_bottom, crop_left, crop_right, logfilename )
+		jobs.append((darkpost_file, 0, num_postdarks, 'exchange/data_dark', num_darks, t_post, 'dark', dark_chunks))
 
-	provenance_offset = _processHIS( tomo_file, dset, 0, provenance_dset, provenance_offset, 
-			0, 'tomo', crop_top, crop_bottom, crop_left, crop_right, logfilename, int_from, int_to )	
+	# Projections are split among the processes (without sharing chunks, if possible):
+	step = 1 if tomo_chunks is None else tomo_chunks[1][tomo_chunks[3]]
+	for start, stop in _split(0, dimz, nr_threads, step):
+		jobs.append((tomo_file, int_from + start, int_from + stop, 'exchange/data', start, t_tomo, 'tomo', tomo_chunks))
 
-	
-	# Close TDF:
-	f.close()	
+	# A single process writes the TDF file (it keeps the file open while the other processes push their images):
+	proc, queue = writer.start_writer(outfile, len(jobs), logfilename, lock)
+
+	workers = []
+	provenance_offset = 0
+	for HISfilename, frame_from, frame_to, dsetname, dset_offset, timestamp, prefix, chunk_info in jobs:
+		p = Process(target=_process, args=(queue, HISfilename, frame_from, frame_to, dset_offset, dsetname, 
+			provenance_offset, timestamp, first_index, prefix, crop_top, crop_bottom, crop_left, crop_right, chunk_info))
+		p.start()
+		workers.append(p)
+		provenance_offset += frame_to - frame_from
+
+	# Wait for all the processes and check that the conversion succeeded:
+	if not writer.wait(workers, proc, queue, logfilename, lock):
+		exit(1)
 	
 if __name__ == "__main__":
 	main(argv[1:])
@@ -42,59 +42,51 @@ from h5py import File as getHDF5
 
 # pystp-specific:
 import stp_core.io.tdf as tdf
+import stp_core.io.h5cache as h5cache
+import stp_core.io.prefetch as prefetch
+import stp_core.io.writer as writer
+import stp_core.io.stats as stats
 
 
-def _write_data(lock, im, index, outfile, outshape, outtype, logfilename, cputime, itime):    	      
-
-	lock.acquire()
-	try:        
-		t0 = time() 			
-		f_out = getHDF5( outfile, 'a' )					 
-		f_out_dset = f_out.require_dataset('exchange/data', outshape, outtype, chunks=tdf.get_dset_chunks(outshape[0])) 
-		tdf.write_tomo(f_out_dset,index,im.astype(float32))
-					
-		# Set minimum and maximum:
-		if ( amin(im[:]) < float(f_out_dset.attrs['min']) ):
-			f_out_dset.attrs['min'] = str(amin(im[:]))
-		if ( amax(im[:]) > float(f_out_dset.attrs['max'])):
-			f_out_dset.attrs['max'] = str(amax(im[:]))		
-		f_out.close()			
-		t1 = time() 
-
-		# Print out execution time:
-		log = open(logfilename,"a")
-		log.write(linesep + "\ttomo_%s processed (CPU: %0.3f sec - I/O: %0.3f sec)." % (str(index).zfill(4), cputime, t1 - t0 + itime))
-		log.close()	
-
-	finally:
-		lock.release()
-
+def _process(lock, queue, int_from, int_to, infile, outfile, outshape, outtype, method, plan, logfilename):
 
-def _process(lock, int_from, int_to, infile, outfile, outshape, outtype, method, plan, logfilename):
+	# Statistics of the output images (merged by the writer process):
+	im_stats = stats.RunningStats()
 
-	# Process the required subset of images:
-	for i in range(int_from, int_to + 1):                 
-				
-		# Read input image:
-		t0 = time()
-		f_in = getHDF5(infile, 'r')
+	# The writer process waits for producer_done even if the processing fails:
+	try:
+		# Open the TDF file only once (projections are read in slabs):
+		f_in = h5cache.open_file(infile, 'tomo')
 		if "/tomo" in f_in:
-			dset = f_in['tomo']
+			dset = tdf.TDFDataset(f_in['tomo'])
 		else: 
-			dset = f_in['exchange/data']
-		im = tdf.read_tomo(dset,i).astype(float32)		
-		f_in.close()
-		t1 = time() 		
+			dset = tdf.TDFDataset(f_in['exchange/data'])
 
-		# Perform phase retrieval (first time also PyFFTW prepares a plan):		
-		if (method == 0):
-			im = tiehom(im, plan).astype(float32)			
-		else:
-			im = phrt(im, plan, method).astype(float32)			
-		t2 = time() 		
+		# Process the required subset of images:
+		t0 = time()
+		for i, im in prefetch.iter_tomos(dset, int_from, int_to + 1):                 
+				
+			# Get input image (I/O time is spent waiting for the slabs read in background):
+			im = im.astype(float32)		
+			t1 = time() 		
+
+			# Perform phase retrieval (first time also PyFFTW prepares a plan):		
+			if (method == 0):
+				im = tiehom(im, plan).astype(float32)			
+			else:
+				im = phrt(im, plan, method).astype(float32)			
+			t2 = time() 		
 								
-		# Save processed image to HDF5 file (atomic procedure - lock used):
-		_write_data(lock, im, i, outfile, outshape, outtype, logfilename, t2 - t1, t1 - t0)
+			# Send processed image to the writer process:
+			im_stats.update(im)
+			writer.put_image(queue, 'exchange/data', 'tomo', i, im, "tomo_%s processed (CPU: %0.3f sec - I/O: %0.3f sec)." % (str(i).zfill(4), t2 - t1, t1 - t0))
+			t0 = time()
+
+		h5cache.log_cache_stats(f_in, logfilename, lock)
+		f_in.close()
+	finally:
+		writer.put_stats(queue, 'exchange/data', im_stats)
+		writer.producer_done(queue)
 
 
 def main(argv):
@@ -155,11 +147,11 @@ def main(argv):
 		remove(outfile)
 	
 	# Open the HDF5 file:
-	f_in = getHDF5(infile, 'r')
+	f_in = h5cache.open_file(infile, 'tomo')
 	if "/tomo" in f_in:
-		dset = f_in['tomo']
+		dset = tdf.TDFDataset(f_in['tomo'])
 	else: 
-		dset = f_in['exchange/data']
+		dset = tdf.TDFDataset(f_in['exchange/data'])
 	num_proj = tdf.get_nr_projs(dset)
 	num_sinos = tdf.get_nr_sinos(dset)
 	
@@ -195,7 +187,7 @@ def main(argv):
 	f_out_dset.attrs['max'] = str(amax(im[:]))
 	
 	f_out_dset.attrs['version'] = '1.0'
-	f_out_dset.attrs['axes'] = "y:theta:x"
+	tdf.set_axes_attr(f_out_dset)
 
 	f_in.close()
 	f_out.close()
@@ -206,18 +198,28 @@ def main(argv):
 	else:
 		plan = phrt_plan (im, energy, distance, pixsize, param2, param1, method, pad)
 
-	# Run several threads for independent computation without waiting for threads completion:
+	# A single process writes the output file (it keeps the file open while the threads push their projections):
+	proc, queue = writer.start_writer(outfile, nr_threads, logfilename, lock)
+
+	# Run several threads for independent computation:
+	workers = []
 	for num in range(nr_threads):
 		start = (num_proj / nr_threads)*num
 		if (num == nr_threads - 1):
 			end = num_proj - 1
 		else:
 			end = (num_proj / nr_threads)*(num + 1) - 1
-		Process(target=_process, args=(lock, start, end, infile, outfile, outshape, im.dtype, method, plan, logfilename)).start()
+		p = Process(target=_process, args=(lock, queue, start, end, infile, outfile, outshape, im.dtype, method, plan, logfilename))
+		p.start()
+		workers.append(p)
+
+	# Wait for all the threads and check that the processing succeeded:
+	if not writer.wait(workers, proc, queue, logfilename, lock):
+		exit(1)
 
 	#start = 0
 	#end = num_proj - 1
-	#_process(lock, start, end, infile, outfile, outshape, im.dtype, method, plan, logfilename)
+	#_process(lock, queue, start, end, infile, outfile, outshape, im.dtype, method, plan, logfilename)
 
 	#255 256 C:\Temp\BrunGeorgos_corr.tdf C:\Temp\BrunGeorgos_corr_phrt.tdf 0 1.0 2000.0 22.0 300.0 2.2 False 1 C:\Temp\log_00.txt
 	#255 256 C:\Temp\BrunGeorgos_corr.tdf C:\Temp\BrunGeorgos_corr_phrt.tdf 4 2.5 1.0 22.0 300.0 2.2 False 1 C:\Temp\log_00.txt
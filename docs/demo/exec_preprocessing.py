@@ -34,76 +34,79 @@ from multiprocessing import Process, Lock
 
 # pystp-specific:
 from stp_core.preprocess.extfov_correction import extfov_correction
-from stp_core.preprocess.flat_fielding import flat_fielding
+from stp_core.preprocess.flat_fielding import flat_fielding_slab, FlatFieldPlan
+from stp_core.preprocess.defect_map import find_defects
 from stp_core.preprocess.dynamic_flatfielding import dff_prepare_plan, dynamic_flat_fielding
 from stp_core.preprocess.ring_correction import ring_correction
-from stp_core.preprocess.extract_flatdark import extract_flatdark, _medianize
+from stp_core.preprocess.extract_flatdark import extract_flatdark, _medianize, REDUCE_METHODS
 
 from h5py import File as getHDF5
 
 # pystp-specific:
 import stp_core.io.tdf as tdf
+import stp_core.io.h5cache as h5cache
+import stp_core.io.prefetch as prefetch
+import stp_core.io.writer as writer
+import stp_core.io.stats as stats
 
 
-def _write_data(lock, im, index, outfile, outshape, outtype, logfilename, cputime, itime):    	      
-
-	lock.acquire()
-	try:        
-		t0 = time() 			
-		f_out = getHDF5( outfile, 'a' )					 
-		f_out_dset = f_out.require_dataset('exchange/data', outshape, outtype, chunks=tdf.get_dset_chunks(outshape[0])) 
-		tdf.write_sino(f_out_dset,index,im.astype(float32))
-					
-		# Set minimum and maximum:
-		if ( amin(im[:]) < float(f_out_dset.attrs['min']) ):
-			f_out_dset.attrs['min'] = str(amin(im[:]))
-		if ( amax(im[:]) > float(f_out_dset.attrs['max'])):
-			f_out_dset.attrs['max'] = str(amax(im[:]))		
-		f_out.close()			
-		t1 = time() 
-
-		# Print out execution time:
-		log = open(logfilename,"a")
-		log.write(linesep + "\tsino_%s processed (CPU: %0.3f sec - I/O: %0.3f sec)." % (str(index).zfill(4), cputime, t1 - t0 + itime))
-		log.close()	
-
-	finally:
-		lock.release()	
-
-def _process (lock, int_from, int_to, infile, outfile, outshape, outtype, skipflat, plan, norm_sx, norm_dx, flat_end, 
+def _process (lock, queue, int_from, int_to, infile, outfile, outshape, outtype, skipflat, plan, norm_sx, norm_dx, flat_end, 
 			 half_half, half_half_line, ext_fov, ext_fov_rot_right, ext_fov_overlap, ringrem, dynamic_ff, EFF, 
 			 filtEFF, im_dark, logfilename):
 
-	# Process the required subset of images:
-	for i in range(int_from, int_to + 1):                 
-				
-		# Read input image:
-		t0 = time()
-		f_in = getHDF5(infile, 'r')
+	# Statistics of the output images (merged by the writer process):
+	im_stats = stats.RunningStats()
+
+	# The writer process waits for producer_done even if the processing fails:
+	try:
+		# Open the TDF file only once (sinograms are read in slabs):
+		f_in = h5cache.open_file(infile, 'sino')
 		if "/tomo" in f_in:
-			dset = f_in['tomo']
+			dset = tdf.TDFDataset(f_in['tomo'])
 		else: 
-			dset = f_in['exchange/data']
-		im = tdf.read_sino(dset,i).astype(float32)		
-		f_in.close()
-		t1 = time() 		
+			dset = tdf.TDFDataset(f_in['exchange/data'])
 
-		# Perform pre-processing (flat fielding, extended FOV, ring removal):	
-		if not skipflat:
-			if dynamic_ff:
-				# Dynamic flat fielding with downsampling = 2:
-				im = dynamic_flat_fielding(im, i, EFF, filtEFF, 2, im_dark, norm_sx, norm_dx)
-			else:
-				im = flat_fielding(im, i, plan, flat_end, half_half, half_half_line, norm_sx, norm_dx)			
-		im = extfov_correction(im, ext_fov, ext_fov_rot_right, ext_fov_overlap)
-		if not skipflat and not dynamic_ff:
-			im = ring_correction (im, ringrem, flat_end, plan['skip_flat_after'], half_half, half_half_line, ext_fov)
-		else:
-			im = ring_correction (im, ringrem, False, False, half_half, half_half_line, ext_fov)
-		t2 = time() 		
-								
-		# Save processed image to HDF5 file (atomic procedure - lock used):
-		_write_data(lock, im, i, outfile, outshape, outtype, logfilename, t2 - t1, t1 - t0)
+		# Process the required subset of images:
+		t0 = time()
+		for idx, block in prefetch.iter_sino_slabs(dset, int_from, int_to + 1):
+
+			# Flat fielding of the whole slab in a single pass (I/O time is spent waiting for 
+			# the slabs read in background):
+			t1 = time()
+			if not skipflat and not dynamic_ff:
+				block = flat_fielding_slab(block, idx, plan, flat_end, half_half, half_half_line, norm_sx, norm_dx)
+			t_ff = (time() - t1) / len(idx)
+			t0 += time() - t1
+
+			for j in range(0, len(idx)):
+
+				# Get input image:
+				i = idx[j]
+				im = block[j].astype(float32)
+				t1 = time() 		
+
+				# Perform pre-processing (dynamic flat fielding, extended FOV, ring removal):	
+				if not skipflat and dynamic_ff:
+					# Dynamic flat fielding with downsampling = 2:
+					im = dynamic_flat_fielding(im, i, EFF, filtEFF, 2, im_dark, norm_sx, norm_dx)
+				im = extfov_correction(im, ext_fov, ext_fov_rot_right, ext_fov_overlap)
+				if not skipflat and not dynamic_ff:
+					im = ring_correction (im, ringrem, flat_end, plan.skip_flat_after, half_half, half_half_line, ext_fov)
+				else:
+					im = ring_correction (im, ringrem, False, False, half_half, half_half_line, ext_fov)
+				t2 = time() + t_ff
+									
+				# Send processed image to the writer process:
+				im = im.astype(float32)
+				im_stats.update(im)
+				writer.put_image(queue, 'exchange/data', 'sino', i, im, "sino_%s processed (CPU: %0.3f sec - I/O: %0.3f sec)." % (str(i).zfill(4), t2 - t1, t1 - t0))
+				t0 = time()
+
+		h5cache.log_cache_stats(f_in, logfilename, lock)
+		f_in.close()
+	finally:
+		writer.put_stats(queue, 'exchange/data', im_stats)
+		writer.producer_done(queue)
 
 
 def main(argv):          
@@ -167,6 +170,12 @@ def main(argv):
 	nr_threads = int(argv[14])
 	logfilename = argv[15]		
 
+	# Reduction of the flat/dark images (optional: 'mean', 'median' or 'sigmaclip'):
+	reduce_method = argv[16] if (len(argv) > 16) else 'mean'
+
+	# Correction of the defective pixels found from the flat/dark images (optional):
+	defect_map = True if (len(argv) > 17) and (argv[17] == "True") else False
+
 
 
 
@@ -177,23 +186,29 @@ def main(argv):
 	log.write(linesep + "\t--------------")	
 	log.write(linesep + "\tOpening input dataset...")	
 	log.close()
+
+	if reduce_method not in REDUCE_METHODS:
+		log = open(logfilename,"a")
+		log.write(linesep + "\tError: reduction method '%s' not supported. Process will end." % (reduce_method))	
+		log.close()			
+		exit()		
 	
 	# Remove a previous copy of output:
 	if exists(outfile):
 		remove(outfile)
 	
 	# Open the HDF5 file:	
-	f_in = getHDF5(infile, 'r')
+	f_in = h5cache.open_file(infile, 'sino')
 
 
 	if "/tomo" in f_in:
-		dset = f_in['tomo']
+		dset = tdf.TDFDataset(f_in['tomo'])
 
 		tomoprefix = 'tomo'
 		flatprefix = 'flat'
 		darkprefix = 'dark'
 	else: 
-		dset = f_in['exchange/data']
+		dset = tdf.TDFDataset(f_in['exchange/data'])
 		if "/provenance/detector_output" in f_in:
 			prov_dset = f_in['provenance/detector_output']		
 	
@@ -233,16 +248,26 @@ def main(argv):
 	plan = -1
 
 	if not dynamic_ff:
-		plan = extract_flatdark(f_in, flat_end, logfilename)
+		plan = extract_flatdark(f_in, flat_end, logfilename, reduce_method, nr_threads)
 		if (isscalar(plan['im_flat']) and isscalar(plan['im_flat_after']) ):
 			skipflat = True
 		else:
 			skipflat = False		
+
+			# Find the defective pixels of the detector once from flats and darks (if required):
+			defects = find_defects(plan) if defect_map else None
+			if defects is not None:
+				log = open(logfilename,"a")
+				log.write(linesep + "\tDefective pixels found: %d." % len(defects))
+				log.close()
+
+			# Compile the flat fielding plan once for all the sinograms:
+			plan = FlatFieldPlan(plan, flat_end, half_half, half_half_line, norm_sx, norm_dx, defects=defects)
 	else:
 		# Dynamic flat fielding:
 		if "/tomo" in f_in:				
 			if "/flat" in f_in:
-				flat_dset = f_in['flat']
+				flat_dset = tdf.TDFDataset(f_in['flat'])
 				if "/dark" in f_in:
 					im_dark = _medianize(f_in['dark'])
 				else:										
@@ -251,7 +276,7 @@ def main(argv):
 				skipflat = True # Nothing to do in this case			
 		else: 
 			if "/exchange/data_white" in f_in:
-				flat_dset = f_in['/exchange/data_white']
+				flat_dset = tdf.TDFDataset(f_in['/exchange/data_white'])
 				if "/exchange/data_dark" in f_in:
 					im_dark = _medianize(f_in['/exchange/data_dark'])
 				else:					
@@ -285,7 +310,7 @@ def main(argv):
 	f_out_dset.attrs['min'] = str(amin(im[:]))
 	f_out_dset.attrs['max'] = str(amax(im[:]))
 	f_out_dset.attrs['version'] = '1.0'
-	f_out_dset.attrs['axes'] = "y:theta:x"
+	tdf.set_axes_attr(f_out_dset)
 
 	f_out.close()
 	f_in.close()
@@ -297,21 +322,30 @@ def main(argv):
 	log.write(linesep + "\tPerforming pre processing...")			
 	log.close()	
 
-	# Run several threads for independent computation without waiting for threads completion:
+	# A single process writes the output file (it keeps the file open while the threads push their sinograms):
+	proc, queue = writer.start_writer(outfile, nr_threads, logfilename, lock)
+
+	# Run several threads for independent computation:
+	workers = []
 	for num in range(nr_threads):
 		start = (num_sinos / nr_threads)*num
 		if (num == nr_threads - 1):
 			end = num_sinos - 1
 		else:
 			end = (num_sinos / nr_threads)*(num + 1) - 1
-		Process(target=_process, args=(lock, start, end, infile, outfile, outshape, im.dtype, skipflat, plan, norm_sx, 
+		p = Process(target=_process, args=(lock, queue, start, end, infile, outfile, outshape, im.dtype, skipflat, plan, norm_sx, 
 				norm_dx, flat_end, half_half, half_half_line, ext_fov, ext_fov_rot_right, ext_fov_overlap, ringrem, 
-				dynamic_ff, EFF, filtEFF, im_dark, logfilename )).start()
+				dynamic_ff, EFF, filtEFF, im_dark, logfilename ))
+		p.start()
+		workers.append(p)
 
+	# Wait for all the threads and check that the processing succeeded:
+	if not writer.wait(workers, proc, queue, logfilename, lock):
+		exit(1)
 
 	#start = int_from # 0
 	#end = int_to # num_sinos - 1
-	#_process(lock, start, end, infile, outfile, outshape, im.dtype, skipflat, plan, norm_sx, 
+	#_process(lock, queue, start, end, infile, outfile, outshape, im.dtype, skipflat, plan, norm_sx, 
 	#			norm_dx, flat_end, half_half, half_half_line, ext_fov, ext_fov_rot_right, ext_fov_overlap, ringrem, 
 	#			dynamic_ff, EFF, filtEFF, im_dark, logfilename)
 
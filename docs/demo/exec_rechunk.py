@@ -0,0 +1,192 @@
+﻿###########################################################################
+# (C) 2016 Elettra - Sincrotrone Trieste S.C.p.A.. All rights reserved.   #
+#                                                                         #
+#                                                                         #
+# This file is part of STP-Core, the Python core of SYRMEP Tomo Project,  #
+# a software tool for the reconstruction of experimental CT datasets.     #
+#                                                                         #
+# STP-Core is free software: you can redistribute it and/or modify it     #
+# under the terms of the GNU General Public License as published by the   #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# STP-Core is distributed in the hope that it will be useful, but WITHOUT #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License    #
+# for more details.                                                       #
+#                                                                         #
+# You should have received a copy of the GNU General Public License       #
+# along with STP-Core. If not, see <http://www.gnu.org/licenses/>.        #
+#                                                                         #
+###########################################################################
+
+import os
+import os.path
+import time
+
+from sys import argv, exit
+from h5py import File as getHDF5, Group
+
+# pystp-specific:
+import stp_core.io.tdf as tdf
+import stp_core.io.h5cache as h5cache
+import stp_core.io.compression as compression
+
+# Datasets with projections, flat or dark images (all the other objects are copied as they are):
+IMAGE_DSETS = ['tomo', 'flat', 'dark', 'flat_post', 'dark_post', 'flat_after', 'dark_after',
+			   'exchange/data', 'exchange/data_white', 'exchange/data_dark']
+
+
+def _rechunk_dset(f_in, f_out, name, order, compr_args, max_bytes, logfilename):
+	"""Copy the specified dataset into the output file with the specified storage order.
+
+	"""
+	src = tdf.TDFDataset(f_in[name])
+
+	det_size = tdf.get_det_size(src)
+	dsetshape = tdf.get_dset_shape(det_size, tdf.get_nr_sinos(src), tdf.get_nr_projs(src), order)
+	access = 'sino' if (order == 1) else 'tomo'
+
+	if (len(compr_args) > 0):
+		dset = f_out.create_dataset(name, dsetshape, src.dtype, chunks=tdf.get_dset_chunks(det_size, dsetshape,
+			src.dtype, True, access, order), **compr_args)
+	else:
+		dset = f_out.create_dataset(name, dsetshape, src.dtype)
+
+	for key in src.attrs.keys():
+		dset.attrs[key] = src.attrs[key]
+	tdf.set_axes_attr(dset, order)
+	dset = tdf.TDFDataset(dset)
+
+	# Transpose block by block:
+	t0 = time.time()
+	t1 = t0
+	for start, stop in tdf.iter_rechunk(src, dset, max_bytes):
+		t2 = time.time()
+		log = open(logfilename,"a")
+		log.write(os.linesep + "\t%s: images [%d,%d] written (I/O: %0.3f sec)." % (name, start, stop - 1, t2 - t1))
+		log.close()
+		t1 = t2
+
+	# Print out the overall throughput:
+	mb = src.shape[0] * src.shape[1] * src.shape[2] * src.dtype.itemsize / 1048576.0
+	log = open(logfilename,"a")
+	log.write(os.linesep + "\t%s: %0.1f MB transposed in %0.3f sec (%0.1f MB/s)." % (name, mb, t1 - t0,
+		mb / max(t1 - t0, 1e-6)))
+	log.close()
+
+
+def main(argv):
+	"""Transpose a TDF file between the projection order (theta:y:x) and the sinogram
+	order (y:theta:x) with an out-of-core approach: slabs of whole chunks are read from
+	the input file, transposed in memory and written as whole chunks to the output file
+	within the specified memory budget. Flat and dark images are transposed as well while
+	all the other objects (e.g. provenance and metadata) are copied as they are.
+
+	Parameters
+	----------
+	argv[0] : string
+		The absolute path of the input TDF file.
+
+	argv[1] : string
+		The absolute path of the output TDF file (overwritten if it exists).
+
+	argv[2] : boolean string
+		"True" to write the output in sinogram order (fast I/O for sinograms, as required
+		by pre-processing and reconstruction), "False" to write it in projection order (fast
+		I/O for projections, as required by phase retrieval).
+
+	argv[3] : int
+		GZIP compression factor in the range [1,9], 0 for no compression or a fast codec
+		(e.g. "lz4" or "zstd:3", see stp_core.io.compression).
+
+	argv[4] : int
+		Memory budget in MB for the buffers (e.g. 1024).
+
+	argv[5] : string
+		The absolute path of the log file.
+
+	Example
+	-------
+	exec_rechunk "S:\\sample1_proj.tdf" "S:\\sample1.tdf" True 1 1024 "R:\\Temp\\log.txt"
+
+	"""
+	# Get input parameters:
+	infile = argv[0]
+	outfile = argv[1]
+	privilege_sino = True if argv[2] == "True" else False
+	compr_spec = argv[3]
+	max_bytes = int(argv[4]) * 1048576
+	logfilename = argv[5]
+
+	order = 1 if privilege_sino else 0
+
+	# Check the compression setting:
+	try:
+		compr_args = compression.get_compression_args(compr_spec)
+	except ValueError as e:
+		log = open(logfilename,"w")
+		log.write(os.linesep + "\tError: %s Process will end." % (str(e)))
+		log.close()
+		exit()
+
+	# Log input parameters:
+	log = open(logfilename,"w")
+	log.write(os.linesep + "\tInput TDF file: %s" % (infile))
+	log.write(os.linesep + "\tOutput TDF file: %s" % (outfile))
+	log.write(os.linesep + "\t--------------")
+	if (privilege_sino):
+		log.write(os.linesep + "\tFast I/O for sinograms privileged.")
+	else:
+		log.write(os.linesep + "\tFast I/O for projections privileged.")
+	log.write(os.linesep + "\tTDF compression: %s" % (compression.describe(compr_spec)))
+	log.write(os.linesep + "\tMemory budget: %d MB" % (max_bytes // 1048576))
+	log.write(os.linesep + "\t--------------")
+	log.close()
+
+	if not os.path.exists(infile):
+		log = open(logfilename,"a")
+		log.write(os.linesep + "\tError: input TDF file not found. Process will end.")
+		log.close()
+		exit()
+
+	# Remove a previous copy of output:
+	if os.path.exists(outfile):
+		log = open(logfilename,"a")
+		log.write(os.linesep + "\tWarning: an output file with the same name was overwritten.")
+		log.close()
+		os.remove(outfile)
+
+	# Slabs of the images of the output layout are read from the input file:
+	f_in = h5cache.open_file(infile, 'sino' if privilege_sino else 'tomo')
+	f_out = getHDF5(outfile, 'w')
+
+	for key in f_in.attrs.keys():
+		f_out.attrs[key] = f_in.attrs[key]
+
+	# Collect the objects to copy (groups are listed before their members):
+	names = []
+	f_in.visit(names.append)
+
+	for name in names:
+		obj = f_in.get(name, getclass=True)
+		if (obj is Group):
+			if name not in f_out:
+				grp = f_out.create_group(name)
+				for key in f_in[name].attrs.keys():
+					grp.attrs[key] = f_in[name].attrs[key]
+		elif (name in IMAGE_DSETS) and (len(f_in[name].shape) == 3):
+			_rechunk_dset(f_in, f_out, name, order, compr_args, max_bytes, logfilename)
+		else:
+			f_in.copy(name, f_out, name=name)
+
+	f_out.close()
+	f_in.close()
+
+	log = open(logfilename,"a")
+	log.write(os.linesep + "\t--------------")
+	log.write(os.linesep + "\tTDF file transposed successfully.")
+	log.close()
+
+if __name__ == "__main__":
+	main(argv[1:])
@@ -30,15 +30,16 @@ from sys import argv, exit
 from os import remove, sep, makedirs, linesep
 from os.path import basename, exists
 from numpy import finfo, copy, float32, double, amin, amax, tile, concatenate, log as nplog
-from numpy import arange, meshgrid, isscalar, ndarray, pi, roll
+from numpy import arange, meshgrid, isscalar, ndarray, pi, roll, ceil
 from time import time
 from multiprocessing import Process, Lock
 
 # pystp-specific:
 from stp_core.preprocess.extfov_correction import extfov_correction
-from stp_core.preprocess.flat_fielding import flat_fielding
+from stp_core.preprocess.flat_fielding import flat_fielding, FlatFieldPlan
+from stp_core.preprocess.defect_map import find_defects
 from stp_core.preprocess.ring_correction import ring_correction
-from stp_core.preprocess.extract_flatdark import extract_flatdark, _medianize
+from stp_core.preprocess.extract_flatdark import extract_flatdark, _medianize, REDUCE_METHODS
 from stp_core.preprocess.dynamic_flatfielding import dff_prepare_plan, dynamic_flat_fielding
 
 from stp_core.reconstruct.rec_astra import recon_astra_fbp, recon_astra_iterative
@@ -55,6 +56,10 @@ from h5py import File as getHDF5
 
 # pystp-specific:
 import stp_core.io.tdf as tdf
+import stp_core.io.h5cache as h5cache
+import stp_core.io.prefetch as prefetch
+import stp_core.io.stats as stats
+import stp_core.io.chunks as chunks
 
 
 def reconstruct(im, angles, offset, logtransform, param1, circle, scale, pad, method, rolling, roll_shift,
@@ -154,8 +159,12 @@ def reconstruct(im, angles, offset, logtransform, param1, circle, scale, pad, me
 		#print numpy.amax(im_f[:])
 		#im_f = (im_f - dset_min) / (dset_max - dset_min)
 		
-		# Cheating the whole process:
-		im_f = (im_f - numpy.amin(im_f[:])) / (numpy.amax(im_f[:]) - numpy.amin(im_f[:]))
+		if (dset_max > dset_min):
+			# Limits of the whole dataset (from the stored histogram):
+			im_f = (im_f - dset_min) / (dset_max - dset_min)
+		else:
+			# Cheating the whole process:
+			im_f = (im_f - numpy.amin(im_f[:])) / (numpy.amax(im_f[:]) - numpy.amin(im_f[:]))
 	
 	# Apply log transform:
 	if (logtransform == True):						
@@ -308,9 +317,14 @@ def reconstruct_gridrec(im1, im2, angles, offset, logtransform, param1, circle,
 		#print numpy.amax(im_f[:])
 		#im_f = (im_f - dset_min) / (dset_max - dset_min)
 		
-		# Cheating the whole process:
-		im_f1 = (im_f1 - numpy.amin(im_f1[:])) / (numpy.amax(im_f1[:]) - numpy.amin(im_f1[:]))
-		im_f2 = (im_f2 - numpy.amin(im_f2[:])) / (numpy.amax(im_f2[:]) - numpy.amin(im_f2[:]))		
+		if (dset_max > dset_min):
+			# Limits of the whole dataset (from the stored histogram):
+			im_f1 = (im_f1 - dset_min) / (dset_max - dset_min)
+			im_f2 = (im_f2 - dset_min) / (dset_max - dset_min)
+		else:
+			# Cheating the whole process:
+			im_f1 = (im_f1 - numpy.amin(im_f1[:])) / (numpy.amax(im_f1[:]) - numpy.amin(im_f1[:]))
+			im_f2 = (im_f2 - numpy.amin(im_f2[:])) / (numpy.amax(im_f2[:]) - numpy.amin(im_f2[:]))		
 	
 	
 	# Apply log transform:
@@ -378,38 +392,79 @@ def write_log_gridrec(lock, fname1, fname2, logfilename, cputime, iotime):
 	finally:
 		lock.release()	
 
+def get_read_sel(preprocessing_required, angles_projfrom, angles_projto, offset, scale, decim_factor, downsc_factor, 
+				 downsc_mode=None):
+	"""Get the HDF5 selections of the rows (projections) and of the columns (pixels) of 
+	each sinogram so that projection removal, decimation and downscaling are performed 
+	while reading. Decimation and downscaling are moved to the read only when the result 
+	does not change, i.e. when no pre-processing is required (flat fielding and ring 
+	removal work on the whole sinogram) and, for downscaling, when no upscaling is required 
+	and the center offset is a multiple of the downscaling factor. Binning (downsc_mode
+	not None) is always performed while reading.
+
+	Return value
+	----------
+	The tuple (proj_sel, det_sel, offset, decim_factor, downsc_factor) where the last three 
+	elements are the values to pass to the reconstruction for the selected data.
+
+	"""
+	if (preprocessing_required) or (decim_factor <= 1):
+		proj_sel = slice(angles_projfrom, angles_projto)
+	else:
+		proj_sel = slice(angles_projfrom, angles_projto, decim_factor)
+		decim_factor = 1
+
+	det_sel = None
+	if (downsc_mode is not None):
+		offset = int(round(offset / float(downsc_factor)))
+		downsc_factor = 1
+	elif (not preprocessing_required) and (downsc_factor > 1) and (abs(scale - 1.0) <= finfo(float32).eps) \
+		and (offset == int(offset)) and (int(offset) % downsc_factor == 0):
+		det_sel = slice(None, None, downsc_factor)
+		offset = int(offset) // downsc_factor
+		downsc_factor = 1
+
+	return (proj_sel, det_sel, offset, decim_factor, downsc_factor)
+
 def process_gridrec(lock, int_from, int_to, num_sinos, infile, outpath, preprocessing_required, skipflat, corr_plan, 
 			norm_sx, norm_dx, flat_end, half_half, 
 			half_half_line, ext_fov, ext_fov_rot_right, ext_fov_overlap, ringrem, angles, angles_projfrom, angles_projto,
 			offset, logtransform, param1, circle, scale, pad, rolling, roll_shift, zerone_mode, dset_min, dset_max, decim_factor, 
-			downsc_factor, corr_offset,	postprocess_required, convert_opt, crop_opt, dynamic_ff, EFF, filtEFF, im_dark, 
-			outprefix, logfilename):
+			downsc_factor, downsc_mode, corr_offset, postprocess_required, convert_opt, crop_opt, dynamic_ff, EFF, filtEFF, im_dark, 
+			outprefix, io_threads, logfilename):
 	"""To do...
 
 	"""
-	# Process the required subset of images:
-	for i in range(int_from, int_to + 1, 2):               
+	# Open the TDF file only once (sinograms are read in slabs and compressed chunks are
+	# decompressed by io_threads threads):
+	f_in = h5cache.open_file(infile, 'sino')
+	if "/tomo" in f_in:
+		dset = tdf.TDFDataset(f_in['tomo'], threads=io_threads)
+	else: 
+		dset = tdf.TDFDataset(f_in['exchange/data'], threads=io_threads)
+
+	# Only the required projections (and pixels) are read:
+	proj_sel, det_sel, rec_offset, rec_decim, rec_downsc = get_read_sel(preprocessing_required, angles_projfrom, 
+		angles_projto, offset, scale, decim_factor, downsc_factor, downsc_mode)
+	if (downsc_mode is None):
+		sinos = prefetch.iter_sinos(dset, int_from, min(int_to + 2, num_sinos), rows=proj_sel, cols=det_sel)
+	else:
+		sinos = prefetch.iter_sinos_binned(dset, int_from, min(int_to + 2, num_sinos), downsc_factor, downsc_mode, 
+			rows=proj_sel)
+
+	# Process the required subset of images (two sinograms at a time):
+	t0 = time()
+	for i, im1 in sinos:
 		
-		# Read two sinograms:
-		t0 = time()
-		f_in = getHDF5(infile, 'r')
-		if "/tomo" in f_in:
-			dset = f_in['tomo']
-		else: 
-			dset = f_in['exchange/data']
-		im1 = tdf.read_sino(dset,i).astype(float32)		
-		if ( (i + 1) <= (int_to + 1) ):
-			im2 = tdf.read_sino(dset,i + 1).astype(float32)		
-		else:
-			im2 = im1
-		f_in.close()
-		t1 = time() 	
+		if (i > int_to):
+			break
 
+		# Get the two sinograms (a copy is required as the slab buffer is reused):
+		im1 = im1.astype(float32)
+		i2, im2 = next(sinos, (i, im1))
+		im2 = im2.astype(float32)
+		t1 = time() 	
 
-		# Apply projection removal (if required):
-		im1 = im1[angles_projfrom:angles_projto, :]				
-		im2 = im2[angles_projfrom:angles_projto, :]				
-			
 		# Perform the preprocessing of the sinograms (if required):
 		if (preprocessing_required):
 			if not skipflat:			
@@ -419,8 +474,8 @@ def process_gridrec(lock, int_from, int_to, num_sinos, infile, outpath, preproce
 				else:
 					im1 = flat_fielding (im1, i, corr_plan, flat_end, half_half, half_half_line, norm_sx, norm_dx).astype(float32)		
 			im1 = extfov_correction (im1, ext_fov, ext_fov_rot_right, ext_fov_overlap)
-			if not skipflat:
-				im1 = ring_correction (im1, ringrem, flat_end, corr_plan['skip_flat_after'], half_half, half_half_line, ext_fov)
+			if not skipflat and not dynamic_ff:
+				im1 = ring_correction (im1, ringrem, flat_end, corr_plan.skip_flat_after, half_half, half_half_line, ext_fov)
 			else:
 				im1 = ring_correction (im1, ringrem, False, False, half_half, half_half_line, ext_fov)
 
@@ -432,14 +487,14 @@ def process_gridrec(lock, int_from, int_to, num_sinos, infile, outpath, preproce
 					im2 = flat_fielding (im2, i + 1, corr_plan, flat_end, half_half, half_half_line, norm_sx, norm_dx).astype(float32)		
 			im2 = extfov_correction (im2, ext_fov, ext_fov_rot_right, ext_fov_overlap)
 			if not skipflat and not dynamic_ff:		
-				im2 = ring_correction (im2, ringrem, flat_end, corr_plan['skip_flat_after'], half_half, half_half_line, ext_fov)
+				im2 = ring_correction (im2, ringrem, flat_end, corr_plan.skip_flat_after, half_half, half_half_line, ext_fov)
 			else:
 				im2 = ring_correction (im2, ringrem, False, False, half_half, half_half_line, ext_fov)
 		
 
 		# Actual reconstruction:
-		[im1, im2] = reconstruct_gridrec(im1, im2, angles, offset, logtransform, param1, circle, scale, pad, rolling, roll_shift,
-						zerone_mode, dset_min, dset_max, decim_factor, downsc_factor, corr_offset)					
+		[im1, im2] = reconstruct_gridrec(im1, im2, angles, rec_offset, logtransform, param1, circle, scale, pad, rolling, roll_shift,
+						zerone_mode, dset_min, dset_max, rec_decim, rec_downsc, corr_offset)					
 
 		# Appy post-processing (if required):
 		if postprocess_required:
@@ -473,19 +528,43 @@ def process_gridrec(lock, int_from, int_to, num_sinos, infile, outpath, preproce
 								
 		# Write log (atomic procedure - lock used):
 		write_log_gridrec(lock, fname1, fname2, logfilename, t2 - t1, (t3 - t2) + (t1 - t0) )		
+		t0 = time()
+
+	# Stop the prefetching thread (the loop can end before the last slab):
+	sinos.close()
+
+	h5cache.log_cache_stats(f_in, logfilename, lock)
+	f_in.close()
 
 
 def process(lock, int_from, int_to, num_sinos, infile, outpath, preprocessing_required, skipflat, corr_plan, norm_sx, norm_dx, 
 			flat_end, half_half, 
 			half_half_line, ext_fov, ext_fov_rot_right, ext_fov_overlap, ringrem, angles, angles_projfrom, angles_projto,
             offset, logtransform, param1, circle, scale, pad, method, rolling, roll_shift, zerone_mode, dset_min, dset_max, decim_factor, 
-			downsc_factor, corr_offset,	postprocess_required, convert_opt, crop_opt, dynamic_ff, EFF, filtEFF, im_dark, 
-			outprefix, logfilename):
+			downsc_factor, downsc_mode, corr_offset, postprocess_required, convert_opt, crop_opt, dynamic_ff, EFF, filtEFF, im_dark, 
+			outprefix, io_threads, logfilename):
 	"""To do...
 
 	"""
+	# Open the TDF file only once (sinograms are read in slabs and compressed chunks are
+	# decompressed by io_threads threads):
+	f_in = h5cache.open_file(infile, 'sino')
+	if "/tomo" in f_in:
+		dset = tdf.TDFDataset(f_in['tomo'], threads=io_threads)
+	else: 
+		dset = tdf.TDFDataset(f_in['exchange/data'], threads=io_threads)
+
+	# Only the required projections (and pixels) are read:
+	proj_sel, det_sel, rec_offset, rec_decim, rec_downsc = get_read_sel(preprocessing_required, angles_projfrom, 
+		angles_projto, offset, scale, decim_factor, downsc_factor, downsc_mode)
+	if (downsc_mode is None):
+		sinos = prefetch.iter_sinos(dset, int_from, int_to + 1, rows=proj_sel, cols=det_sel)
+	else:
+		sinos = prefetch.iter_sinos_binned(dset, int_from, int_to + 1, downsc_factor, downsc_mode, rows=proj_sel)
+
 	# Process the required subset of images:
-	for i in range(int_from, int_to + 1):                 
+	t0 = time()
+	for i, im in sinos:                 
 		
 		# Perform reconstruction (on-the-fly preprocessing and phase retrieval, if required):
 		#if (phaseretrieval_required):
@@ -546,19 +625,9 @@ def process(lock, int_from, int_to, num_sinos, infile, outpath, preprocessing_re
 			
 		#else:
 
-		# Read only one sinogram:
-		t0 = time()
-		f_in = getHDF5(infile, 'r')
-		if "/tomo" in f_in:
-			dset = f_in['tomo']
-		else: 
-			dset = f_in['exchange/data']
-		im = tdf.read_sino(dset,i).astype(float32)		
-		f_in.close()
+		# Get the sinogram (I/O time is spent waiting for the slabs read in background):
+		im = im.astype(float32)		
 		t1 = time() 	
-
-		# Apply projection removal (if required):
-		im = im[angles_projfrom:angles_projto, :]				
 			
 		# Perform the preprocessing of the sinogram (if required):
 		if (preprocessing_required):
@@ -570,14 +639,14 @@ def process(lock, int_from, int_to, num_sinos, infile, outpath, preprocessing_re
 					im = flat_fielding (im, i, corr_plan, flat_end, half_half, half_half_line, norm_sx, norm_dx).astype(float32)		
 			im = extfov_correction (im, ext_fov, ext_fov_rot_right, ext_fov_overlap)
 			if not skipflat and not dynamic_ff:
-				im = ring_correction (im, ringrem, flat_end, corr_plan['skip_flat_after'], half_half, half_half_line, ext_fov)
+				im = ring_correction (im, ringrem, flat_end, corr_plan.skip_flat_after, half_half, half_half_line, ext_fov)
 			else:
 				im = ring_correction (im, ringrem, False, False, half_half, half_half_line, ext_fov)
 		
 
 		# Actual reconstruction:
-		im = reconstruct(im, angles, offset, logtransform, param1, circle, scale, pad, method, rolling, roll_shift,
-						zerone_mode, dset_min, dset_max, decim_factor, downsc_factor, corr_offset).astype(float32)			
+		im = reconstruct(im, angles, rec_offset, logtransform, param1, circle, scale, pad, method, rolling, roll_shift,
+						zerone_mode, dset_min, dset_max, rec_decim, rec_downsc, corr_offset).astype(float32)			
 		
 		# Apply post-processing (if required):
 		if postprocess_required:
@@ -603,6 +672,10 @@ def process(lock, int_from, int_to, num_sinos, infile, outpath, preprocessing_re
 								
 		# Write log (atomic procedure - lock used):
 		write_log(lock, fname, logfilename, t2 - t1, (t3 - t2) + (t1 - t0) )
+		t0 = time()
+
+	h5cache.log_cache_stats(f_in, logfilename, lock)
+	f_in.close()
 
 
 def main(argv):          
@@ -684,7 +757,14 @@ def main(argv):
 	reconmethod = argv[25]		
 	
 	decim_factor = int(argv[26])
-	downsc_factor = int(argv[27])
+	downsc_factor, downsc_mode = tdf.parse_downsc(argv[27]) # e.g. "2" (decimation) or "2:mean" (binning)
+
+	# Binned sinograms are read already binned, so the parameters in pixels have to refer 
+	# to the binned detector (as for the center offset in get_read_sel):
+	if (downsc_mode is not None):
+		norm_sx = int(ceil(norm_sx / float(downsc_factor)))
+		norm_dx = int(ceil(norm_dx / float(downsc_factor)))
+		ext_fov_overlap = int(round(ext_fov_overlap / float(downsc_factor)))
 	
 	# Parameters for postprocessing:
 	postprocess_required = True if argv[28] == "True" else False
@@ -702,6 +782,12 @@ def main(argv):
 	nr_threads = int(argv[36])	
 	logfilename = argv[37]	
 	process_id = int(logfilename[-6:-4])
+
+	# Reduction of the flat/dark images (optional: 'mean', 'median' or 'sigmaclip'):
+	reduce_method = argv[38] if (len(argv) > 38) else 'mean'
+
+	# Correction of the defective pixels found from the flat/dark images (optional):
+	defect_map = True if (len(argv) > 39) and (argv[39] == "True") else False
 	
 	# Check prefixes and path:
 	#if not infile.endswith(sep): infile += sep
@@ -711,15 +797,15 @@ def main(argv):
 	if not outpath.endswith(sep): outpath += sep
 		
 	# Open the HDF5 file:
-	f_in = getHDF5(infile, 'r')
+	f_in = h5cache.open_file(infile, 'sino')
 	if "/tomo" in f_in:
-		dset = f_in['tomo']
+		dset = tdf.TDFDataset(f_in['tomo'])
 		
 		tomoprefix = 'tomo'
 		flatprefix = 'flat'
 		darkprefix = 'dark'
 	else: 
-		dset = f_in['exchange/data']
+		dset = tdf.TDFDataset(f_in['exchange/data'])
 		if "/provenance/detector_output" in f_in:
 			prov_dset = f_in['provenance/detector_output']		
 			
@@ -730,17 +816,21 @@ def main(argv):
 	dset_min = -1
 	dset_max = -1
 	if (zerone_mode):
-		if ('min' in dset.attrs):
-			dset_min = float(dset.attrs['min'])								
-		else:
+		if ('min' not in dset.attrs) or ('max' not in dset.attrs):
 			zerone_mode = False
-			
-		if ('max' in dset.attrs):
-			dset_max = float(dset.attrs['max'])				
 		else:
-			zerone_mode = False	
+			# Use the limits of the whole dataset only if the histogram is available and the 
+			# limits describe the sinograms to reconstruct, i.e. with no preprocessing on the fly 
+			# and no sum binning (otherwise each sinogram is scaled to its own extrema):
+			dset_stats = stats.read_stats(dset)
+			if (dset_stats is not None) and (not preprocessing_required) and (downsc_mode != 'sum'):
+				dset_min, dset_max = dset_stats.get_limits()
 		
 	num_sinos = tdf.get_nr_sinos(dset) # Pay attention to the downscale factor
+
+	# With binning the indexes refer to the binned dataset:
+	if (downsc_mode is not None):
+		num_sinos = num_sinos // downsc_factor
 	
 	if (num_sinos == 0):
 		log = open(logfilename,"a")
@@ -759,6 +849,12 @@ def main(argv):
 	log.write(linesep + "\t--------------")		
 	log.write(linesep + "\tPreparing the work plan...")	
 	log.close()	
+
+	if reduce_method not in REDUCE_METHODS:
+		log = open(logfilename,"a")
+		log.write(linesep + "\tError: reduction method '%s' not supported. Process will end." % (reduce_method))	
+		log.close()			
+		exit()		
 	
 	# Get correction plan and phase retrieval plan (if required):
 	corrplan = -1
@@ -772,25 +868,36 @@ def main(argv):
 	if (preprocessing_required):
 		if not dynamic_ff:
 			# Load flat fielding plan either from cache (if required) or from TDF file and cache it for faster re-use:			
-			corrplan = extract_flatdark(f_in, flat_end, logfilename)
+			corrplan = extract_flatdark(f_in, flat_end, logfilename, reduce_method)
 			if (isscalar(corrplan['im_flat']) and isscalar(corrplan['im_flat_after']) ):
 				skipflat = True
 			
 			# Dowscale flat and dark images if necessary:
 			if isinstance(corrplan['im_flat'], ndarray):
-				corrplan['im_flat'] = corrplan['im_flat'][::downsc_factor,::downsc_factor]		
+				corrplan['im_flat'] = tdf.downscale_image(corrplan['im_flat'], downsc_factor, downsc_mode)		
 			if isinstance(corrplan['im_dark'], ndarray):
-				corrplan['im_dark'] = corrplan['im_dark'][::downsc_factor,::downsc_factor]	
+				corrplan['im_dark'] = tdf.downscale_image(corrplan['im_dark'], downsc_factor, downsc_mode)	
 			if isinstance(corrplan['im_flat_after'], ndarray):
-				corrplan['im_flat_after'] = corrplan['im_flat_after'][::downsc_factor,::downsc_factor]	
+				corrplan['im_flat_after'] = tdf.downscale_image(corrplan['im_flat_after'], downsc_factor, downsc_mode)	
 			if isinstance(corrplan['im_dark_after'], ndarray):
-				corrplan['im_dark_after'] = corrplan['im_dark_after'][::downsc_factor,::downsc_factor]			
+				corrplan['im_dark_after'] = tdf.downscale_image(corrplan['im_dark_after'], downsc_factor, downsc_mode)			
+
+			# Compile the flat fielding plan once for all the sinograms (with the defective 
+			# pixels of the detector, if required):
+			if not skipflat:
+				defects = find_defects(corrplan) if defect_map else None
+				if defects is not None:
+					log = open(logfilename,"a")
+					log.write(linesep + "\tDefective pixels found: %d." % len(defects))
+					log.close()
+				corrplan = FlatFieldPlan(corrplan, flat_end, half_half, half_half_line, norm_sx, norm_dx, 
+					defects=defects)
 
 		else:
 			# Dynamic flat fielding:
 			if "/tomo" in f_in:				
 				if "/flat" in f_in:
-					flat_dset = f_in['flat']
+					flat_dset = tdf.TDFDataset(f_in['flat'])
 					if "/dark" in f_in:
 						im_dark = _medianize(f_in['dark'])
 					else:										
@@ -799,7 +906,7 @@ def main(argv):
 					skipflat = True # Nothing to do in this case			
 			else: 
 				if "/exchange/data_white" in f_in:
-					flat_dset = f_in['/exchange/data_white']
+					flat_dset = tdf.TDFDataset(f_in['/exchange/data_white'])
 					if "/exchange/data_dark" in f_in:
 						im_dark = _medianize(f_in['/exchange/data_dark'])	
 					else:					
@@ -812,9 +919,9 @@ def main(argv):
 				EFF, filtEFF = dff_prepare_plan(flat_dset, 16, im_dark)
 
 				# Downscale images if necessary:
-				im_dark = im_dark[::downsc_factor,::downsc_factor]
-				EFF = EFF[::downsc_factor,::downsc_factor,:]	
-				filtEFF = filtEFF[::downsc_factor,::downsc_factor,:]	
+				im_dark = tdf.downscale_image(im_dark, downsc_factor, downsc_mode)
+				EFF = tdf.downscale_image(EFF, downsc_factor, downsc_mode)	
+				filtEFF = tdf.downscale_image(filtEFF, downsc_factor, downsc_mode)	
 			
 	f_in.close()			
 		
@@ -825,6 +932,9 @@ def main(argv):
 	log.write(linesep + "\tPerforming reconstruction...")			
 	log.close()	
 
+	# Each process decompresses its chunks with the cores left free by the other ones:
+	io_threads = chunks.get_nr_threads(nr_threads)
+
 	# Run several threads for independent computation without waiting for threads completion:
 	for num in range(nr_threads):
 		start = ( (int_to - int_from + 1) / nr_threads)*num + int_from
@@ -838,18 +948,18 @@ def main(argv):
 						ext_fov_overlap, ringrem, 
 						angles, angles_projfrom, angles_projto, offset, logtrsf, param1, circle, scale, overpad, 
                         rolling, roll_shift,
-						zerone_mode, dset_min, dset_max, decim_factor, downsc_factor, corr_offset, 
+						zerone_mode, dset_min, dset_max, decim_factor, downsc_factor, downsc_mode, corr_offset, 
 						postprocess_required, convert_opt, crop_opt, dynamic_ff, EFF, filtEFF, im_dark, outprefix, 
-						logfilename )).start()
+						io_threads, logfilename )).start()
 		else:
 			Process(target=process, args=(lock, start, end, num_sinos, infile, outpath, preprocessing_required, skipflat, 
 						corrplan, norm_sx, 
 						norm_dx, flat_end, half_half, half_half_line, ext_fov, ext_fov_rot_right, ext_fov_overlap, ringrem, 
 						angles, angles_projfrom, angles_projto, offset, logtrsf, param1, circle, scale, overpad, 
 						reconmethod, rolling, roll_shift,
-                        zerone_mode, dset_min, dset_max, decim_factor, downsc_factor, corr_offset, 
+                        zerone_mode, dset_min, dset_max, decim_factor, downsc_factor, downsc_mode, corr_offset, 
 						postprocess_required, convert_opt, crop_opt, dynamic_ff, EFF, filtEFF, im_dark, outprefix, 
-						logfilename )).start()
+						io_threads, logfilename )).start()
 
 	#start = int_from
 	#end = int_to
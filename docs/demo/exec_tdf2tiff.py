@@ -38,6 +38,7 @@ from h5py import File as getHDF5
 
 # pystp-specific:
 import stp_core.io.tdf as tdf
+import stp_core.io.h5cache as h5cache
 
 from multiprocessing import Process, Lock
 
@@ -61,8 +62,8 @@ def _process(lock, int_from, int_to, infile, dset_str, TIFFFormat, projorder, ou
 	"""							
 	try:			
 
-		f = getHDF5( infile, 'r' )	
-		dset = f[dset_str]
+		f = h5cache.open_file( infile, 'tomo' if projorder else 'sino', dset_str )	
+		dset = tdf.TDFDataset(f[dset_str])
 				
 		# Process the required subset of images:
 		for i in range(int_from, int_to + 1):                  			
@@ -95,6 +96,7 @@ def _process(lock, int_from, int_to, infile, dset_str, TIFFFormat, projorder, ou
 			# Print out execution time:	
 			_write_log(lock, fname, logfilename, t1 - t0)
 					
+		h5cache.log_cache_stats(f, logfilename, lock)
 		f.close()
 				
 	except Exception: 
@@ -264,12 +266,12 @@ def main(argv):
 		exit()	
 
 	# Open the HDF5 file:
-	f = getHDF5( infile, 'r' )
+	f = h5cache.open_file( infile, 'tomo' )
 	
 	oldTDF = False;
 	
 	try:		
-		dset = f['tomo']			
+		dset = tdf.TDFDataset(f['tomo'])			
 		oldTDF = True
 		
 	except Exception:
@@ -279,7 +281,7 @@ def main(argv):
 	if not oldTDF:
 		
 		#try:
-			dset = f['exchange/data']
+			dset = tdf.TDFDataset(f['exchange/data'])
 			
 		#except Exception:		
 			
@@ -298,7 +300,7 @@ def main(argv):
 
 	# Get attributes:
 	try:
-		f = getHDF5( infile, 'r' )
+		f = h5cache.open_file( infile, 'tomo' )
 		if ('version' in f.attrs) and (f.attrs['version'] == 'TDF 1.0'):	
 			log = open(logfilename,"a")
 			log.write(os.linesep + "\tTDF version 1.0 found.")
@@ -321,12 +323,12 @@ def main(argv):
 	# Spawn the process for the conversion of flat images:
 	if not skipflat:
 
-		f = getHDF5( infile, 'r' )
+		f = h5cache.open_file( infile, 'tomo' )
 		if oldTDF:
 			dset_str = 'flat'
 		else:
 			dset_str = 'exchange/data_white'
-		num_flats = tdf.get_nr_projs(f[dset_str])
+		num_flats = tdf.get_nr_projs(tdf.TDFDataset(f[dset_str]))
 		f.close()	
 
 		if ( num_flats > 0):
@@ -337,12 +339,12 @@ def main(argv):
 	# Spawn the process for the conversion of dark images:
 	if not skipdark:
 
-		f = getHDF5( infile, 'r' )
+		f = h5cache.open_file( infile, 'tomo' )
 		if oldTDF:
 			dset_str = 'dark'
 		else:
 			dset_str = 'exchange/data_dark'
-		num_darks = tdf.get_nr_projs(f[dset_str])
+		num_darks = tdf.get_nr_projs(tdf.TDFDataset(f[dset_str]))
 		f.close()	
 
 		if ( num_darks > 0):
@@ -40,74 +40,138 @@ from h5py import File as getHDF5
 
 # pystp-specific:
 import stp_core.io.tdf as tdf
+import stp_core.io.compression as compression
+import stp_core.io.writer as writer
+import stp_core.io.stats as stats
+import stp_core.io.chunks as chunks
 from multiprocessing import Process, Lock
+from multiprocessing.pool import ThreadPool
 
+SLAB_IMAGES = 16        # Max number of images sent to the writer process with a single message
+SLAB_BYTES = 16777216   # Max size in bytes of a slab of images (it bounds the memory of the queue and of the 
+                        # chunks buffered by each process)
 
-def _write_data(lock, im, index, offset, abs_offset, imfilename, timestamp, projorder, tot_files, 
-				provenance_dt, outfile, dsetname, outshape, outtype, logfilename, itime):    	      
-	"""To do...
+def _get_chunk_info(dset, projorder, order):
+	"""Get what the workers need to compress the chunks of the dataset by themselves 
+	(None if the filters of the dataset are not supported, e.g. for fast codecs).
 
 	"""
-	lock.acquire()
-	try:  
+	if not chunks.is_supported(dset):
+		return None
+	axis = 0 if (projorder == (order == 0)) else 1
+	return (dset.shape, dset.chunks, dset.dtype, axis, chunks.get_pipeline(dset))
 
-		# Open the HDF5 file to be populated with projections (or sinograms):
-		t0 = time.time() 			
-		f_out = getHDF5( outfile, 'a' )					 
-		f_out_dset = f_out.require_dataset(dsetname, outshape, outtype, chunks=tdf.get_dset_chunks(outshape[0])) 
-		
-		# Write the projection file or sinogram file:
-		if projorder:
-			tdf.write_tomo(f_out_dset, index - abs_offset, im)
-		else:
-			tdf.write_sino(f_out_dset, index - abs_offset, im)
-					
-		# Set minimum and maximum:
-		if ( numpy.amin(im[:]) < float(f_out_dset.attrs['min']) ):
-			f_out_dset.attrs['min'] = str(numpy.amin(im[:]))
-		if ( numpy.amax(im[:]) > float(f_out_dset.attrs['max'])):
-			f_out_dset.attrs['max'] = str(numpy.amax(im[:]))	
-			
-		# Save provenance metadata:
-		provenance_dset =  f_out.require_dataset('provenance/detector_output', (tot_files,), dtype=provenance_dt)	
-		provenance_dset["filename", offset - abs_offset + index] = numpy.string_(os.path.basename(imfilename))
-		provenance_dset["timestamp", offset - abs_offset + index] = numpy.string_(
-			datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3])
-		
-		# Close the HDF5:
-		f_out.close()	
-		t1 = time.time()
 
-		# Print out execution time:
-		log = open(logfilename,"a")
-		log.write(os.linesep + "\t%s processed (I: %0.3f sec - O: %0.3f sec)." % (os.path.basename(imfilename), itime, t1 - t0))
-		log.close()	
+def _read_image(filename, crop_top, crop_bottom, crop_left, crop_right):
+	"""Decode (and crop) a TIFF file and get its timestamp (called by the decoding threads).
 
-	finally:
-		lock.release()	
+	"""
+	t0 = time.time()
+	im = imread(filename)
+	im = im[crop_top:im.shape[0]-crop_bottom,crop_left:im.shape[1]-crop_right]
+	t = os.path.getmtime(filename)
 
-def _process(lock, int_from, int_to, offset, abs_offset, files, projorder, outfile, dsetname, outshape, outtype, 
-			crop_top, crop_bottom, crop_left, crop_right, tot_files, provenance_dt, logfilename):
-	"""To do...
+	return (im, t, time.time() - t0)
 
-	"""
-	# Process the required subset of images:
-	for i in range(int_from, int_to + 1):    
-		
-		# Read input image:
-		t0 = time.time()
-		im = imread(files[i])
 
-		# Crop:
-		im = im[crop_top:im.shape[0]-crop_bottom,crop_left:im.shape[1]-crop_right]	
+def _send_slab(queue, dsetname, kind, start, images, stacker, pipeline, lines):
+	"""Send a slab of consecutive images to the writer process: the completed chunks are 
+	compressed here while the other images are sent with one message for each run of
+	consecutive indexes. The log lines are sent with the last message (if any).
 
-		# Get the timestamp:
-		t = os.path.getmtime(files[i])
-		t1 = time.time() 					
-								
-		# Save processed image to HDF5 file (atomic procedure - lock used):
-		_write_data(lock, im, i, offset, abs_offset, files[i], t, projorder, tot_files, provenance_dt, 
-					outfile, dsetname, outshape, outtype, logfilename, t1 - t0)
+	"""
+	encoded = []
+	runs = []
+	for k in range(0, len(images)):
+		row = None if stacker is None else stacker.add(start + k, images[k])
+		if row is None:
+			if (len(runs) > 0) and (runs[-1][0] + len(runs[-1][1]) == start + k):
+				runs[-1][1].append(images[k])
+			else:
+				runs.append((start + k, [images[k]]))
+		else:
+			encoded.extend(chunks.encode_chunks(row, pipeline))
+
+	msgs = len(encoded) + len(runs)
+	line = (os.linesep + "\t").join(lines) if (msgs > 0) and (len(lines) > 0) else None
+	for chunk_offsets, data in encoded:
+		msgs -= 1
+		writer.put_chunk(queue, dsetname, chunk_offsets, data, line if (msgs == 0) else None)
+	for index, run in runs:
+		msgs -= 1
+		writer.put_images(queue, dsetname, kind, index, numpy.stack(run), line if (msgs == 0) else None)
+	if line is not None:
+		del lines[:]
+
+
+def _process(queue, int_from, int_to, offset, abs_offset, files, projorder, outfile, dsetname, outshape, outtype, 
+			crop_top, crop_bottom, crop_left, crop_right, tot_files, provenance_dt, chunk_info, nr_decoders, logfilename):
+	"""To do...
+
+	"""
+	# Statistics of the images (merged by the writer process):
+	im_stats = stats.RunningStats()
+	kind = 'tomo' if projorder else 'sino'
+
+	# The writer process waits for producer_done even if the conversion fails:
+	try:
+		# Whole chunks are compressed here and stored as they are by the writer process
+		# (chunks shared with another process or whose row of chunks does not fit the memory 
+		# budget are compressed by the writer):
+		stacker = None
+		pipeline = None
+		if chunk_info is not None:
+			shape, chunk_shape, dtype, axis, pipeline = chunk_info
+			stacker = chunks.ChunkStacker(shape, chunk_shape, dtype, axis, int_from - abs_offset, int_to + 1 - abs_offset, 
+				SLAB_BYTES)
+
+		# Images are sent in slabs within the memory budget (the size of the images is bounded by the
+		# shape of the dataset):
+		im_bytes = max(outshape[0], outshape[1]) * outshape[2] * numpy.dtype(outtype).itemsize
+		slab_size = max(1, min(SLAB_IMAGES, SLAB_BYTES // max(im_bytes, 1)))
+		names = files[int_from:int_to + 1]
+		batches = [(j, names[j:j + slab_size]) for j in range(0, len(names), slab_size)]
+
+		# TIFF files are decoded by a pool of threads (the next slab is decoded while the current 
+		# one is sent to the writer process):
+		pool = ThreadPool(nr_decoders)
+		read = lambda filename: _read_image(filename, crop_top, crop_bottom, crop_left, crop_right)
+		if (len(batches) > 0):
+			result = pool.map_async(read, batches[0][1])
+
+		rows = []
+		lines = []
+		for b in range(0, len(batches)):
+			j, batch = batches[b]
+			decoded = result.get()
+			if (b + 1 < len(batches)):
+				result = pool.map_async(read, batches[b + 1][1])
+
+			images = []
+			for filename, (im, t, t_read) in zip(batch, decoded):
+				im_stats.update(im)
+				images.append(im)
+				rows.append((numpy.string_(os.path.basename(filename)), 
+					numpy.string_(datetime.datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3])))
+				lines.append("%s processed (I: %0.3f sec)." % (os.path.basename(filename), t_read))
+
+			# Send the slab of projections or sinograms (or the completed chunks) to the writer process:
+			_send_slab(queue, dsetname, kind, int_from - abs_offset + j, images, stacker, pipeline, lines)
+
+		pool.close()
+		pool.join()
+
+		# Images of incomplete chunks (if any):
+		if stacker is not None:
+			for index, im in stacker.flush():
+				writer.put_image(queue, dsetname, kind, index, im)
+
+		# Provenance metadata in bulk:
+		writer.put_rows(queue, 'provenance/detector_output', offset - abs_offset + int_from, rows, 
+			(os.linesep + "\t").join(lines) if (len(lines) > 0) else None)
+	finally:
+		writer.put_stats(queue, dsetname, im_stats)
+		writer.producer_done(queue)
 
 
 def main(argv):          
@@ -173,10 +237,13 @@ def main(argv):
 		specify the string "True" if the TDF will privilege a fast read/write of sinograms (the most common 
 		case), "False" for fast read/write of projections.
 		
-	compression : scalar, integer
+	compression : scalar, integer or string
 		an integer value in the range of [1,9] to be used as GZIP compression factor in the HDF5 file, where
 		1 is the minimum compression (and maximum speed) and 9 is the maximum (and slow) compression.
-		The value 0 can be specified with the meaning of no compression.
+		The value 0 can be specified with the meaning of no compression. Faster lossless codecs can be 
+		specified as well (they require the hdf5plugin package or the HDF5 filters in HDF5_PLUGIN_PATH): 
+		"lz4", "zstd:<level>", "bitshuffle" (with LZ4), "bitshuffle:zstd:<level>" and "blosc:<compressor>:<level>" 
+		(e.g. "blosc:zstd:5"). See stp_core.io.compression.
 
 	nr_threads : int
 		number of multiple threads (actually processes) to consider to speed up the whole conversion process.
@@ -234,16 +301,21 @@ def main(argv):
 	projorder = True if argv[11] == "True" else False		
 	privilege_sino = True if argv[12] == "True" else False
 
-	# Get compression factor:
-	compr_opts = int(argv[13])
-	compressionFlag = True;
-	if (compr_opts <= 0):
-		compressionFlag = False;
-	elif (compr_opts > 9):
-		compr_opts = 9		
+	# Get compression setting (GZIP factor or fast codec, e.g. "lz4" or "zstd:3"):
+	compr_spec = argv[13]
 	
 	nr_threads  = int(argv[14])
 	logfilename = argv[15]	
+
+	# Check the compression setting:
+	try:
+		compr_args = compression.get_compression_args(compr_spec)
+		compressionFlag = (len(compr_args) > 0)
+	except ValueError as e:
+		log = open(logfilename,"w")
+		log.write(os.linesep + "\tError: %s Process will end." % (str(e)))
+		log.close()
+		exit()
 	
 	# Check prefixes and path:
 	if not inpath.endswith(os.path.sep): inpath += os.path.sep
@@ -276,7 +348,7 @@ def main(argv):
 		log.write(os.linesep + "\tFast I/O for projections privileged.")
 	
 	if (compressionFlag):
-		log.write(os.linesep + "\tTDF compression factor: %d" % (compr_opts))
+		log.write(os.linesep + "\tTDF compression: %s" % (compression.describe(compr_spec)))
 	else:
 		log.write(os.linesep + "\tTDF compression: none.")
 	
@@ -334,13 +406,16 @@ def main(argv):
 	log.write(os.linesep + "\tPreparing the work plan...")	
 	log.close()
 						
+	# Sinograms or projections stored contiguously (according to the axes attribute):
+	order = 1 if privilege_sino else 0
+
 	#dsetshape = (num_files,) + im.shape
 	if projorder:			
 		#dsetshape = tdf.get_dset_shape(privilege_sino, im.shape[1], im.shape[0], num_files)
-		datashape = tdf.get_dset_shape(im.shape[1], im.shape[0], num_files)
+		datashape = tdf.get_dset_shape(im.shape[1], im.shape[0], num_files, order)
 	else:
 		#dsetshape = tdf.get_dset_shape(privilege_sino, im.shape[1], num_files, im.shape[0])
-		datashape = tdf.get_dset_shape(im.shape[1], num_files, im.shape[0])
+		datashape = tdf.get_dset_shape(im.shape[1], num_files, im.shape[0], order)
 			
 	if not os.path.isfile(outfile):									
 		f = getHDF5( outfile, 'w' )
@@ -350,15 +425,14 @@ def main(argv):
 		echange_group  = f.create_group( 'exchange' )			
 			
 		if (compressionFlag):
-			dset = f.create_dataset('exchange/data', datashape, im.dtype, chunks=tdf.get_dset_chunks(im.shape[1]), 
-				compression="gzip", compression_opts=compr_opts, shuffle=True, fletcher32=True)
+			dset = f.create_dataset('exchange/data', datashape, im.dtype, chunks=tdf.get_dset_chunks(im.shape[1], datashape, 
+				im.dtype, True, 'sino' if privilege_sino else 'tomo', order), 
+				**compr_args)
 		else:
 			dset = f.create_dataset('exchange/data', datashape, im.dtype)		
+		data_chunks = _get_chunk_info(dset, projorder, order) if (compressionFlag) else None
 
-		if privilege_sino:			
-			dset.attrs['axes'] = "y:theta:x"
-		else:
-			dset.attrs['axes'] = "theta:y:x"
+		tdf.set_axes_attr(dset, order)
 				
 		dset.attrs['min'] = str(numpy.amin(im[:]))
 		dset.attrs['max'] = str(numpy.amax(im[:]))	
@@ -409,21 +483,20 @@ def main(argv):
 			im = im[crop_top:im.shape[0]-crop_bottom,crop_left:im.shape[1]-crop_right]
 			
 			#flatshape = tdf.get_dset_shape(privilege_sino, im.shape[1], im.shape[0], num_flats)
-			flatshape = tdf.get_dset_shape(im.shape[1], im.shape[0], num_flats)
+			flatshape = tdf.get_dset_shape(im.shape[1], im.shape[0], num_flats, order)
 			f = getHDF5( outfile, 'a' )	
 			if (compressionFlag):
-				dset = f.create_dataset('exchange/data_white', flatshape, im.dtype, chunks=tdf.get_dset_chunks(im.shape[1]), 
-					compression="gzip", compression_opts=compr_opts, shuffle=True, fletcher32=True)
+				dset = f.create_dataset('exchange/data_white', flatshape, im.dtype, chunks=tdf.get_dset_chunks(im.shape[1], flatshape, 
+					im.dtype, True, 'tomo', order), 
+					**compr_args)
 			else:
 				dset = f.create_dataset('exchange/data_white', flatshape, im.dtype)		
+			flat_chunks = _get_chunk_info(dset, True, order) if (compressionFlag) else None
 						
 			dset.attrs['min'] = str(numpy.amin(im[:]))
 			dset.attrs['max'] = str(numpy.amax(im[:]))
 			
-			if privilege_sino:			
-				dset.attrs['axes'] = "y:theta:x"
-			else:
-				dset.attrs['axes'] = "theta:y:x"
+			tdf.set_axes_attr(dset, order)
 			f.close()
 			
 			#process(lock, 0, num_flats - 1, 0, flat_files, True, outfile, 'exchange/data_white', dsetshape, im.dtype, 
@@ -445,21 +518,20 @@ def main(argv):
 			im = im[crop_top:im.shape[0]-crop_bottom,crop_left:im.shape[1]-crop_right]
 			
 			#darkshape = tdf.get_dset_shape(privilege_sino, im.shape[1], im.shape[0], num_flats)
-			darkshape = tdf.get_dset_shape(im.shape[1], im.shape[0], num_darks)
+			darkshape = tdf.get_dset_shape(im.shape[1], im.shape[0], num_darks, order)
 			f = getHDF5( outfile, 'a' )	
 			if (compressionFlag):
-				dset = f.create_dataset('exchange/data_dark', darkshape, im.dtype, chunks=tdf.get_dset_chunks(im.shape[1]), 
-					compression="gzip", compression_opts=compr_opts, shuffle=True, fletcher32=True)
+				dset = f.create_dataset('exchange/data_dark', darkshape, im.dtype, chunks=tdf.get_dset_chunks(im.shape[1], darkshape, 
+					im.dtype, True, 'tomo', order), 
+					**compr_args)
 			else:
 				dset = f.create_dataset('exchange/data_dark', darkshape, im.dtype)	
+			dark_chunks = _get_chunk_info(dset, True, order) if (compressionFlag) else None
 			
 			dset.attrs['min'] = str(numpy.amin(im))
 			dset.attrs['max'] = str(numpy.amax(im))
 			
-			if privilege_sino:			
-				dset.attrs['axes'] = "y:theta:x"
-			else:
-				dset.attrs['axes'] = "theta:y:x"
+			tdf.set_axes_attr(dset, order)
 			f.close()		
 			
 			#process(lock, 0, num_darks - 1, num_flats, dark_files, True, outfile, 'exchange/data_dark', dsetshape, im.dtype, 
@@ -472,20 +544,40 @@ def main(argv):
 			log.close()		
 		
 	# Process the required subset of images:
+	nr_producers = nr_threads
 	if not skipflat:
 		flatdark_offset = num_flats + num_darks
+		if ( num_flats > 0):
+			nr_producers += 1
+		if ( num_darks > 0):
+			nr_producers += 1
 	else:
 		flatdark_offset = 0
+		num_flats = 0
+		num_darks = 0
+
+	# A single process writes the TDF file (it keeps the file open while the other processes push their images):
+	proc, queue = writer.start_writer(outfile, nr_producers, logfilename, lock)
+
+	# Threads decoding the TIFF files within each process (decoding is mostly I/O):
+	nr_decoders = max(2, chunks.get_nr_threads(nr_producers))
 
 	# Spawn the process for the conversion of flat images:
+	workers = []
 	if ( num_flats > 0):
-		Process(target=_process, args=(lock, 0, num_flats - 1, 0, 0, flat_files, True, outfile, 'exchange/data_white', 
-			flatshape, im.dtype, crop_top, crop_bottom, crop_left, crop_right, tot_files, provenance_dt, logfilename )).start()
+		p = Process(target=_process, args=(queue, 0, num_flats - 1, 0, 0, flat_files, True, outfile, 'exchange/data_white', 
+			flatshape, im.dtype, crop_top, crop_bottom, crop_left, crop_right, tot_files, provenance_dt, flat_chunks, nr_decoders, 
+			logfilename ))
+		p.start()
+		workers.append(p)
 
 	# Spawn the process for the conversion of dark images:
 	if ( num_darks > 0):
-		Process(target=_process, args=(lock, 0, num_darks - 1, num_flats, 0, dark_files, True, outfile, 'exchange/data_dark', 
-			darkshape, im.dtype, crop_top, crop_bottom, crop_left, crop_right, tot_files, provenance_dt, logfilename )).start()
+		p = Process(target=_process, args=(queue, 0, num_darks - 1, num_flats, 0, dark_files, True, outfile, 'exchange/data_dark', 
+			darkshape, im.dtype, crop_top, crop_bottom, crop_left, crop_right, tot_files, provenance_dt, dark_chunks, nr_decoders, 
+			logfilename ))
+		p.start()
+		workers.append(p)
 
 	# Start the process for the conversion of the projections (or sinograms) in a multi-threaded way:
 	for num in range(nr_threads):
@@ -495,11 +587,18 @@ def main(argv):
 		else:
 			end = ( (int_to - int_from + 1) / nr_threads)*(num + 1) + int_from - 1
 
-		Process(target=_process, args=(lock, start, end, flatdark_offset, int_from, tomo_files, projorder, outfile, 'exchange/data', 
-				datashape, im.dtype, crop_top, crop_bottom, crop_left, crop_right, tot_files, provenance_dt, logfilename )).start()
+		p = Process(target=_process, args=(queue, start, end, flatdark_offset, int_from, tomo_files, projorder, outfile, 'exchange/data', 
+				datashape, im.dtype, crop_top, crop_bottom, crop_left, crop_right, tot_files, provenance_dt, data_chunks, nr_decoders, 
+				logfilename ))
+		p.start()
+		workers.append(p)
 		
-		#process(lock, start, end, offset, tomo_files, projorder, outfile, 'exchange/data', 
+		#process(queue, start, end, offset, tomo_files, projorder, outfile, 'exchange/data', 
 		#		datashape, im.dtype, crop_top, crop_bottom, crop_left, crop_right, tot_files, provenance_dt, logfilename )
+
+	# Wait for all the processes and check that the conversion succeeded:
+	if not writer.wait(workers, proc, queue, logfilename, lock):
+		exit(1)
 	
 if __name__ == "__main__":
 	main(argv[1:])
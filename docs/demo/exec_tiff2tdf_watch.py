@@ -0,0 +1,350 @@
+﻿###########################################################################
+# (C) 2016 Elettra - Sincrotrone Trieste S.C.p.A.. All rights reserved.   #
+#                                                                         #
+#                                                                         #
+# This file is part of STP-Core, the Python core of SYRMEP Tomo Project,  #
+# a software tool for the reconstruction of experimental CT datasets.     #
+#                                                                         #
+# STP-Core is free software: you can redistribute it and/or modify it     #
+# under the terms of the GNU General Public License as published by the   #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# STP-Core is distributed in the hope that it will be useful, but WITHOUT #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License    #
+# for more details.                                                       #
+#                                                                         #
+# You should have received a copy of the GNU General Public License       #
+# along with STP-Core. If not, see <http://www.gnu.org/licenses/>.        #
+#                                                                         #
+###########################################################################
+
+import datetime
+import os
+import os.path
+import numpy
+import time
+
+from sys import argv, exit
+from glob import glob
+from multiprocessing.pool import ThreadPool
+
+from tifffile import imread
+from h5py import File as getHDF5
+
+# pystp-specific:
+import stp_core.io.tdf as tdf
+import stp_core.io.compression as compression
+import stp_core.io.chunks as chunks
+import stp_core.io.stats as stats
+
+SLAB_IMAGES = 16          # Max number of files decoded (and appended) at a time
+BUFFER_BYTES = 268435456  # Max size in bytes of the projections buffered to write whole chunks
+
+
+def _read_image(filename, crop_top, crop_bottom, crop_left, crop_right):
+	"""Decode (and crop) a TIFF file and get its timestamp (called by the decoding threads).
+
+	"""
+	im = imread(filename)
+	im = im[crop_top:im.shape[0]-crop_bottom,crop_left:im.shape[1]-crop_right]
+
+	return (im, os.path.getmtime(filename))
+
+
+def _get_ready(inpath, prefix, sizes, poll_time, start=0):
+	"""Get the sorted list of the files with the specified prefix that are complete, i.e. 
+	whose size did not change for at least poll_time seconds. The first start files (already
+	converted) are not checked again. The size of all the other files is recorded at each
+	poll (as size and time since when the file has such size), but the list stops at the 
+	first file that is not complete so that the files are converted in order.
+
+	"""
+	ready = []
+	complete = True
+	t = time.time()
+	for filename in sorted(glob(inpath + prefix + '*.tif*'))[start:]:
+		try:
+			size = os.path.getsize(filename)
+		except OSError:
+			complete = False
+			continue
+		if (filename not in sizes) or (sizes[filename][0] != size):
+			sizes[filename] = (size, t)
+		if complete and (size > 0) and (t - sizes[filename][1] >= poll_time):
+			ready.append(filename)
+		else:
+			complete = False
+
+	return ready
+
+
+def _create_dset(f, name, im, nr_proj, order, access, compr_args):
+	"""Create a dataset that grows along the axis of the projections while the files arrive.
+	The chunks along such axis are limited so that the projections buffered to write whole
+	chunks fit BUFFER_BYTES.
+
+	"""
+	tomo_axis = 0 if (order == 0) else 1
+	shape = list(tdf.get_dset_shape(im.shape[1], im.shape[0], max(nr_proj, 1), order))
+	chunk_shape = list(tdf.get_dset_chunks(im.shape[1], shape, im.dtype, len(compr_args) > 0, access, order))
+	chunk_shape[tomo_axis] = max(1, min(chunk_shape[tomo_axis], BUFFER_BYTES // im.nbytes))
+	maxshape = list(shape)
+	maxshape[tomo_axis] = None
+	shape[tomo_axis] = 0
+
+	dset = f.create_dataset(name, tuple(shape), im.dtype, chunks=tuple(chunk_shape), maxshape=tuple(maxshape), 
+		**compr_args)
+	tdf.set_axes_attr(dset, order)
+
+	return tdf.TDFDataset(dset, order)
+
+
+def _append(state, provenance_dset, flush=False):
+	"""Append the buffered images to their dataset (as whole chunks unless flush is True) and 
+	then their provenance metadata. Readers see the new images after a refresh.
+
+	"""
+	dset = state['dset']
+	size = dset.chunks[0 if (dset.order == 0) else 1]
+	nr_images = len(state['images']) if flush else (len(state['images']) // size) * size
+	if (nr_images == 0):
+		return 0
+
+	tdf.append_tomos(dset, numpy.stack(state['images'][:nr_images]))
+
+	start = provenance_dset.shape[0]
+	provenance_dset.resize(start + nr_images, axis=0)
+	provenance_dset[start:start + nr_images] = numpy.array(state['rows'][:nr_images], dtype=provenance_dset.dtype)
+	provenance_dset.flush()
+
+	del state['images'][:nr_images]
+	del state['rows'][:nr_images]
+
+	return nr_images
+
+
+def main(argv):
+	"""Convert a sequence of TIFF files into a TDF file while the acquisition is still running 
+	(watch mode). The input folder is polled for new projection, flat and dark files. The complete
+	files are decoded by a pool of threads and appended to the TDF file, which is written in 
+	SWMR mode (single writer, multiple readers): the preview tools can open it at the same time
+	(see stp_core.io.tdf.open_swmr) and they see the datasets grow. The conversion ends when no
+	new files arrive for the specified time. Statistics, metadata (logfile.xml) and the attributes
+	that cannot be created in SWMR mode are stored at the end.
+
+	Parameters
+	----------
+	argv[0] : string
+		Path of the acquisition folder (e.g. "Z:\\sample1\\tomo\\").
+
+	argv[1] : string
+		The absolute path of the output TDF file (overwritten if it exists).
+
+	argv[2], argv[3], argv[4], argv[5] : int
+		Pixels to crop from the top, bottom, left and right of the images (0 for no cropping).
+
+	argv[6], argv[7], argv[8] : string
+		Filename prefixes of the projection, flat and dark files (e.g. "tomo", "flat", "dark"). 
+		The string "-" for flat or dark means "do not consider flat or darks".
+
+	argv[9] : boolean string
+		"True" if the TDF will privilege a fast read/write of sinograms, "False" for fast read/write of
+		projections (recommended for streaming, since projections are appended as they arrive).
+
+	argv[10] : scalar, integer or string
+		GZIP compression factor in the range [1,9], 0 for no compression or a fast codec (see 
+		stp_core.io.compression).
+
+	argv[11] : int
+		Expected number of projections used to tune the chunk shape (-1 if not known).
+
+	argv[12] : float
+		Time in seconds between two polls of the acquisition folder (e.g. 1.0).
+
+	argv[13] : float
+		Time in seconds without new files after which the conversion ends (e.g. 60.0).
+
+	argv[14] : string
+		The absolute path of the log file.
+
+	Example
+	-------
+	exec_tiff2tdf_watch "Z:\\sample1\\tomo\\" "S:\\sample1.tdf" 0 0 0 0 tomo flat dark False 1 1800 1.0 60.0 "R:\\Temp\\log.txt"
+
+	"""
+	# Get input parameters:
+	inpath = argv[0]
+	outfile = argv[1]
+
+	crop_top    = int(argv[2])
+	crop_bottom = int(argv[3])
+	crop_left   = int(argv[4])
+	crop_right  = int(argv[5])
+
+	tomoprefix = argv[6]
+	flatprefix = argv[7]
+	darkprefix = argv[8]
+	skipflat = (flatprefix == "-") or (darkprefix == "-")
+
+	privilege_sino = True if argv[9] == "True" else False
+	compr_spec = argv[10]
+	nr_proj = int(argv[11])
+	poll_time = float(argv[12])
+	timeout = float(argv[13])
+	logfilename = argv[14]
+
+	order = 1 if privilege_sino else 0
+	if not inpath.endswith(os.path.sep): inpath += os.path.sep
+
+	# Check the compression setting:
+	try:
+		compr_args = compression.get_compression_args(compr_spec)
+	except ValueError as e:
+		log = open(logfilename,"w")
+		log.write(os.linesep + "\tError: %s Process will end." % (str(e)))
+		log.close()
+		exit()
+
+	# Log input parameters:
+	log = open(logfilename,"w")
+	log.write(os.linesep + "\tWatched path: %s" % (inpath))
+	log.write(os.linesep + "\tOutput TDF file: %s" % (outfile))
+	log.write(os.linesep + "\t--------------")
+	log.write(os.linesep + "\tProjection file prefix: %s" % (tomoprefix))
+	log.write(os.linesep + "\tDark file prefix: %s" % (darkprefix))
+	log.write(os.linesep + "\tFlat file prefix: %s" % (flatprefix))
+	if (privilege_sino):
+		log.write(os.linesep + "\tFast I/O for sinograms privileged.")
+	else:
+		log.write(os.linesep + "\tFast I/O for projections privileged.")
+	if (len(compr_args) > 0):
+		log.write(os.linesep + "\tTDF compression: %s" % (compression.describe(compr_spec)))
+	else:
+		log.write(os.linesep + "\tTDF compression: none.")
+	log.write(os.linesep + "\tPolling every %0.1f sec (timeout: %0.1f sec)." % (poll_time, timeout))
+	log.write(os.linesep + "\t--------------")
+	log.write(os.linesep + "\tWaiting for the first projection...")
+	log.close()
+
+	# Remove a previous copy of output:
+	if os.path.exists(outfile):
+		os.remove(outfile)
+
+	# Wait for the first projection (it defines the shape of the images):
+	sizes = {}
+	t_last = time.time()
+	ready = _get_ready(inpath, tomoprefix, sizes, poll_time)
+	while (len(ready) == 0):
+		if (time.time() - t_last >= timeout):
+			log = open(logfilename,"a")
+			log.write(os.linesep + "\tError: no projection files found. Process will end.")
+			log.close()
+			exit()
+		time.sleep(poll_time)
+		ready = _get_ready(inpath, tomoprefix, sizes, poll_time)
+	im, t = _read_image(ready[0], crop_top, crop_bottom, crop_left, crop_right)
+
+	# Create the TDF file with all the datasets (objects cannot be created in SWMR mode):
+	f = getHDF5(outfile, 'w', libver='latest')
+	f.attrs['version'] = '1.0'
+	f.attrs['implements'] = "exchange:provenance"
+	f.create_group('exchange')
+
+	kinds = [('tomo', tomoprefix, 'exchange/data', 'sino' if privilege_sino else 'tomo', nr_proj)]
+	if not skipflat:
+		kinds.append(('flat', flatprefix, 'exchange/data_white', 'tomo', -1))
+		kinds.append(('dark', darkprefix, 'exchange/data_dark', 'tomo', -1))
+
+	states = {}
+	for kind, prefix, name, access, nr in kinds:
+		states[kind] = { 'dset': _create_dset(f, name, im, nr, order, access, compr_args), 'done': 0, 
+			'images': [], 'rows': [], 'stats': stats.RunningStats() }
+
+	provenance_dt = numpy.dtype([("filename", numpy.dtype("S255")), ("timestamp", numpy.dtype("S255"))])
+	f.create_group('provenance')
+	provenance_dset = f.create_dataset('provenance/detector_output', (0,), dtype=provenance_dt, maxshape=(None,), 
+		chunks=(256,))
+	provenance_dset.attrs['tomo_prefix'] = tomoprefix
+	provenance_dset.attrs['dark_prefix'] = darkprefix
+	provenance_dset.attrs['flat_prefix'] = flatprefix
+	provenance_dset.attrs['first_index'] = int(ready[0][-8:-4])
+
+	f.swmr_mode = True
+
+	log = open(logfilename,"a")
+	log.write(os.linesep + "\tTDF file created in SWMR mode (it can be read while it grows).")
+	log.close()
+
+	# Poll the acquisition folder until no new files arrive:
+	pool = ThreadPool(max(2, chunks.get_nr_threads()))
+	read = lambda filename: _read_image(filename, crop_top, crop_bottom, crop_left, crop_right)
+	t_last = time.time()
+	while True:
+
+		nr_new = 0
+		for kind, prefix, name, access, nr in kinds:
+			state = states[kind]
+			ready = _get_ready(inpath, prefix, sizes, poll_time, state['done'])
+
+			for j in range(0, len(ready), SLAB_IMAGES):
+				batch = ready[j:j + SLAB_IMAGES]
+				try:
+					decoded = pool.map(read, batch)
+				except Exception as e:
+					# Try again at the next poll:
+					log = open(logfilename,"a")
+					log.write(os.linesep + "\tWarning: %s" % (str(e)))
+					log.close()
+					break
+
+				for filename, (im, t) in zip(batch, decoded):
+					state['stats'].update(im)
+					state['images'].append(im)
+					state['rows'].append((numpy.string_(os.path.basename(filename)), 
+						numpy.string_(datetime.datetime.fromtimestamp(t).strftime('%Y-%m-%d %H:%M:%S.%f')[:-3])))
+				state['done'] += len(batch)
+				nr_new += len(batch)
+				_append(state, provenance_dset)
+
+		# Publish the progress:
+		if (nr_new > 0):
+			t_last = time.time()
+			log = open(logfilename,"a")
+			log.write(os.linesep + "\t" + ", ".join(["%s: %d available" % (kind, tdf.get_nr_projs(states[kind]['dset']))
+				for kind, prefix, name, access, nr in kinds]) + ".")
+			log.close()
+		elif (time.time() - t_last >= timeout):
+			break
+
+		# Files still being written are checked again at the next poll:
+		time.sleep(poll_time)
+
+	# Write the images still buffered:
+	for kind, prefix, name, access, nr in kinds:
+		_append(states[kind], provenance_dset, True)
+	pool.close()
+	f.close()
+
+	# Store what cannot be created in SWMR mode:
+	f = getHDF5(outfile, 'a')
+	for kind, prefix, name, access, nr in kinds:
+		if (states[kind]['done'] == 0):
+			del f[name]
+		else:
+			stats.write_stats(f[name], states[kind]['stats'])
+
+	if (os.path.isfile(inpath + 'logfile.xml')):
+		with open (inpath + 'logfile.xml', "r") as file:
+			xml_command = file.read()
+		tdf.parse_metadata(f, xml_command)
+	f.close()
+
+	log = open(logfilename,"a")
+	log.write(os.linesep + "\t--------------")
+	log.write(os.linesep + "\tNo new files for %0.1f sec: conversion completed." % (timeout))
+	log.close()
+
+if __name__ == "__main__":
+	main(argv[1:])
@@ -42,6 +42,7 @@ from h5py import File as getHDF5
 from stp_core.utils.caching import cache2plan, plan2cache
 from stp_core.preprocess.extract_flatdark import extract_flatdark
 import stp_core.io.tdf as tdf
+import stp_core.io.h5cache as h5cache
 
 
 def main(argv):
@@ -79,11 +80,11 @@ def main(argv):
 
 	
 	# Open the HDF5 file:
-	f_in = getHDF5(infile, 'r')
+	f_in = h5cache.open_file(infile, 'tomo')
 	if "/tomo" in f_in:
-		dset = f_in['tomo']
+		dset = tdf.TDFDataset(f_in['tomo'])
 	else: 
-		dset = f_in['exchange/data']
+		dset = tdf.TDFDataset(f_in['exchange/data'])
 	num_proj = tdf.get_nr_projs(dset)
 	num_sinos = tdf.get_nr_sinos(dset)
 	
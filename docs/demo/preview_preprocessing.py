@@ -34,14 +34,16 @@ from multiprocessing import Process, Lock
 
 # pystp-specific:
 from stp_core.preprocess.extfov_correction import extfov_correction
-from stp_core.preprocess.flat_fielding import flat_fielding
+from stp_core.preprocess.flat_fielding import flat_fielding, FlatFieldPlan
+from stp_core.preprocess.defect_map import find_defects
 from stp_core.preprocess.dynamic_flatfielding import dff_prepare_plan, dynamic_flat_fielding
 from stp_core.preprocess.ring_correction import ring_correction
-from stp_core.preprocess.extract_flatdark import extract_flatdark, _medianize
+from stp_core.preprocess.extract_flatdark import extract_flatdark, _medianize, REDUCE_METHODS
 
 from h5py import File as getHDF5
 from stp_core.utils.caching import cache2plan, plan2cache
 import stp_core.io.tdf as tdf
+import stp_core.io.h5cache as h5cache
 
 def main(argv):          
 	"""To do...
@@ -88,15 +90,25 @@ def main(argv):
 	if not tmppath.endswith(sep): tmppath += sep		
 	logfilename = argv[14]		
 
+	# Reduction of the flat/dark images (optional: 'mean', 'median' or 'sigmaclip'):
+	reduce_method = argv[15] if (len(argv) > 15) else 'mean'
+
+	# Correction of the defective pixels found from the flat/dark images (optional):
+	defect_map = True if (len(argv) > 16) and (argv[16] == "True") else False
+	if reduce_method not in REDUCE_METHODS:
+		log = open(logfilename,"a")
+		log.write(linesep + "\tError: reduction method '%s' not supported. Process will end." % (reduce_method))	
+		log.close()			
+		exit()		
 	
 	# Open the HDF5 file:	
-	f_in = getHDF5(infile, 'r')
+	f_in = h5cache.open_file(infile, 'sino')
 	
 	try:
 		if "/tomo" in f_in:
-			dset = f_in['tomo']		
+			dset = tdf.TDFDataset(f_in['tomo'])		
 		else: 
-			dset = f_in['exchange/data']		
+			dset = tdf.TDFDataset(f_in['exchange/data'])		
 	
 	except:
 		log = open(logfilename,"a")
@@ -119,19 +131,26 @@ def main(argv):
 	skipdark = False
 	if not dynamic_ff:
 		try:
-			corrplan = cache2plan(infile, tmppath)
+			corrplan = cache2plan(infile, tmppath, reduce_method)
 		except Exception as e:
 			#print "Error(s) when reading from cache"
-			corrplan = extract_flatdark(f_in, flat_end, logfilename)
+			corrplan = extract_flatdark(f_in, flat_end, logfilename, reduce_method)
 			if (isscalar(corrplan['im_flat']) and isscalar(corrplan['im_flat_after']) ):
 				skipflat = True
 			else:
-				plan2cache(corrplan, infile, tmppath)					
+				plan2cache(corrplan, infile, tmppath, reduce_method)					
+
+		# Compile the flat fielding plan once (for the previewed sinogram only) with the 
+		# defective pixels of the detector (if required):
+		if not skipflat:
+			defects = find_defects(corrplan) if defect_map else None
+			corrplan = FlatFieldPlan(corrplan, flat_end, half_half, half_half_line, norm_sx, norm_dx, 
+				slice(idx, idx + 1), defects)
 	else:
 		# Dynamic flat fielding:
 		if "/tomo" in f_in:				
 			if "/flat" in f_in:
-				flat_dset = f_in['flat']
+				flat_dset = tdf.TDFDataset(f_in['flat'])
 				if "/dark" in f_in:
 					im_dark = _medianize(f_in['dark'])
 				else:										
@@ -140,7 +159,7 @@ def main(argv):
 				skipflat = True # Nothing to do in this case			
 		else: 
 			if "/exchange/data_white" in f_in:
-				flat_dset = f_in['/exchange/data_white']
+				flat_dset = tdf.TDFDataset(f_in['/exchange/data_white'])
 				if "/exchange/data_dark" in f_in:
 					im_dark = _medianize(f_in['/exchange/data_dark'])
 				else:					
@@ -166,7 +185,7 @@ def main(argv):
 						
 	im = extfov_correction(im, ext_fov, ext_fov_rot_right, ext_fov_overlap)
 	if not skipflat and not dynamic_ff:
-		im = ring_correction (im, ringrem, flat_end, corrplan['skip_flat_after'], half_half, half_half_line, ext_fov)		
+		im = ring_correction (im, ringrem, flat_end, corrplan.skip_flat_after, half_half, half_half_line, ext_fov)		
 	else:
 		im = ring_correction (im, ringrem, False, False, half_half, half_half_line, ext_fov)						
 
@@ -36,10 +36,11 @@ from multiprocessing import Process, Array
 
 # pystp-specific:
 from stp_core.preprocess.extfov_correction import extfov_correction
-from stp_core.preprocess.flat_fielding import flat_fielding
+from stp_core.preprocess.flat_fielding import flat_fielding, FlatFieldPlan
+from stp_core.preprocess.defect_map import find_defects
 from stp_core.preprocess.dynamic_flatfielding import dff_prepare_plan, dynamic_flat_fielding
 from stp_core.preprocess.ring_correction import ring_correction
-from stp_core.preprocess.extract_flatdark import extract_flatdark, _medianize
+from stp_core.preprocess.extract_flatdark import extract_flatdark, _medianize, REDUCE_METHODS
 
 from stp_core.phaseretrieval.tiehom import tiehom, tiehom_plan
 from stp_core.phaseretrieval.phrt   import phrt, phrt_plan
@@ -57,6 +58,9 @@ from stp_core.utils.caching import cache2plan, plan2cache
 from tifffile import imread, imsave
 from h5py import File as getHDF5
 import stp_core.io.tdf as tdf
+import stp_core.io.h5cache as h5cache
+import stp_core.io.stats as stats
+import stp_core.io.pyramid as pyramid
 
 
 def reconstruct(im, angles, offset, logtransform, recpar, circle, scale, pad, method, 
@@ -127,8 +131,12 @@ def reconstruct(im, angles, offset, logtransform, recpar, circle, scale, pad, me
 		#print numpy.amax(im_f[:])
 		#im_f = (im_f - dset_min) / (dset_max - dset_min)
 		
-		# Cheating the whole process:
-		im = (im - numpy.amin(im[:])) / (numpy.amax(im[:]) - numpy.amin(im[:]))
+		if (dset_max > dset_min):
+			# Limits of the whole dataset (from the stored histogram):
+			im = (im - dset_min) / (dset_max - dset_min)
+		else:
+			# Cheating the whole process:
+			im = (im - numpy.amin(im[:])) / (numpy.amax(im[:]) - numpy.amin(im[:]))
 			
 	# Apply log transform:
 	if (logtransform == True):						
@@ -184,15 +192,47 @@ def reconstruct(im, angles, offset, logtransform, recpar, circle, scale, pad, me
 #		fname = 'C:\\Temp\\StupidFolder\\proj_' + str(ct).zfill(4) + '.tif'
 #		imsave(fname, a.astype(float32))
 		
+def _get_dset(f_in, downsc_factor, downsc_mode):
+	"""Get the dataset with the projections and its level (1 for full resolution): when 
+	pixels are averaged the coarsest level of the pyramid compatible with the factor is 
+	read (if the pyramid has been built).
+
+	"""
+	if (downsc_mode == 'mean'):
+		f_in = pyramid.open_level(f_in, downsc_factor)
+	else:
+		f_in = pyramid.PyramidLevel(f_in, 1)
+	if "/tomo" in f_in:
+		dset = tdf.TDFDataset(f_in['tomo'])
+	else: 
+		dset = tdf.TDFDataset(f_in['exchange/data'])
+
+	return (dset, f_in.level)
+
+def _read_sino(dset, sino_idx, proj_sel, downsc_factor, downsc_mode, level=1):
+	"""Read the specified sinogram (index at full resolution) either decimated or binned 
+	according to the downscaling settings. A binned level of the dataset is binned by the 
+	remaining factor only.
+
+	"""
+	if downsc_mode is None:
+		return tdf.read_sino(dset, sino_idx, proj_sel, slice(None, None, downsc_factor))
+	else:
+		return tdf.read_sino_binned(dset, sino_idx // downsc_factor, downsc_factor // level, downsc_mode, proj_sel)
+
 def process(sino_idx, num_sinos, infile, outfile, preprocessing_required, corr_plan, skipflat, norm_sx, norm_dx, flat_end, half_half, 
 			half_half_line, ext_fov, ext_fov_rot_right, ext_fov_overlap, ringrem, phaseretrieval_required, phrtmethod, phrt_param1,
 			phrt_param2, energy, distance, pixsize, phrtpad, approx_win, angles, angles_projfrom, angles_projto,
 			offset, logtransform, recpar, circle, scale, pad, method, rolling, roll_shift,
-			zerone_mode, dset_min, dset_max, decim_factor, downsc_factor, corr_offset, postprocess_required, convert_opt, 
-			crop_opt, dynamic_ff, EFF, filtEFF, im_dark, nr_threads, logfilename):
+			zerone_mode, dset_min, dset_max, decim_factor, downsc_factor, downsc_mode, corr_offset, postprocess_required, 
+			convert_opt, crop_opt, dynamic_ff, EFF, filtEFF, im_dark, nr_threads, logfilename):
 	"""To do...
 
 	"""
+	# Projection removal, decimation and downscaling (or binning) are performed
+	# while reading so that only the required part of each sinogram is read:
+	proj_sel = slice(angles_projfrom, angles_projto, decim_factor)
+
 	# Perform reconstruction (on-the-fly preprocessing and phase retrieval, if
 	# required):
 	if (phaseretrieval_required):
@@ -205,17 +245,14 @@ def process(sino_idx, num_sinos, infile, outfile, preprocessing_required, corr_p
 		#		
 
 		# Open the TDF file and get the dataset:
-		f_in = getHDF5(infile, 'r')
-		if "/tomo" in f_in:
-			dset = f_in['tomo']
-		else: 
-			dset = f_in['exchange/data']
+		f_in = h5cache.open_file(infile, 'sino')
+		dset, level = _get_dset(f_in, downsc_factor, downsc_mode)
 		
 		# Downscaling and decimation factors considered when determining the
 		# approximation window:
 		zrange = arange(sino_idx - approx_win * downsc_factor / 2, sino_idx + approx_win * downsc_factor / 2, downsc_factor)
 		zrange = zrange[(zrange >= 0)]
-		zrange = zrange[(zrange < num_sinos)]
+		zrange = zrange[(zrange < (num_sinos if (downsc_mode is None) else (num_sinos // downsc_factor) * downsc_factor))]
 		approx_win = zrange.shape[0]
 		
 		# Approximation window cannot be odd:
@@ -224,13 +261,7 @@ def process(sino_idx, num_sinos, infile, outfile, preprocessing_required, corr_p
 			zrange = zrange[0:approx_win]
 		
 		# Read one sinogram to get the proper dimensions:
-		test_im = tdf.read_sino(dset, zrange[0]).astype(float32)	
-
-		# Apply projection removal (if required):
-		test_im = test_im[angles_projfrom:angles_projto, :]
-
-		# Apply decimation and downscaling (if required):
-		test_im = test_im[::decim_factor, ::downsc_factor]
+		test_im = _read_sino(dset, zrange[0], proj_sel, downsc_factor, downsc_mode, level).astype(float32)	
 
 		# Perform the pre-processing of the first sinogram to get the right
 		# dimension:
@@ -244,7 +275,7 @@ def process(sino_idx, num_sinos, infile, outfile, preprocessing_required, corr_p
 											half_half_line / decim_factor, norm_sx, norm_dx).astype(float32)
 			test_im = extfov_correction(test_im, ext_fov, ext_fov_rot_right, ext_fov_overlap / downsc_factor).astype(float32)			
 			if not skipflat and not dynamic_ff:
-				test_im = ring_correction(test_im, ringrem, flat_end, corr_plan['skip_flat_after'], half_half, 
+				test_im = ring_correction(test_im, ringrem, flat_end, corr_plan.skip_flat_after, half_half, 
 											half_half_line / decim_factor, ext_fov).astype(float32)	
 			else:
 				test_im = ring_correction(test_im, ringrem, False, False, half_half, 
@@ -258,13 +289,7 @@ def process(sino_idx, num_sinos, infile, outfile, preprocessing_required, corr_p
 		for ct in range(1, approx_win):
 
 			# Read the sinogram:
-			test_im = tdf.read_sino(dset, zrange[ct]).astype(float32)
-
-			# Apply projection removal (if required):
-			test_im = test_im[angles_projfrom:angles_projto, :]
-
-			# Apply decimation and downscaling (if required):
-			test_im = test_im[::decim_factor, ::downsc_factor]
+			test_im = _read_sino(dset, zrange[ct], proj_sel, downsc_factor, downsc_mode, level).astype(float32)
 			
 			# Perform the pre-processing for each sinogram of the bunch:
 			if (preprocessing_required):
@@ -277,7 +302,7 @@ def process(sino_idx, num_sinos, infile, outfile, preprocessing_required, corr_p
 											half_half_line / decim_factor, norm_sx, norm_dx).astype(float32)	
 				test_im = extfov_correction(test_im, ext_fov, ext_fov_rot_right, ext_fov_overlap / downsc_factor).astype(float32)
 				if not skipflat and not dynamic_ff:
-					test_im = ring_correction(test_im, ringrem, flat_end, corr_plan['skip_flat_after'], half_half, 
+					test_im = ring_correction(test_im, ringrem, flat_end, corr_plan.skip_flat_after, half_half, 
 											half_half_line / decim_factor, ext_fov).astype(float32)	
 				else:
 					test_im = ring_correction(test_im, ringrem, False, False, half_half, 
@@ -317,19 +342,10 @@ def process(sino_idx, num_sinos, infile, outfile, preprocessing_required, corr_p
 	else:
 
 		# Read only one sinogram:
-		f_in = getHDF5(infile, 'r')
-		if "/tomo" in f_in:
-			dset = f_in['tomo']
-		else: 
-			dset = f_in['exchange/data']
-		im = tdf.read_sino(dset,sino_idx).astype(float32)		
+		f_in = h5cache.open_file(infile, 'sino')
+		dset, level = _get_dset(f_in, downsc_factor, downsc_mode)
+		im = _read_sino(dset, sino_idx, proj_sel, downsc_factor, downsc_mode, level).astype(float32)		
 		f_in.close()
-
-		# Apply projection removal (if required):
-		im = im[angles_projfrom:angles_projto, :]
-
-		# Apply decimation and downscaling (if required):
-		im = im[::decim_factor,::downsc_factor]
 		sino_idx = sino_idx / downsc_factor	
 			
 		# Perform the preprocessing of the sinogram (if required):
@@ -343,7 +359,7 @@ def process(sino_idx, num_sinos, infile, outfile, preprocessing_required, corr_p
 								norm_sx, norm_dx).astype(float32)		
 			im = extfov_correction(im, ext_fov, ext_fov_rot_right, ext_fov_overlap)
 			if not skipflat and not dynamic_ff:
-				im = ring_correction(im, ringrem, flat_end, corr_plan['skip_flat_after'], half_half, 
+				im = ring_correction(im, ringrem, flat_end, corr_plan.skip_flat_after, half_half, 
 								half_half_line / decim_factor, ext_fov)
 			else:
 				im = ring_correction(im, ringrem, False, False, half_half, 
@@ -451,7 +467,7 @@ def main(argv):
 	reconmethod = argv[23]	
 	
 	decim_factor = int(argv[24])
-	downsc_factor = int(argv[25])
+	downsc_factor, downsc_mode = tdf.parse_downsc(argv[25]) # e.g. "2" (decimation) or "2:mean" (binning)
 	
 	# Parameters for postprocessing:
 	postprocess_required = True if argv[26] == "True" else False
@@ -483,35 +499,48 @@ def main(argv):
 	if not tmppath.endswith(sep): tmppath += sep
 		
 	logfilename = argv[46]		
+
+	# Reduction of the flat/dark images (optional: 'mean', 'median' or 'sigmaclip'):
+	reduce_method = argv[47] if (len(argv) > 47) else 'mean'
+
+	# Correction of the defective pixels found from the flat/dark images (optional):
+	defect_map = True if (len(argv) > 48) and (argv[48] == "True") else False
+	if reduce_method not in REDUCE_METHODS:
+		log = open(logfilename,"a")
+		log.write(linesep + "\tError: reduction method '%s' not supported. Process will end." % (reduce_method))	
+		log.close()			
+		exit()		
 			
 	# Open the HDF5 file:
-	f_in = getHDF5(infile, 'r')
+	f_in = h5cache.open_file(infile, 'sino')
 	if "/tomo" in f_in:
-		dset = f_in['tomo']	
+		dset = tdf.TDFDataset(f_in['tomo'])	
 	else: 
-		dset = f_in['exchange/data']
+		dset = tdf.TDFDataset(f_in['exchange/data'])
 		if "/provenance/detector_output" in f_in:
 			prov_dset = f_in['provenance/detector_output']				
 	
 	dset_min = -1
 	dset_max = -1
 	if (zerone_mode):
-		if ('min' in dset.attrs):
-			dset_min = float(dset.attrs['min'])								
-		else:
+		if ('min' not in dset.attrs) or ('max' not in dset.attrs):
 			zerone_mode = False
-			
-		if ('max' in dset.attrs):
-			dset_max = float(dset.attrs['max'])				
 		else:
-			zerone_mode = False	
+			# Use the limits of the whole dataset only if the histogram is available and the 
+			# limits describe the sinograms to reconstruct, i.e. with no preprocessing on the fly 
+			# and no sum binning (otherwise each sinogram is scaled to its own extrema):
+			dset_stats = stats.read_stats(dset)
+			if (dset_stats is not None) and (not preprocessing_required) and (downsc_mode != 'sum'):
+				dset_min, dset_max = dset_stats.get_limits()
 		
 	num_sinos = tdf.get_nr_sinos(dset) # Pay attention to the downscale factor
 	
 	if (num_sinos == 0):	
 		exit()		
 
-	# Check extrema:
+	# Check extrema (the last sinograms cannot be binned if they do not fill a whole block):
+	if (downsc_mode is not None):
+		num_sinos = (num_sinos // downsc_factor) * downsc_factor
 	if (sino_idx >= num_sinos):
 		sino_idx = num_sinos - 1
 	
@@ -524,40 +553,61 @@ def main(argv):
 	filtEFF = 0
 	if (preprocessing_required):
 		if not dynamic_ff:
+			# Flat and dark images are read from the same level of the projections (the
+			# plan is cached only at full resolution):
+			if (downsc_mode == 'mean'):
+				f_plan = pyramid.open_level(f_in, downsc_factor)
+			else:
+				f_plan = pyramid.PyramidLevel(f_in, 1)
+			plan_factor = downsc_factor
+
 			# Load flat fielding plan either from cache (if required) or from TDF file
 			# and cache it for faster re-use:
 			if (preprocessingplan_fromcache):
 				try:
-					corrplan = cache2plan(infile, tmppath)
+					corrplan = cache2plan(infile, tmppath, reduce_method)
 				except Exception as e:
 					#print "Error(s) when reading from cache"
-					corrplan = extract_flatdark(f_in, flat_end, logfilename)
+					corrplan = extract_flatdark(f_plan, flat_end, logfilename, reduce_method)
+					plan_factor = downsc_factor // f_plan.level
 					if (isscalar(corrplan['im_flat']) and isscalar(corrplan['im_flat_after'])):
 						skipflat = True
-					else:
-						plan2cache(corrplan, infile, tmppath)		
+					elif (f_plan.level == 1):
+						plan2cache(corrplan, infile, tmppath, reduce_method)		
 			else:			
-				corrplan = extract_flatdark(f_in, flat_end, logfilename)		
+				corrplan = extract_flatdark(f_plan, flat_end, logfilename, reduce_method)		
+				plan_factor = downsc_factor // f_plan.level
 				if (isscalar(corrplan['im_flat']) and isscalar(corrplan['im_flat_after'])):
 					skipflat = True
-				else:
-					plan2cache(corrplan, infile, tmppath)	
+				elif (f_plan.level == 1):
+					plan2cache(corrplan, infile, tmppath, reduce_method)	
 
 			# Dowscale flat and dark images if necessary:
 			if isinstance(corrplan['im_flat'], ndarray):
-				corrplan['im_flat'] = corrplan['im_flat'][::downsc_factor,::downsc_factor]		
+				corrplan['im_flat'] = tdf.downscale_image(corrplan['im_flat'], plan_factor, downsc_mode)		
 			if isinstance(corrplan['im_dark'], ndarray):
-				corrplan['im_dark'] = corrplan['im_dark'][::downsc_factor,::downsc_factor]	
+				corrplan['im_dark'] = tdf.downscale_image(corrplan['im_dark'], plan_factor, downsc_mode)	
 			if isinstance(corrplan['im_flat_after'], ndarray):
-				corrplan['im_flat_after'] = corrplan['im_flat_after'][::downsc_factor,::downsc_factor]	
+				corrplan['im_flat_after'] = tdf.downscale_image(corrplan['im_flat_after'], plan_factor, downsc_mode)	
 			if isinstance(corrplan['im_dark_after'], ndarray):
-				corrplan['im_dark_after'] = corrplan['im_dark_after'][::downsc_factor,::downsc_factor]			
+				corrplan['im_dark_after'] = tdf.downscale_image(corrplan['im_dark_after'], plan_factor, downsc_mode)			
+
+			# Compile the flat fielding plan once for all the sinograms (with the defective 
+			# pixels of the detector, if required):
+			if not skipflat:
+				defects = find_defects(corrplan) if defect_map else None
+				if defects is not None:
+					log = open(logfilename,"a")
+					log.write(linesep + "\tDefective pixels found: %d." % len(defects))
+					log.close()
+				corrplan = FlatFieldPlan(corrplan, flat_end, half_half, half_half_line // decim_factor, norm_sx, 
+					norm_dx, defects=defects)
 
 		else:
 			# Dynamic flat fielding:
 			if "/tomo" in f_in:				
 				if "/flat" in f_in:
-					flat_dset = f_in['flat']
+					flat_dset = tdf.TDFDataset(f_in['flat'])
 					if "/dark" in f_in:
 						im_dark = _medianize(f_in['dark'])
 					else:										
@@ -566,7 +616,7 @@ def main(argv):
 					skipflat = True # Nothing to do in this case
 			else: 
 				if "/exchange/data_white" in f_in:
-					flat_dset = f_in['/exchange/data_white']
+					flat_dset = tdf.TDFDataset(f_in['/exchange/data_white'])
 					if "/exchange/data_dark" in f_in:
 						im_dark = _medianize(f_in['/exchange/data_dark'])	
 					else:					
@@ -579,9 +629,9 @@ def main(argv):
 				EFF, filtEFF = dff_prepare_plan(flat_dset, 16, im_dark)
 
 				# Downscale images if necessary:
-				im_dark = im_dark[::downsc_factor,::downsc_factor]
-				EFF = EFF[::downsc_factor,::downsc_factor,:]	
-				filtEFF = filtEFF[::downsc_factor,::downsc_factor,:]	
+				im_dark = tdf.downscale_image(im_dark, downsc_factor, downsc_mode)
+				EFF = tdf.downscale_image(EFF, downsc_factor, downsc_mode)	
+				filtEFF = tdf.downscale_image(filtEFF, downsc_factor, downsc_mode)	
 			
 	f_in.close()			
 
@@ -593,7 +643,8 @@ def main(argv):
 				logtrsf, recpar, circle, scale, overpad, reconmethod, 
                 rolling, roll_shift,
                 zerone_mode, dset_min, dset_max, decim_factor, 
-				downsc_factor, corr_offset, postprocess_required, convert_opt, crop_opt, dynamic_ff, EFF, filtEFF, im_dark, nr_threads, logfilename)		
+				downsc_factor, downsc_mode, corr_offset, postprocess_required, convert_opt, crop_opt, dynamic_ff, EFF, filtEFF, im_dark, 
+				nr_threads, logfilename)		
 
 	# Sample:
 	# 311 C:\Temp\BrunGeorgos.tdf C:\Temp\BrunGeorgos.raw 3.1416 -31.0 shepp-logan
@@ -38,6 +38,7 @@ from tifffile import imread, imsave
 
 # pystp-specific:
 import stp_core.io.tdf as tdf
+import stp_core.io.stats as stats
 
 def main(argv):    
 	"""Computes min/max limits to be used in image degradation to 8-bit or 16-bit.
@@ -66,29 +67,28 @@ def main(argv):
 		# Get the number of files in folder:
 		files = sorted(glob(inpath + '*.tif*'))
 		num_files = len(files)			
+
+		# Nothing to do without reconstructed slices:
+		if (num_files == 0):
+			exit(1)
 	
-		# Read the median slice from disk:
-		im = imread(files[num_files/2])
-	
-		# Flat the image and sort it:
-		im_flat = im.flatten()
-		im_flat = numpy.sort(im_flat)
+		# Read the median slice from disk and compute its histogram (no sorting):
+		im = imread(files[num_files // 2])
+		im_stats = stats.RunningStats()
+		im_stats.update(im)
 	
 		# Return as minimum the value the skip 0.30% of "black" tail and 0.005% of "white" tail:
-		low_idx  = int(im_flat.shape[0] * 0.0030)
-		high_idx = int(im_flat.shape[0] * 0.9995)
-	
-		min = im_flat[low_idx]
-		max = im_flat[high_idx]
+		min, max = im_stats.get_limits(0.0030, 0.9995)
 	
 		# Print center to output file:
 		text_file = open(outfile, "w")
 		text_file.write( str(min) + ":" + str(max) )
 		text_file.close()			
 	
-	except:				
+	except Exception:				
 		
-		exit()
+		# Limits not computed (e.g. unreadable slice):
+		exit(1)
 
 if __name__ == "__main__":
 	main(argv[1:])
@@ -0,0 +1,163 @@
+﻿###########################################################################
+# (C) 2016 Elettra - Sincrotrone Trieste S.C.p.A.. All rights reserved.   #
+#                                                                         #
+#                                                                         #
+# This file is part of STP-Core, the Python core of SYRMEP Tomo Project,  #
+# a software tool for the reconstruction of experimental CT datasets.     #
+#                                                                         #
+# STP-Core is free software: you can redistribute it and/or modify it     #
+# under the terms of the GNU General Public License as published by the   #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# STP-Core is distributed in the hope that it will be useful, but WITHOUT #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License    #
+# for more details.                                                       #
+#                                                                         #
+# You should have received a copy of the GNU General Public License       #
+# along with STP-Core. If not, see <http://www.gnu.org/licenses/>.        #
+#                                                                         #
+###########################################################################
+
+import os
+import os.path
+import numpy
+import time
+
+from sys import argv, exit
+from h5py import File as getHDF5
+
+# pystp-specific:
+import stp_core.io.tdf as tdf
+import stp_core.io.h5cache as h5cache
+
+
+def _benchmark(scratchfile, det_size, fov_height, nr_proj, dtype, chunks, compr_opts, nr_reads):
+	"""Write a synthetic dataset with the specified chunk layout to a scratch file and measure
+	the throughput (in MB/s) when writing it by sinograms and when reading sinograms and
+	projections from it.
+
+	"""
+	# Synthetic sinogram with photon noise (it makes sense also for compression):
+	sino = numpy.random.poisson(1000.0, (nr_proj, det_size)).astype(dtype)
+	sino_mb = sino.nbytes / 1048576.0
+
+	# Remove a previous copy of the scratch file:
+	if os.path.exists(scratchfile):
+		os.remove(scratchfile)
+
+	# Write the whole dataset by sinograms:
+	dsetshape = tdf.get_dset_shape(det_size, fov_height, nr_proj)
+	t0 = time.time()
+	f = getHDF5(scratchfile, 'w')
+	if (compr_opts > 0):
+		dset = f.create_dataset('exchange/data', dsetshape, dtype, chunks=chunks, compression="gzip",
+			compression_opts=compr_opts, shuffle=True, fletcher32=True)
+	else:
+		dset = f.create_dataset('exchange/data', dsetshape, dtype, chunks=chunks)
+	num_sinos = tdf.get_nr_sinos(dset)
+	num_projs = tdf.get_nr_projs(dset)
+	for i in range(0, num_sinos):
+		tdf.write_sino(dset, i, sino)
+	f.close()
+	write_mbs = num_sinos * sino_mb / (time.time() - t0)
+
+	# Read a few sinograms and a few projections evenly spaced within the dataset:
+	f = h5cache.open_file(scratchfile, 'both')
+	dset = tdf.TDFDataset(f['exchange/data'])
+
+	t0 = time.time()
+	idxs = numpy.linspace(0, num_sinos - 1, min(nr_reads, num_sinos)).astype(int)
+	for i in idxs:
+		im = tdf.read_sino(dset, i)
+	sino_mbs = idxs.shape[0] * sino_mb / (time.time() - t0)
+
+	t0 = time.time()
+	idxs = numpy.linspace(0, num_projs - 1, min(nr_reads, num_projs)).astype(int)
+	for i in idxs:
+		im = tdf.read_tomo(dset, i)
+	tomo_mbs = idxs.shape[0] * (im.nbytes / 1048576.0) / (time.time() - t0)
+
+	f.close()
+	os.remove(scratchfile)
+
+	return (write_mbs, sino_mbs, tomo_mbs)
+
+
+def main(argv):
+	"""Measure the read/write throughput of a few candidate chunk layouts (the legacy one and
+	the ones suggested by tdf.get_dset_chunks for each access pattern) on a local scratch file.
+
+	Parameters
+	----------
+	argv[0] : string
+		The absolute path of the scratch file (it is created and removed for each layout). Put
+		it on the same disk of the actual data. Consider that small datasets will be read from
+		the operating system cache.
+
+	argv[1] : int
+		Width of the detector (nr of pixels).
+
+	argv[2] : int
+		Height of the FOV, i.e. the number of sinograms.
+
+	argv[3] : int
+		Number of projections.
+
+	argv[4] : string
+		Data type of the dataset (e.g. "uint16" or "float32").
+
+	argv[5] : int
+		GZIP compression factor in the range [1,9] or 0 for no compression.
+
+	argv[6] : int
+		Number of sinograms (and projections) to read for each layout.
+
+	argv[7] : string
+		The absolute path of the output log file with the measured throughputs.
+
+	Example
+	-------
+	tools_benchmark_chunks "S:\\scratch.tdf" 2048 256 1800 uint16 1 32 "R:\\Temp\\benchmark.txt"
+
+	"""
+	# Get input parameters:
+	scratchfile = argv[0]
+	det_size = int(argv[1])
+	fov_height = int(argv[2])
+	nr_proj = int(argv[3])
+	dtype = numpy.dtype(argv[4])
+	compr_opts = min(int(argv[5]), 9)
+	nr_reads = int(argv[6])
+	logfilename = argv[7]
+
+	dsetshape = tdf.get_dset_shape(det_size, fov_height, nr_proj)
+
+	# Log input parameters:
+	log = open(logfilename, "w")
+	log.write(os.linesep + "\tScratch file: %s" % (scratchfile))
+	log.write(os.linesep + "\tDataset shape: %s (%s)" % (str(dsetshape), str(dtype)))
+	if (compr_opts > 0):
+		log.write(os.linesep + "\tTDF compression factor: %d" % (compr_opts))
+	else:
+		log.write(os.linesep + "\tTDF compression: none.")
+	log.write(os.linesep + "\t--------------")
+	log.close()
+
+	# Candidate layouts:
+	layouts = [('legacy', tdf.get_dset_chunks(det_size))]
+	for access in ['sino', 'tomo', 'both']:
+		layouts.append((access, tdf.get_dset_chunks(det_size, dsetshape, dtype, compr_opts > 0, access)))
+
+	for name, chunks in layouts:
+		write_mbs, sino_mbs, tomo_mbs = _benchmark(scratchfile, det_size, fov_height, nr_proj, dtype, chunks,
+			compr_opts, nr_reads)
+
+		log = open(logfilename, "a")
+		log.write(os.linesep + "\t%s %s: write %0.1f MB/s - sino read %0.1f MB/s - tomo read %0.1f MB/s." %
+			(name, str(chunks), write_mbs, sino_mbs, tomo_mbs))
+		log.close()
+
+if __name__ == "__main__":
+	main(argv[1:])
@@ -0,0 +1,164 @@
+﻿###########################################################################
+# (C) 2016 Elettra - Sincrotrone Trieste S.C.p.A.. All rights reserved.   #
+#                                                                         #
+#                                                                         #
+# This file is part of STP-Core, the Python core of SYRMEP Tomo Project,  #
+# a software tool for the reconstruction of experimental CT datasets.     #
+#                                                                         #
+# STP-Core is free software: you can redistribute it and/or modify it     #
+# under the terms of the GNU General Public License as published by the   #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# STP-Core is distributed in the hope that it will be useful, but WITHOUT #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License    #
+# for more details.                                                       #
+#                                                                         #
+# You should have received a copy of the GNU General Public License       #
+# along with STP-Core. If not, see <http://www.gnu.org/licenses/>.        #
+#                                                                         #
+###########################################################################
+
+import os
+import os.path
+import numpy
+import time
+
+from sys import argv, exit
+from h5py import File as getHDF5
+
+# pystp-specific:
+import stp_core.io.tdf as tdf
+import stp_core.io.h5cache as h5cache
+import stp_core.io.compression as compression
+
+
+def _benchmark(scratchfile, data, compr_spec):
+	"""Write the projections to a scratch file with the specified compression setting and
+	measure the compression ratio and the throughput (in MB/s) when writing and reading
+	the projections one at a time.
+
+	"""
+	# Remove a previous copy of the scratch file:
+	if os.path.exists(scratchfile):
+		os.remove(scratchfile)
+
+	nr_proj = data.shape[0]
+	mb = data.nbytes / 1048576.0
+	dsetshape = tdf.get_dset_shape(data.shape[2], data.shape[1], nr_proj, 0)
+	compr_args = compression.get_compression_args(compr_spec)
+
+	# Write the projections (data are compressed when chunks are flushed, i.e. at last on close):
+	t0 = time.time()
+	f = getHDF5(scratchfile, 'w')
+	dset = f.create_dataset('exchange/data', dsetshape, data.dtype, chunks=tdf.get_dset_chunks(data.shape[2],
+		dsetshape, data.dtype, len(compr_args) > 0, 'tomo', 0), **compr_args)
+	tdf.set_axes_attr(dset, 0)
+	dset = tdf.TDFDataset(dset)
+	for i in range(0, nr_proj):
+		tdf.write_tomo(dset, i, data[i])
+	stored = dset.id.get_storage_size()
+	f.close()
+	write_mbs = mb / (time.time() - t0)
+
+	# Read the projections back:
+	t0 = time.time()
+	f = h5cache.open_file(scratchfile, 'tomo')
+	dset = tdf.TDFDataset(f['exchange/data'])
+	for i in range(0, nr_proj):
+		im = tdf.read_tomo(dset, i)
+	im = dset = None # Release the memory map (if any) before removing the file
+	f.close()
+	read_mbs = mb / (time.time() - t0)
+
+	os.remove(scratchfile)
+
+	return (data.nbytes / float(max(stored, 1)), write_mbs, read_mbs)
+
+
+def main(argv):
+	"""Compare the available compression codecs (see stp_core.io.compression) on actual
+	projection data: a subset of the projections of an existing TDF file is written to a
+	scratch file with each codec and the compression ratio as well as the throughput when
+	writing and reading projections are reported.
+
+	Parameters
+	----------
+	argv[0] : string
+		The absolute path of the input TDF file with the (e.g. 16-bit) projections.
+
+	argv[1] : string
+		The absolute path of the scratch file (it is created and removed for each codec). Put
+		it on the same disk of the actual data. Consider that small datasets will be read from
+		the operating system cache.
+
+	argv[2] : string
+		Comma separated list of the compression settings to compare, e.g. "0,1,lz4,zstd:3,
+		bitshuffle,blosc:zstd:5" (0 means no compression and 1-9 is the GZIP factor).
+
+	argv[3] : int
+		Number of projections (evenly spaced) to consider.
+
+	argv[4] : string
+		The absolute path of the output log file with the measured figures.
+
+	Example
+	-------
+	tools_benchmark_codecs "S:\\sample1.tdf" "S:\\scratch.tdf" "0,1,lz4,zstd:3,bitshuffle" 64 "R:\\Temp\\codecs.txt"
+
+	"""
+	# Get input parameters:
+	infile = argv[0]
+	scratchfile = argv[1]
+	specs = [s.strip() for s in argv[2].split(',') if (s.strip() != '')]
+	nr_reads = int(argv[3])
+	logfilename = argv[4]
+
+	# Log input parameters:
+	log = open(logfilename, "w")
+	log.write(os.linesep + "\tInput TDF file: %s" % (infile))
+	log.write(os.linesep + "\tScratch file: %s" % (scratchfile))
+	log.write(os.linesep + "\t--------------")
+	log.close()
+
+	if not os.path.exists(infile):
+		log = open(logfilename,"a")
+		log.write(os.linesep + "\tError: input TDF file not found. Process will end.")
+		log.close()
+		exit()
+
+	# Read a subset of the projections:
+	f_in = h5cache.open_file(infile, 'tomo')
+	if "/tomo" in f_in:
+		dset = tdf.TDFDataset(f_in['tomo'])
+	else:
+		dset = tdf.TDFDataset(f_in['exchange/data'])
+	num_proj = tdf.get_nr_projs(dset)
+	idxs = numpy.linspace(0, num_proj - 1, min(nr_reads, num_proj)).astype(int)
+	data = numpy.stack([tdf.read_tomo(dset, i) for i in idxs])
+	f_in.close()
+
+	log = open(logfilename, "a")
+	log.write(os.linesep + "\t%d projections of %dx%d pixels (%s) considered." % (data.shape[0], data.shape[2],
+		data.shape[1], str(data.dtype)))
+	log.write(os.linesep + "\t--------------")
+	log.close()
+
+	for spec in specs:
+		try:
+			if not compression.is_available(spec):
+				msg = "%s: HDF5 filter not available." % (compression.describe(spec))
+			else:
+				ratio, write_mbs, read_mbs = _benchmark(scratchfile, data, spec)
+				msg = "%s: ratio %0.2f - write %0.1f MB/s - read %0.1f MB/s." % (compression.describe(spec), ratio,
+					write_mbs, read_mbs)
+		except ValueError as e:
+			msg = "%s: %s" % (spec, str(e))
+
+		log = open(logfilename, "a")
+		log.write(os.linesep + "\t" + msg)
+		log.close()
+
+if __name__ == "__main__":
+	main(argv[1:])
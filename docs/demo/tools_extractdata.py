@@ -37,6 +37,7 @@ from numpy import float32
 
 # pystp-specific:
 import stp_core.io.tdf as tdf
+import stp_core.io.h5cache as h5cache
 
 def main(argv):    
 	"""Extract a 2D image (projection or sinogram) from the input TDF file (DataExchange HDF5) and
@@ -84,30 +85,30 @@ def main(argv):
 
 		# Open the HDF5 file:
 
-		f = getHDF5( infile, 'r' )
+		f = h5cache.open_file( infile, 'sino' if (imtype == 'sino') else 'tomo' )
 		if (imtype == 'sino'):
 			if "/tomo" in f:
-				dset = f['tomo']	
+				dset = tdf.TDFDataset(f['tomo'])	
 			else: 
-				dset = f['exchange/data']
+				dset = tdf.TDFDataset(f['exchange/data'])
 			im = tdf.read_sino( dset, index )	
 		elif (imtype == 'dark'):
 			if "/dark" in f:
-				dset = f['dark']	
+				dset = tdf.TDFDataset(f['dark'])	
 			else: 
-				dset = f['exchange/data_dark']	
+				dset = tdf.TDFDataset(f['exchange/data_dark'])	
 			im = tdf.read_tomo( dset, index )
 		elif (imtype == 'flat'):
 			if "/flat" in f:
-				dset = f['flat']	
+				dset = tdf.TDFDataset(f['flat'])	
 			else: 
-				dset = f['exchange/data_white']	
+				dset = tdf.TDFDataset(f['exchange/data_white'])	
 			im = tdf.read_tomo( dset, index )
 		else:
 			if "/tomo" in f:
-				dset = f['tomo']	
+				dset = tdf.TDFDataset(f['tomo'])	
 			else: 
-				dset = f['exchange/data']	
+				dset = tdf.TDFDataset(f['exchange/data'])	
 			im = tdf.read_tomo( dset, index )
 				
 
@@ -40,6 +40,8 @@ import time
 
 # pystp-specific:
 import stp_core.io.tdf as tdf
+import stp_core.io.h5cache as h5cache
+import stp_core.io.pyramid as pyramid
 import stp_core.utils.findcenter as findcenter
 from stp_core.utils.caching import cache2plan, plan2cache
 from stp_core.preprocess.extract_flatdark import extract_flatdark
@@ -61,6 +63,7 @@ def main(argv):
 	scale   : int
         If sub-pixel precision is interesting, use e.g. 2.0 to get a center of rotation 
 		of .5 value. Use 1.0 if sub-pixel precision is not required
+		(values lower than 1.0, e.g. 0.25, read the pyramid of the dataset, if built)
 
 	angles  : int
         Total number of angles of the input dataset	
@@ -97,22 +100,35 @@ def main(argv):
 	tmplog  = tmppath + basename(infile) + str(time.time())
 			
 	# Open the HDF5 file (take into account also older TDF versions):
-	f_in = getHDF5( infile, 'r' )
-	if "/tomo" in f_in:
-		dset = f_in['tomo']
+	f_in = h5cache.open_file( infile, 'tomo' )
+
+	# When downscaling, the coarsest level of the pyramid (if any) compatible with the 
+	# scale is read and the remaining scaling is performed in memory:
+	if (scale < 1.0):
+		f_lvl = pyramid.open_level(f_in, int(round(1.0 / scale)))
+	else:
+		f_lvl = pyramid.PyramidLevel(f_in, 1)
+	im_scale = scale * f_lvl.level
+
+	if "/tomo" in f_lvl:
+		dset = tdf.TDFDataset(f_lvl['tomo'])
 	else: 
-		dset = f_in['exchange/data']
+		dset = tdf.TDFDataset(f_lvl['exchange/data'])
 	num_proj = tdf.get_nr_projs(dset)	
 	num_sinos = tdf.get_nr_sinos(dset)	
 
-	# Get flats and darks from cache or from file:
-	try:
-		corrplan = cache2plan(infile, tmppath)
-	except Exception as e:
-		#print "Error(s) when reading from cache"
-		corrplan = extract_flatdark(f_in, True, tmplog)
+	# Get flats and darks from cache or from file (the cache is at full resolution):
+	if (f_lvl.level > 1):
+		corrplan = extract_flatdark(f_lvl, True, tmplog)
 		remove(tmplog)
-		plan2cache(corrplan, infile, tmppath)
+	else:
+		try:
+			corrplan = cache2plan(infile, tmppath)
+		except Exception as e:
+			#print "Error(s) when reading from cache"
+			corrplan = extract_flatdark(f_in, True, tmplog)
+			remove(tmplog)
+			plan2cache(corrplan, infile, tmppath)
 
 	# Get first and the 180 deg projections: 	
 	im1 = tdf.read_tomo(dset,proj_from).astype(float32)	
@@ -129,9 +145,9 @@ def main(argv):
 			+ finfo(float32).eps)).astype(float32)	
 
 	# Scale projections (if required) to get subpixel estimation:
-	if ( abs(scale - 1.0) > finfo(float32).eps ):	
-		im1 = imresize(im1, (int(round(scale*im1.shape[0])), int(round(scale*im1.shape[1]))), interp='bicubic', mode='F');	
-		im2 = imresize(im2, (int(round(scale*im2.shape[0])), int(round(scale*im2.shape[1]))), interp='bicubic', mode='F');	
+	if ( abs(im_scale - 1.0) > finfo(float32).eps ):	
+		im1 = imresize(im1, (int(round(im_scale*im1.shape[0])), int(round(im_scale*im1.shape[1]))), interp='bicubic', mode='F');	
+		im2 = imresize(im2, (int(round(im_scale*im2.shape[0])), int(round(im_scale*im2.shape[1]))), interp='bicubic', mode='F');	
 
 	# Find the center (flipping left-right im2):
 	cen = findcenter.usecorrelation(im1, im2[ :,::-1])
@@ -37,6 +37,7 @@ import time
 
 # pystp-specific:
 import stp_core.io.tdf as tdf
+import stp_core.io.h5cache as h5cache
 import stp_core.utils.findcenter as findcenter
 from stp_core.utils.caching import cache2plan, plan2cache
 from stp_core.preprocess.extract_flatdark import extract_flatdark
@@ -74,11 +75,11 @@ def main(argv):
 			
 
 	# Open the HDF5 file:
-	f_in = getHDF5( infile, 'r' )
+	f_in = h5cache.open_file( infile, 'tomo' )
 	if "/tomo" in f_in:
-		dset = f_in['tomo']
+		dset = tdf.TDFDataset(f_in['tomo'])
 	else: 
-		dset = f_in['exchange/data']
+		dset = tdf.TDFDataset(f_in['exchange/data'])
 	num_proj = tdf.get_nr_projs(dset)
 
 	
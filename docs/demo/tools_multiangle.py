@@ -56,6 +56,7 @@ from stp_core.utils.caching import cache2plan, plan2cache
 from tifffile import imread, imsave
 from h5py import File as getHDF5
 import stp_core.io.tdf as tdf
+import stp_core.io.h5cache as h5cache
 
 
 def write_log(lock, fname, logfilename):    	      
@@ -239,11 +240,11 @@ def process(sino_idx, num_sinos, infile, outpath, preprocessing_required, corr_p
 		#		
 
 		# Open the TDF file and get the dataset:
-		f_in = getHDF5(infile, 'r')
+		f_in = h5cache.open_file(infile, 'sino')
 		if "/tomo" in f_in:
-			dset = f_in['tomo']
+			dset = tdf.TDFDataset(f_in['tomo'])
 		else: 
-			dset = f_in['exchange/data']
+			dset = tdf.TDFDataset(f_in['exchange/data'])
 		
 		# Downscaling and decimation factors considered when determining the approximation window:
 		zrange = arange(sino_idx - approx_win*downsc_factor/2, sino_idx + approx_win*downsc_factor/2, downsc_factor)
@@ -317,11 +318,11 @@ def process(sino_idx, num_sinos, infile, outpath, preprocessing_required, corr_p
 	else:
 
 		# Read only one sinogram:
-		f_in = getHDF5(infile, 'r')
+		f_in = h5cache.open_file(infile, 'sino')
 		if "/tomo" in f_in:
-			dset = f_in['tomo']
+			dset = tdf.TDFDataset(f_in['tomo'])
 		else: 
-			dset = f_in['exchange/data']
+			dset = tdf.TDFDataset(f_in['exchange/data'])
 		im = tdf.read_sino(dset,sino_idx).astype(float32)		
 		f_in.close()
 
@@ -469,11 +470,11 @@ def main(argv):
 	log.close()	
 			
 	# Open the HDF5 file:
-	f_in = getHDF5(infile, 'r')
+	f_in = h5cache.open_file(infile, 'sino')
 	if "/tomo" in f_in:
-		dset = f_in['tomo']	
+		dset = tdf.TDFDataset(f_in['tomo'])	
 	else: 
-		dset = f_in['exchange/data']
+		dset = tdf.TDFDataset(f_in['exchange/data'])
 		if "/provenance/detector_output" in f_in:
 			prov_dset = f_in['provenance/detector_output']				
 	
@@ -0,0 +1,471 @@
+﻿###########################################################################
+# (C) 2016 Elettra - Sincrotrone Trieste S.C.p.A.. All rights reserved.   #
+#                                                                         #
+#                                                                         #
+# This file is part of STP-Core, the Python core of SYRMEP Tomo Project,  #
+# a software tool for the reconstruction of experimental CT datasets.     #
+#                                                                         #
+# STP-Core is free software: you can redistribute it and/or modify it     #
+# under the terms of the GNU General Public License as published by the   #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# STP-Core is distributed in the hope that it will be useful, but WITHOUT #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License    #
+# for more details.                                                       #
+#                                                                         #
+# You should have received a copy of the GNU General Public License       #
+# along with STP-Core. If not, see <http://www.gnu.org/licenses/>.        #
+#                                                                         #
+###########################################################################
+
+#
+# This module reads and writes the chunks of a compressed TDF (HDF5) dataset
+# without the HDF5 filter pipeline: the raw chunks are fetched with direct
+# chunk reads and the filters (gzip, shuffle and fletcher32) are reverted in
+# a pool of threads. HDF5 calls are serialized by h5py, but zlib and numpy
+# release the GIL, therefore a single process can use several cores to
+# decompress the data it reads. In the same way, the converters compress
+# whole chunks in the worker processes (see ChunkStacker) and the chunks
+# are stored as they are with direct chunk writes.
+#
+
+import numpy as np
+import zlib
+
+from itertools import product
+from math import ceil
+from struct import pack
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from os import getpid
+from h5py import h5z
+
+FILTER_DEFLATE = h5z.FILTER_DEFLATE
+FILTER_SHUFFLE = h5z.FILTER_SHUFFLE
+FILTER_FLETCHER32 = h5z.FILTER_FLETCHER32
+
+# Filters that can be reverted by this module:
+SUPPORTED_FILTERS = (FILTER_DEFLATE, FILTER_SHUFFLE, FILTER_FLETCHER32)
+
+FLETCHER_BLOCK = 4194304 # Nr of words summed at once when computing checksums
+
+_pools = {}
+
+def get_nr_threads ( nr_procs=1 ):
+	"""Get the number of decompression threads for each of the specified number of
+	processes so that the available cores are not oversubscribed.
+
+	"""
+	try:
+		nr_cores = cpu_count()
+	except NotImplementedError:
+		nr_cores = 1
+	return max(1, nr_cores // max(nr_procs, 1))
+
+def _get_pool ( nr_threads ):
+	"""Get the pool of threads of the calling process (pools are not inherited by
+	forked processes).
+
+	"""
+	key = (getpid(), nr_threads)
+	if key not in _pools:
+		_pools[key] = ThreadPool(nr_threads)
+	return _pools[key]
+
+def get_pipeline ( dataset ):
+	"""Get the filters of the dataset in the order they are applied when writing as 
+	a list of (identifier, parameters) tuples.
+
+	Parameters
+	----------
+	dataset : HDF5 dataset 
+		HDF5 dataset as returned by the h5py API.
+
+	"""
+	plist = dataset.id.get_create_plist()
+	pipeline = []
+	for i in range(0, plist.get_nfilters()):
+		filt = plist.get_filter(i)
+		pipeline.append((filt[0], tuple(filt[2])))
+	return pipeline
+
+def get_filters ( dataset ):
+	"""Get the identifiers of the filters of the dataset in the order they are 
+	applied when writing.
+
+	Parameters
+	----------
+	dataset : HDF5 dataset 
+		HDF5 dataset as returned by the h5py API.
+
+	"""
+	return [filt[0] for filt in get_pipeline(dataset)]
+
+def is_supported ( dataset ):
+	"""Check if the chunks of the dataset can be read (and decompressed) by this 
+	module, i.e. if the dataset is chunked, compressed with gzip and all its 
+	filters are supported.
+
+	"""
+	try:
+		if (dataset.chunks is None) or (dataset.dtype.fields is not None) or dataset.dtype.hasobject:
+			return False
+		filters = get_filters(dataset)
+	except Exception:
+		return False
+
+	return (FILTER_DEFLATE in filters) and all(f in SUPPORTED_FILTERS for f in filters)
+
+def fletcher32 ( data ):
+	"""Compute the Fletcher-32 checksum of the specified bytes as the HDF5 fletcher32 
+	filter does (16-bit big-endian words, the last odd byte is padded with zero).
+
+	"""
+	if (len(data) % 2):
+		data = bytes(data) + b'\0'
+	words = np.frombuffer(data, dtype='>u2').astype(np.int64)
+	n = words.shape[0]
+
+	# Word i is summed (n - i) times in the second sum (blocks avoid integer overflows):
+	sum1 = 0
+	sum2 = 0
+	for k in range(0, n, FLETCHER_BLOCK):
+		block = words[k:k + FLETCHER_BLOCK]
+		s1 = int(block.sum())
+		sum2 += (n - k) * s1 - int(np.dot(np.arange(block.shape[0], dtype=np.int64), block))
+		sum1 += s1
+
+	# HDF5 folds the sums modulo 65535 but a non-zero sum is never folded to zero:
+	if (sum1 > 0):
+		sum1 = (sum1 - 1) % 65535 + 1
+		sum2 = (sum2 - 1) % 65535 + 1
+
+	return (sum2 << 16) | sum1
+
+def _unshuffle ( data, itemsize ):
+	"""Revert the HDF5 shuffle filter (the bytes of the same order are grouped together
+	and the trailing bytes are left as they are).
+
+	"""
+	n = len(data) // itemsize
+	if (itemsize <= 1) or (n == 0):
+		return data
+	src = np.frombuffer(data, dtype=np.uint8, count=n * itemsize)
+	out = np.empty((n, itemsize), dtype=np.uint8)
+	for k in range(0, itemsize):
+		out[:,k] = src[k * n:(k + 1) * n]
+	if (n * itemsize < len(data)):
+		return out.tobytes() + bytes(data[n * itemsize:])
+	return out
+
+def _shuffle ( data, itemsize ):
+	"""Apply the HDF5 shuffle filter to the bytes of whole elements.
+
+	"""
+	n = len(data) // itemsize
+	if (itemsize <= 1) or (n == 0):
+		return data
+	src = np.frombuffer(data, dtype=np.uint8, count=n * itemsize).reshape(n, itemsize)
+	out = np.empty(n * itemsize, dtype=np.uint8)
+	for k in range(0, itemsize):
+		out[k * n:(k + 1) * n] = src[:,k]
+	return out
+
+def encode_chunk ( chunk, pipeline ):
+	"""Apply the filters of a dataset to a whole chunk so that it can be stored with a
+	direct chunk write.
+
+	Parameters
+	----------
+	chunk : array_like
+		Chunk as numpy array with the data type of the dataset. Edge chunks have to be 
+		padded to the whole chunk shape.
+	pipeline : list
+		Filters of the dataset (see get_pipeline).
+
+	Returns
+	-------
+	The raw chunk as bytes.
+
+	"""
+	chunk = np.ascontiguousarray(chunk)
+	data = chunk.reshape(-1).view(np.uint8)
+	for filt, params in pipeline:
+		if (filt == FILTER_SHUFFLE):
+			data = _shuffle(data, chunk.dtype.itemsize)
+		elif (filt == FILTER_DEFLATE):
+			data = zlib.compress(data, params[0] if (len(params) > 0) else 6)
+		elif (filt == FILTER_FLETCHER32):
+			data = bytes(data) + pack('<I', fletcher32(data))
+		else:
+			raise ValueError("Filter %d not supported." % filt)
+
+	return bytes(data)
+
+def encode_chunks ( chunks, pipeline, nr_threads=1 ):
+	"""Apply the filters of a dataset to a list of (offsets, chunk) tuples (as returned by
+	ChunkStacker.add) with the specified number of threads.
+
+	Returns
+	-------
+	A list of (offsets, raw chunk) tuples.
+
+	"""
+	def _encode ( item ):
+		return (item[0], encode_chunk(item[1], pipeline))
+
+	if (nr_threads > 1) and (len(chunks) > 1):
+		return _get_pool(nr_threads).map(_encode, chunks, 1)
+	else:
+		return [_encode(item) for item in chunks]
+
+def write_chunks ( dataset, chunks ):
+	"""Store the specified (offsets, raw chunk) tuples with direct chunk writes.
+
+	"""
+	for offsets, data in chunks:
+		dataset.id.write_direct_chunk(offsets, data)
+
+
+class ChunkStacker(object):
+	"""Collect the images written to a chunked dataset and return the chunks of a row 
+	(i.e. the chunks sharing the same position along the axis the images are stacked 
+	on) as soon as all its images have been collected, so that the chunks can be 
+	compressed by the process producing the images. Rows that are not within the range 
+	of images of the producer (e.g. shared with another process) are not collected and 
+	their images have to be written as usual.
+
+	Parameters
+	----------
+	shape : tuple
+		Shape of the dataset.
+	chunk_shape : tuple
+		Chunk shape of the dataset.
+	dtype : numpy.dtype
+		Data type of the dataset.
+	axis : int
+		Axis of the dataset (0 or 1) along which the images are stacked.
+	start : int, optional
+		Relative position of the first image added by the producer (default = 0).
+	stop : int, optional
+		Relative position of the last image (excluded) added by the producer (default = 
+		all the images of the dataset).
+	max_bytes : int, optional
+		Max size in bytes of the buffer of a row: if a row is larger no image is collected, 
+		i.e. all the images have to be written as usual (default = no limit).
+
+	Example (using h5py)
+	--------------------------
+	>>> stacker = chunks.ChunkStacker(dset.shape, dset.chunks, dset.dtype, 0)
+	>>> for i in range(0, dset.shape[0]):
+	>>>     row = stacker.add(i, im[i])
+	>>>     if row is None:
+	>>>         tdf.write_tomo(dset, i, im[i])
+	>>>     else:
+	>>>         chunks.write_chunks(dset, chunks.encode_chunks(row, chunks.get_pipeline(dset)))
+	>>> for i, im_i in stacker.flush():
+	>>>     tdf.write_tomo(dset, i, im_i)
+
+	"""
+	def __init__(self, shape, chunk_shape, dtype, axis, start=0, stop=None, max_bytes=None):
+		self.shape = tuple(shape)
+		self.chunk_shape = tuple(chunk_shape)
+		self.dtype = np.dtype(dtype)
+		self.axis = axis
+		self.start = max(start, 0)
+		self.stop = self.shape[axis] if stop is None else min(stop, self.shape[axis])
+		self._rows = {}
+
+		# Rows exceeding the memory budget are not collected:
+		if (max_bytes is not None) and (self.get_row_bytes() > max_bytes):
+			self.stop = self.start
+
+	def get_row_bytes(self):
+		"""Get the size in bytes of the buffer of a row (edge chunks included).
+
+		"""
+		shape = [int(ceil(self.shape[i] / float(self.chunk_shape[i]))) * self.chunk_shape[i] for i in range(0, 3)]
+		shape[self.axis] = self.chunk_shape[self.axis]
+
+		return int(np.prod(shape)) * self.dtype.itemsize
+
+	def _get_row_size(self, row):
+		size = self.chunk_shape[self.axis]
+		return min(size, self.shape[self.axis] - row * size)
+
+	def _get_sel(self, pos):
+		sel = [slice(0, self.shape[0]), slice(0, self.shape[1]), slice(0, self.shape[2])]
+		sel[self.axis] = pos
+		return tuple(sel)
+
+	def add(self, index, im):
+		"""Add the image at the specified relative position.
+
+		Returns
+		-------
+		None if the image is not collected (it has to be written as usual), otherwise a 
+		list of (offsets, chunk) tuples with the chunks of the completed row (an empty 
+		list if the row is not complete yet). Edge chunks are padded with zeros.
+
+		"""
+		size = self.chunk_shape[self.axis]
+		row = index // size
+		if (row * size < self.start) or (row * size + self._get_row_size(row) > self.stop):
+			return None
+
+		if row not in self._rows:
+			shape = [int(ceil(self.shape[i] / float(self.chunk_shape[i]))) * self.chunk_shape[i] for i in range(0, 3)]
+			shape[self.axis] = size
+			self._rows[row] = [np.zeros(shape, dtype=self.dtype), set()]
+		block = self._rows[row]
+
+		block[0][self._get_sel(index - row * size)] = im
+		block[1].add(index)
+		if (len(block[1]) < self._get_row_size(row)):
+			return []
+
+		# Split the completed row into chunks:
+		del self._rows[row]
+		grid = [range(0, block[0].shape[i], self.chunk_shape[i]) for i in range(0, 3)]
+		grid[self.axis] = [0]
+		out = []
+		for offsets in product(*grid):
+			sel = tuple([slice(o, o + c) for o, c in zip(offsets, self.chunk_shape)])
+			offsets = list(offsets)
+			offsets[self.axis] = row * size
+			out.append((tuple(offsets), block[0][sel]))
+
+		return out
+
+	def flush(self):
+		"""Get the images collected for the rows that are not complete (e.g. when the 
+		producer ends earlier than expected) as a list of (index, image) tuples. The 
+		images have to be written as usual.
+
+		"""
+		size = self.chunk_shape[self.axis]
+		out = []
+		for row in sorted(self._rows.keys()):
+			block = self._rows[row]
+			for index in sorted(block[1]):
+				out.append((index, block[0][self._get_sel(index - row * size)]))
+		self._rows = {}
+
+		return out
+
+
+def decode_chunk ( data, filters, filter_mask, shape, dtype ):
+	"""Revert the filters applied to a raw chunk.
+
+	Parameters
+	----------
+	data : bytes
+		Raw chunk as returned by a direct chunk read.
+	filters : list
+		Identifiers of the filters of the dataset (see get_filters).
+	filter_mask : int
+		Mask of the filters skipped when the chunk was written (bit i for filter i).
+	shape : tuple
+		Shape of the chunk.
+	dtype : numpy.dtype
+		Data type of the dataset.
+
+	Returns
+	-------
+	The chunk as numpy array.
+
+	"""
+	dtype = np.dtype(dtype)
+	for k in reversed(range(0, len(filters))):
+		if (filter_mask & (1 << k)):
+			continue
+		if (filters[k] == FILTER_FLETCHER32):
+			stored = int(np.frombuffer(data[-4:], dtype='<u4')[0])
+			data = data[:-4]
+			if (fletcher32(data) != stored):
+				raise IOError("Fletcher32 checksum mismatch in a chunk of the dataset.")
+		elif (filters[k] == FILTER_DEFLATE):
+			data = zlib.decompress(data)
+		elif (filters[k] == FILTER_SHUFFLE):
+			data = _unshuffle(data, dtype.itemsize)
+		else:
+			raise ValueError("Filter %d not supported." % filters[k])
+
+	return np.frombuffer(data, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+
+def _axis_parts ( length, chunk, sel ):
+	"""Split the selection of an axis by chunk. Each part is the tuple (offset of the 
+	chunk, slice of the output, slice within the chunk).
+
+	"""
+	start, stop, step = sel.indices(length)
+	parts = []
+	if (len(range(start, stop, step)) == 0):
+		return parts
+
+	pos = 0
+	for c in range(start // chunk, (stop - 1) // chunk + 1):
+		lo = c * chunk
+		hi = min(lo + chunk, stop)
+		first = start if (lo <= start) else start + ((lo - start + step - 1) // step) * step
+		if (first >= hi):
+			continue
+		nr = len(range(first, hi, step))
+		parts.append((lo, slice(pos, pos + nr), slice(first - lo, first - lo + (nr - 1) * step + 1, step)))
+		pos += nr
+
+	return parts
+
+def read_slab ( dataset, sel, out, nr_threads ):
+	"""Read the specified selection of a chunked and gzip-compressed dataset into the 
+	output array by decompressing the touched chunks with a pool of threads.
+
+	Parameters
+	----------
+	dataset : HDF5 dataset 
+		HDF5 dataset as returned by the h5py API (see is_supported).
+	sel : tuple
+		A slice (with positive step) for each axis of the dataset.
+	out : array_like
+		Output array with the shape of the selection (any numeric data type).
+	nr_threads : int
+		Number of decompression threads.
+
+	Example (using h5py)
+	--------------------------
+	>>> f   = getHDF5('dataset.tdf', 'r')
+	>>> out = numpy.empty((16, 1800, 2048), dtype=numpy.float32)
+	>>> chunks.read_slab(f['exchange/data'], numpy.s_[0:16,:,:], out, 4)
+
+	"""
+	shape = dataset.shape
+	chunk_shape = dataset.chunks
+	filters = get_filters(dataset)
+	dtype = dataset.dtype
+	fillvalue = dataset.fillvalue
+	dsid = dataset.id
+
+	parts = [_axis_parts(shape[i], chunk_shape[i], sel[i]) for i in range(0, len(shape))]
+
+	def _read_chunk ( chunk_parts ):
+		offsets = tuple([p[0] for p in chunk_parts])
+		dst = tuple([p[1] for p in chunk_parts])
+		src = tuple([p[2] for p in chunk_parts])
+		try:
+			filter_mask, data = dsid.read_direct_chunk(offsets)
+		except Exception:
+			# The chunk may have never been written:
+			if (dsid.get_chunk_info_by_coord(offsets).byte_offset is None):
+				out[dst] = fillvalue
+				return
+			raise
+		out[dst] = decode_chunk(data, filters, filter_mask, chunk_shape, dtype)[src]
+
+	tasks = list(product(*parts))
+	if (nr_threads > 1) and (len(tasks) > 1):
+		_get_pool(nr_threads).map(_read_chunk, tasks, 1)
+	else:
+		for task in tasks:
+			_read_chunk(task)
@@ -0,0 +1,174 @@
+﻿###########################################################################
+# (C) 2016 Elettra - Sincrotrone Trieste S.C.p.A.. All rights reserved.   #
+#                                                                         #
+#                                                                         #
+# This file is part of STP-Core, the Python core of SYRMEP Tomo Project,  #
+# a software tool for the reconstruction of experimental CT datasets.     #
+#                                                                         #
+# STP-Core is free software: you can redistribute it and/or modify it     #
+# under the terms of the GNU General Public License as published by the   #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# STP-Core is distributed in the hope that it will be useful, but WITHOUT #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License    #
+# for more details.                                                       #
+#                                                                         #
+# You should have received a copy of the GNU General Public License       #
+# along with STP-Core. If not, see <http://www.gnu.org/licenses/>.        #
+#                                                                         #
+###########################################################################
+
+#
+# This module maps the compression setting of the TDF converters to the
+# arguments of h5py's create_dataset. Besides GZIP (always available), fast
+# lossless codecs are supported as dynamically loaded HDF5 filters: LZ4,
+# Zstd, Bitshuffle (+LZ4 or +Zstd) and Blosc. The filters are registered
+# by importing the hdf5plugin package (if installed) or they are loaded by
+# HDF5 from the HDF5_PLUGIN_PATH folder. Since this module is imported by
+# stp_core.io.tdf, files written with any of these codecs are read
+# transparently.
+#
+
+import h5py
+
+try:
+	import hdf5plugin
+except ImportError:
+	hdf5plugin = None
+
+LZ4_FILTER = 32004
+BITSHUFFLE_FILTER = 32008
+BLOSC_FILTER = 32001
+ZSTD_FILTER = 32015
+
+CODECS = ['gzip', 'lz4', 'zstd', 'bitshuffle', 'blosc']
+
+_FILTERS = { 'lz4': LZ4_FILTER, 'zstd': ZSTD_FILTER, 'bitshuffle': BITSHUFFLE_FILTER, 'blosc': BLOSC_FILTER }
+_BLOSC_CODES = { 'blosclz': 0, 'lz4': 1, 'lz4hc': 2, 'snappy': 3, 'zlib': 4, 'zstd': 5 }
+_LEVELS = { 'gzip': 1, 'lz4': 0, 'zstd': 3, 'bitshuffle': 0, 'blosc': 5 }
+
+def parse_compression ( spec ):
+	"""Parse a compression setting. The setting is either an integer in the range
+	[0,9] (GZIP compression factor, 0 for no compression, as in the past) or a
+	string "codec[:inner][:level]", e.g. "lz4", "zstd:5", "bitshuffle" (with LZ4),
+	"bitshuffle:zstd:3", "blosc" (LZ4 with bitshuffle) or "blosc:zstd:5".
+
+	Parameters
+	----------
+	spec : int or string
+		The compression setting.
+
+	Return value
+	----------
+	The tuple (codec, inner, level) where codec is None for no compression.
+
+	"""
+	tokens = [t for t in str(spec).strip().lower().split(':') if (t != '')]
+	if (len(tokens) == 0) or (tokens[0] in ['none', '-']):
+		return (None, None, 0)
+
+	# Legacy setting (GZIP factor):
+	if tokens[0].isdigit():
+		level = min(int(tokens[0]), 9)
+		return (None, None, 0) if (level <= 0) else ('gzip', None, level)
+
+	codec = tokens[0]
+	if codec not in CODECS:
+		raise ValueError("Unknown compression codec: %s." % codec)
+
+	inner = None
+	level = _LEVELS[codec]
+	for t in tokens[1:]:
+		if t.isdigit():
+			level = int(t)
+		else:
+			inner = t
+
+	if (codec == 'bitshuffle'):
+		inner = 'lz4' if inner is None else inner
+		if inner not in ['lz4', 'zstd']:
+			raise ValueError("Bitshuffle supports only lz4 or zstd.")
+	elif (codec == 'blosc'):
+		inner = 'lz4' if inner is None else inner
+		if inner not in _BLOSC_CODES:
+			raise ValueError("Unknown Blosc compressor: %s." % inner)
+		level = min(level, 9)
+	elif (codec == 'gzip'):
+		level = max(min(level, 9), 1)
+
+	return (codec, inner, level)
+
+def is_available ( spec ):
+	"""Check if the HDF5 filter required by the specified compression setting is
+	available.
+
+	"""
+	codec, inner, level = parse_compression(spec)
+	if (codec is None) or (codec == 'gzip'):
+		return True
+
+	return h5py.h5z.filter_avail(_FILTERS[codec]) > 0
+
+def get_compression_args ( spec, fletcher32=True ):
+	"""Get the compression arguments of h5py's create_dataset for the specified
+	compression setting. An empty dictionary is returned for no compression.
+
+	Parameters
+	----------
+	spec : int or string
+		The compression setting (see parse_compression).
+	fletcher32 : bool, optional
+		Add the Fletcher32 checksum to each chunk (default = True).
+
+	Example (using h5py)
+	--------------------------
+	>>> args = compression.get_compression_args("zstd:3")
+	>>> dset = f.create_dataset('exchange/data', dsetshape, dtype, chunks=chunks, **args)
+
+	"""
+	codec, inner, level = parse_compression(spec)
+	if codec is None:
+		return {}
+
+	if not is_available(spec):
+		raise ValueError("The HDF5 filter for %s is not available (install hdf5plugin)." % codec)
+
+	if (codec == 'gzip'):
+		args = { 'compression': 'gzip', 'compression_opts': level, 'shuffle': True }
+	elif (codec == 'lz4'):
+		args = { 'compression': LZ4_FILTER, 'compression_opts': (0,), 'shuffle': True }
+	elif (codec == 'zstd'):
+		args = { 'compression': ZSTD_FILTER, 'compression_opts': (level,), 'shuffle': True }
+	elif (codec == 'bitshuffle'):
+		# Shuffling is performed by the filter itself (block size chosen by the filter):
+		if (inner == 'zstd'):
+			args = { 'compression': BITSHUFFLE_FILTER, 'compression_opts': (0, 3, level) }
+		else:
+			args = { 'compression': BITSHUFFLE_FILTER, 'compression_opts': (0, 2) }
+	else: # (codec == 'blosc'):
+		# Bit shuffling (2) is performed by Blosc itself:
+		args = { 'compression': BLOSC_FILTER, 'compression_opts': (0, 0, 0, 0, level, 2, _BLOSC_CODES[inner]) }
+
+	args['fletcher32'] = fletcher32
+
+	return args
+
+def describe ( spec ):
+	"""Get a human readable description of the compression setting (for the logs).
+
+	"""
+	codec, inner, level = parse_compression(spec)
+	if codec is None:
+		return "none"
+	elif (codec == 'gzip'):
+		return "gzip (factor %d)" % level
+	elif (codec == 'lz4'):
+		return "lz4"
+	elif (codec == 'zstd'):
+		return "zstd (level %d)" % level
+	elif (codec == 'bitshuffle'):
+		return "bitshuffle+%s" % inner if (inner == 'lz4') else "bitshuffle+%s (level %d)" % (inner, level)
+	else:
+		return "blosc (%s, level %d, bitshuffle)" % (inner, level)
@@ -0,0 +1,345 @@
+﻿###########################################################################
+# (C) 2016 Elettra - Sincrotrone Trieste S.C.p.A.. All rights reserved.   #
+#                                                                         #
+#                                                                         #
+# This file is part of STP-Core, the Python core of SYRMEP Tomo Project,  #
+# a software tool for the reconstruction of experimental CT datasets.     #
+#                                                                         #
+# STP-Core is free software: you can redistribute it and/or modify it     #
+# under the terms of the GNU General Public License as published by the   #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# STP-Core is distributed in the hope that it will be useful, but WITHOUT #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License    #
+# for more details.                                                       #
+#                                                                         #
+# You should have received a copy of the GNU General Public License       #
+# along with STP-Core. If not, see <http://www.gnu.org/licenses/>.        #
+#                                                                         #
+###########################################################################
+
+#
+# This module opens TDF (HDF5) files for reading with a raw-data chunk cache
+# sized according to the chunk shape of the main dataset and to the order
+# in which the dataset is going to be traversed. HDF5 does not expose the
+# usage of its chunk cache, therefore the returned file keeps track of the
+# chunks touched by each read and simulates an LRU cache with the same
+# capacity in order to report the expected hit/miss counts.
+#
+
+import h5py
+import numpy as np
+
+from collections import OrderedDict
+from math import ceil
+from os import linesep
+
+# pystp-specific:
+import stp_core.io.tdf as tdf
+
+MAX_CACHE_BYTES = 268435456 # Upper bound for the chunk cache of each dataset (per process)
+MIN_CACHE_BYTES = 1048576   # The HDF5 default
+MIN_CACHE_SLOTS = 521       # The HDF5 default
+MAX_CACHE_SLOTS = 1048573
+
+def _is_prime ( n ):
+	"""Check if the specified (odd) number is prime.
+
+	"""
+	i = 3
+	while (i * i <= n):
+		if (n % i == 0):
+			return False
+		i += 2
+	return True
+
+def _next_prime ( n ):
+	"""Get the first prime number greater than or equal to n (n > 2).
+
+	"""
+	n = int(n) | 1
+	while not _is_prime(n):
+		n += 2
+	return n
+
+def _get_main_dataset ( f ):
+	"""Get the name of the dataset with the projections (None if not found).
+
+	"""
+	if "/tomo" in f:
+		return 'tomo'
+	elif "/exchange/data" in f:
+		return 'exchange/data'
+	else:
+		return None
+
+def get_cache_params ( shape, chunks, itemsize, access='sino', max_bytes=MAX_CACHE_BYTES, order=None ):
+	"""Get the parameters of the raw-data chunk cache that avoid decompressing
+	the same chunk more than once when a dataset is traversed in the specified
+	order (one sinogram or one projection at a time).
+
+	Parameters
+	----------
+	shape : tuple
+		Shape of the dataset.
+	chunks : tuple
+		Chunk shape of the dataset (None for contiguous datasets).
+	itemsize : int
+		Size in bytes of each element of the dataset.
+	access : string, optional
+		Planned traversal order: 'sino', 'tomo' or 'both' (default = 'sino'). A 
+		ValueError is raised for any other value.
+	max_bytes : int, optional
+		Maximum size in bytes of the cache (default = MAX_CACHE_BYTES).
+	order : int, optional
+		Storage order of the dataset: 0 for theta:y:x or 1 for y:theta:x (default = 
+		tdf.DATA_ORDER).
+
+	Return value
+	----------
+	The tuple (nslots, nbytes, w0) to be used for the chunk cache.
+
+	"""
+	if access not in ('sino', 'tomo', 'both'):
+		raise ValueError("Access pattern '%s' not supported (use 'sino', 'tomo' or 'both')." % access)
+	if chunks is None:
+		return (MIN_CACHE_SLOTS, MIN_CACHE_BYTES, 0.75)
+
+	chunk_bytes = int(np.prod(chunks)) * itemsize
+	grid = [int(ceil(shape[i] / float(chunks[i]))) for i in range(len(shape))]
+	sino_axis, tomo_axis = tdf._get_axes(order)
+
+	# Number of chunks touched by one sinogram / one projection:
+	sino_chunks = grid[tomo_axis] * grid[2]
+	tomo_chunks = grid[sino_axis] * grid[2]
+
+	if (access == 'tomo'):
+		nr_chunks = tomo_chunks
+		axis = tomo_axis
+	elif (access == 'both'):
+		nr_chunks = max(sino_chunks, tomo_chunks)
+		axis = None
+	else: # (access == 'sino'):
+		nr_chunks = sino_chunks
+		axis = sino_axis
+
+	# Room for all the chunks touched by a single image (if possible):
+	nbytes = min(max(nr_chunks * chunk_bytes, MIN_CACHE_BYTES), max(max_bytes, chunk_bytes))
+	nslots = _next_prime(min(max(100 * (nbytes // chunk_bytes), MIN_CACHE_SLOTS), MAX_CACHE_SLOTS))
+
+	# If a chunk contains only one image along the traversal axis it is never read
+	# again, otherwise a pure LRU policy is the right one:
+	if axis is None:
+		w0 = 0.75
+	elif (chunks[axis] == 1):
+		w0 = 1.0
+	else:
+		w0 = 0.0
+
+	return (nslots, nbytes, w0)
+
+
+class CacheStats(object):
+	"""Hit/miss counts of the chunk cache of an open file. The counts are
+	estimated by replaying the reads on an LRU cache with the same capacity
+	of the actual HDF5 chunk cache.
+
+	"""
+	def __init__(self, nbytes):
+		self.nbytes = nbytes
+		self.hits = 0
+		self.misses = 0
+		self._caches = {}
+
+	def record(self, dataset, sel):
+		"""Account the chunks of the dataset touched by the specified selection.
+
+		"""
+		chunks = dataset.chunks
+		if chunks is None:
+			return
+
+		chunk_bytes = int(np.prod(chunks)) * dataset.dtype.itemsize
+		capacity = self.nbytes // chunk_bytes
+
+		cache = self._caches.setdefault(dataset.name, OrderedDict())
+		for key in _touched_chunks(dataset.shape, chunks, sel):
+			if key in cache:
+				self.hits += 1
+				del cache[key]
+			else:
+				self.misses += 1
+				if (len(cache) >= capacity) and (len(cache) > 0):
+					cache.popitem(last=False)
+			if (capacity > 0):
+				cache[key] = True
+
+	def hit_rate(self):
+		"""Get the percentage of chunk accesses served by the cache.
+
+		"""
+		total = self.hits + self.misses
+		return 100.0 * self.hits / total if (total > 0) else 0.0
+
+	def __str__(self):
+		return "%d hits, %d misses (%0.1f%% hit rate)" % (self.hits, self.misses, self.hit_rate())
+
+
+def _touched_chunks ( shape, chunks, sel ):
+	"""Get the coordinates (in the chunk grid) of the chunks touched by a
+	selection made of integers, slices and Ellipsis.
+
+	"""
+	if not isinstance(sel, tuple):
+		sel = (sel,)
+
+	# Expand the Ellipsis (if any) and the missing trailing axes:
+	if any(s is Ellipsis for s in sel):
+		i = [s is Ellipsis for s in sel].index(True)
+		sel = sel[:i] + (slice(None),) * (len(shape) - len(sel) + 1) + sel[i + 1:]
+	sel = sel + (slice(None),) * (len(shape) - len(sel))
+
+	ranges = []
+	for s, n, c in zip(sel, shape, chunks):
+		if isinstance(s, slice):
+			start, stop, step = s.indices(n)
+			if (step == 1):
+				idx = range(start // c, (stop - 1) // c + 1) if (stop > start) else []
+			else:
+				idx = np.unique(np.arange(start, stop, step) // c).tolist()
+		else:
+			try:
+				idx = np.unique(np.asarray(s, dtype=np.int64).ravel() % n // c).tolist()
+			except (TypeError, ValueError):
+				idx = range(0, int(ceil(n / float(c))))
+		ranges.append(idx)
+
+	keys = [()]
+	for idx in ranges:
+		keys = [k + (i,) for k in keys for i in idx]
+
+	return keys
+
+
+class CachedDataset(h5py.Dataset):
+	"""An h5py dataset that accounts the chunks touched by each read.
+
+	"""
+	def read_direct(self, dest, source_sel=None, dest_sel=None):
+		self.file_stats.record(self, Ellipsis if source_sel is None else source_sel)
+		return h5py.Dataset.read_direct(self, dest, source_sel, dest_sel)
+
+	def __getitem__(self, args, *rest, **kwds):
+		self.file_stats.record(self, args)
+		return h5py.Dataset.__getitem__(self, args, *rest, **kwds)
+
+
+class CachedFile(h5py.File):
+	"""An h5py file opened with a tuned chunk cache. The cache parameters
+	are available as cache_params and the (estimated) hit/miss counts as
+	cache_stats.
+
+	"""
+	def __getitem__(self, name):
+		obj = h5py.File.__getitem__(self, name)
+		if isinstance(obj, h5py.Dataset):
+			dset = CachedDataset(obj.id)
+			dset.file_stats = self.cache_stats
+			return dset
+		return obj
+
+
+def open_file ( filename, access='sino', dsetname=None, mode='r', max_bytes=MAX_CACHE_BYTES, swmr=None ):
+	"""Open a TDF file for reading with a raw-data chunk cache sized according
+	to the chunk shape of the specified dataset and to the planned traversal
+	order. The returned file can be used as any h5py file.
+
+	Parameters
+	----------
+	filename : string
+		Absolute path of the TDF file.
+	access : string, optional
+		Planned traversal order of the dataset: 'sino' (one sinogram at a time),
+		'tomo' (one projection at a time) or 'both' (default = 'sino').
+	dsetname : string, optional
+		Name of the dataset to tune the cache for (default: the dataset with
+		the projections, i.e. 'tomo' or 'exchange/data').
+	mode : string, optional
+		'r' (default) or 'r+'.
+	max_bytes : int, optional
+		Maximum size in bytes of the cache (default = MAX_CACHE_BYTES). Each
+		dataset of the file has its own cache.
+	swmr : bool, optional
+		True to open (read only) a file that is being written in SWMR mode (see
+		tdf.open_swmr). By default the SWMR mode is used only if the file cannot
+		be opened otherwise because it is still open for writing.
+
+	Example
+	--------------------------
+	>>> f    = h5cache.open_file('dataset.tdf', 'sino')
+	>>> dset = f['exchange/data']
+	>>> im   = tdf.read_sino(dset, 1024)
+	>>> print(f.cache_stats)
+	>>> f.close()
+
+	"""
+	# Inspect the dataset:
+	if (mode == 'r+'):
+		swmr = False
+	if swmr is None:
+		try:
+			f = h5py.File(filename, 'r')
+			swmr = False
+		except (IOError, OSError):
+			f = tdf.open_swmr(filename)
+			swmr = True
+	elif swmr:
+		f = tdf.open_swmr(filename)
+	else:
+		f = h5py.File(filename, 'r')
+	try:
+		if dsetname is None:
+			dsetname = _get_main_dataset(f)
+		if (dsetname is not None) and (dsetname in f):
+			dset = tdf.TDFDataset(f[dsetname])
+			params = get_cache_params(dset.shape, dset.chunks, dset.dtype.itemsize, access, max_bytes, 
+				dset.order)
+		else:
+			params = get_cache_params(None, None, 0, access, max_bytes)
+	finally:
+		f.close()
+
+	# Re-open the file with the tuned cache:
+	nslots, nbytes, w0 = params
+	fapl = h5py.h5p.create(h5py.h5p.FILE_ACCESS)
+	fapl.set_cache(0, nslots, nbytes, w0)
+	flags = h5py.h5f.ACC_RDWR if (mode == 'r+') else h5py.h5f.ACC_RDONLY
+	if swmr:
+		flags |= h5py.h5f.ACC_SWMR_READ
+	fid = h5py.h5f.open(filename.encode('utf-8') if not isinstance(filename, bytes) else filename,
+		flags, fapl=fapl)
+
+	f = CachedFile(fid)
+	f.cache_params = params
+	f.cache_stats = CacheStats(nbytes)
+
+	return f
+
+def log_cache_stats ( f, logfilename, lock=None ):
+	"""Append the (estimated) hit/miss counts of the chunk cache of the
+	specified file to the log file. The lock (if any) is acquired while
+	writing.
+
+	"""
+	if lock is not None:
+		lock.acquire()
+	try:
+		log = open(logfilename,"a")
+		log.write(linesep + "\tChunk cache (%d slots, %0.1f MB): %s." % (f.cache_params[0],
+			f.cache_params[1] / 1048576.0, str(f.cache_stats)))
+		log.close()
+	finally:
+		if lock is not None:
+			lock.release()
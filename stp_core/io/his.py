@@ -0,0 +1,143 @@
+﻿###########################################################################
+# (C) 2016 Elettra - Sincrotrone Trieste S.C.p.A.. All rights reserved.   #
+#                                                                         #
+#                                                                         #
+# This file is part of STP-Core, the Python core of SYRMEP Tomo Project,  #
+# a software tool for the reconstruction of experimental CT datasets.     #
+#                                                                         #
+# STP-Core is free software: you can redistribute it and/or modify it     #
+# under the terms of the GNU General Public License as published by the   #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# STP-Core is distributed in the hope that it will be useful, but WITHOUT #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License    #
+# for more details.                                                       #
+#                                                                         #
+# You should have received a copy of the GNU General Public License       #
+# along with STP-Core. If not, see <http://www.gnu.org/licenses/>.        #
+#                                                                         #
+###########################################################################
+
+#
+# This module reads the HIS files (the format of the flat panel detectors
+# used at the SYRMEP beamline) without walking them frame by frame: the file
+# header is parsed once, the position of each frame is computed and all the
+# frames are exposed as a memory-mapped structured numpy array. Any subset of
+# frames can therefore be read independently (e.g. by several processes).
+#
+# A HIS file is made of a 64 bytes header followed by a comment and by the
+# frames. All the frames after the first one are preceded by a 64 bytes
+# frame header.
+#
+
+import numpy as np
+
+from os.path import getsize
+
+HEADER_SIZE = 64        # Size in bytes of the file header (the comment follows)
+FRAME_HEADER_SIZE = 64  # Size in bytes of the header preceding each frame (but the first)
+
+HEADER_DTYPE = np.dtype([("tag", "S2"), ("comment_len", "<u2"), ("dim1", "<u2"), ("dim2", "<u2"), 
+	("dim1_offset", "<u2"), ("dim2_offset", "<u2"), ("header_type", "<u2"), ("dump", "V50")])
+
+DTYPE = np.dtype("<u2") # Data type of the pixels
+
+def read_header ( filename ):
+	"""Read the header of a HIS file.
+
+	Parameters
+	----------
+	filename : string
+		Absolute path of the HIS file.
+
+	Return value
+	----------
+	A dictionary with the size of the frames ('dim1' columns and 'dim2' rows), the 
+	offsets of the frames ('dim1_offset' and 'dim2_offset'), the 'header_type', the 
+	'comment', the position of the first frame within the file ('offset'), the size 
+	in bytes of each frame ('frame_size') and the number of complete frames in the 
+	file ('nr_frames').
+
+	"""
+	hdr = np.fromfile(filename, dtype=HEADER_DTYPE, count=1)
+	if (hdr.shape[0] == 0):
+		raise IOError("%s is not a valid HIS file." % filename)
+	hdr = hdr[0]
+
+	header = {}
+	for name in ["dim1", "dim2", "dim1_offset", "dim2_offset", "header_type"]:
+		header[name] = int(hdr[name])
+
+	# Comment (if any):
+	comment_len = int(hdr["comment_len"])
+	f = open(filename, "rb")
+	try:
+		f.seek(HEADER_SIZE)
+		header["comment"] = f.read(comment_len)
+	finally:
+		f.close()
+
+	# Position and number of the complete frames:
+	header["offset"] = HEADER_SIZE + comment_len
+	header["frame_size"] = header["dim1"] * header["dim2"] * DTYPE.itemsize
+	tot_bytes = getsize(filename) - header["offset"] - header["frame_size"]
+	if (tot_bytes < 0) or (header["frame_size"] == 0):
+		header["nr_frames"] = 0
+	else:
+		header["nr_frames"] = tot_bytes // (header["frame_size"] + FRAME_HEADER_SIZE) + 1
+
+	return header
+
+def get_frame_offsets ( header ):
+	"""Get the position in bytes of each frame within the HIS file.
+
+	Parameters
+	----------
+	header : dict
+		Header of the HIS file as returned by read_header.
+
+	Return value
+	----------
+	A numpy array with the offset of each frame.
+
+	"""
+	return header["offset"] + np.arange(0, header["nr_frames"], dtype=np.int64) * (header["frame_size"] + 
+		FRAME_HEADER_SIZE)
+
+def get_frames ( filename, header=None ):
+	"""Map all the frames of a HIS file (read only) as a structured numpy array with the 
+	fields 'header' (the 64 bytes preceding the frame, meaningless for the first frame) 
+	and 'image'. Data are read from disk only when accessed.
+
+	Parameters
+	----------
+	filename : string
+		Absolute path of the HIS file.
+	header : dict, optional
+		Header of the HIS file as returned by read_header (it is read if not specified).
+
+	Return value
+	----------
+	A numpy memory map with one element for each frame.
+
+	Example
+	--------------------------
+	>>> header = his.read_header('tomo.his')
+	>>> frames = his.get_frames('tomo.his', header)
+	>>> im     = numpy.array(frames['image'][10])	
+	>>> slab   = numpy.array(frames['image'][10:20, crop_top:header['dim2'] - crop_bottom, :])
+
+	"""
+	if header is None:
+		header = read_header(filename)
+	frame_dt = np.dtype([("header", "V%d" % FRAME_HEADER_SIZE), ("image", DTYPE, (header["dim2"], header["dim1"]))])
+
+	if (header["nr_frames"] == 0):
+		return np.zeros((0,), dtype=frame_dt)
+
+	# The first frame is not preceded by a frame header, therefore the mapping starts 
+	# within the file header (or the comment):
+	return np.memmap(filename, dtype=frame_dt, mode="r", offset=header["offset"] - FRAME_HEADER_SIZE, 
+		shape=(header["nr_frames"],))
@@ -0,0 +1,255 @@
+﻿###########################################################################
+# (C) 2016 Elettra - Sincrotrone Trieste S.C.p.A.. All rights reserved.   #
+#                                                                         #
+#                                                                         #
+# This file is part of STP-Core, the Python core of SYRMEP Tomo Project,  #
+# a software tool for the reconstruction of experimental CT datasets.     #
+#                                                                         #
+# STP-Core is free software: you can redistribute it and/or modify it     #
+# under the terms of the GNU General Public License as published by the   #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# STP-Core is distributed in the hope that it will be useful, but WITHOUT #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License    #
+# for more details.                                                       #
+#                                                                         #
+# You should have received a copy of the GNU General Public License       #
+# along with STP-Core. If not, see <http://www.gnu.org/licenses/>.        #
+#                                                                         #
+###########################################################################
+
+#
+# This module reads sinograms or projections from a TDF file on a background
+# thread while the current ones are processed. Images are read in slabs (see
+# stp_core.io.tdf.read_sinos and read_tomos) into a small pool of buffers:
+# when all the buffers are filled the thread waits for the consumer to give
+# one back, therefore the memory footprint is bounded by (depth + 1) slabs.
+# The thread ends when all the images have been read or when the iterator is
+# closed (or garbage collected), e.g. after a break in the loop.
+#
+
+from threading import Thread, Event
+
+try:
+	from queue import Queue, Empty
+except ImportError:
+	from Queue import Queue, Empty
+
+# pystp-specific:
+import stp_core.io.tdf as tdf
+
+DEPTH = 2                 # Nr of slabs read in advance
+MAX_BYTES = 67108864      # Maximum size in bytes of each slab
+
+def _reader ( read_func, dataset, slabs, step, rows, cols, free, ready, stop_event ):
+	"""Body of the background thread: read each slab into a free buffer of the pool
+	and hand it to the consumer.
+
+	"""
+	try:
+		for curr in slabs:
+
+			# Wait for a free buffer (or for the request to stop):
+			while True:
+				if stop_event.is_set():
+					return
+				try:
+					block = free.get(True, 0.1)
+					break
+				except Empty:
+					pass
+
+			# The last slab can be smaller (a new buffer is allocated):
+			if (block is not None) and (block.shape[0] != len(curr)):
+				block = None
+			block = read_func(dataset, curr[0], curr[-1] + 1, step, block, rows, cols)
+			ready.put((curr, block))
+
+	except Exception as e:
+		ready.put(e)
+
+	finally:
+		ready.put(None)
+
+def _iter_prefetch ( read_func, dataset, start, stop, step, slab_size, depth, rows=None, cols=None, whole=False ):
+	"""Generator yielding the images read by the background thread one by one (or the
+	whole slabs if required).
+
+	"""
+	indexes = list(range(start, stop, step))
+	slabs = [indexes[k:k + slab_size] for k in range(0, len(indexes), slab_size)]
+
+	# Pool of buffers (allocated by the first reads):
+	free = Queue()
+	ready = Queue()
+	for k in range(0, depth + 1):
+		free.put(None)
+
+	stop_event = Event()
+	thread = Thread(target=_reader, args=(read_func, dataset, slabs, step, rows, cols, free, ready, stop_event))
+	thread.daemon = True
+	thread.start()
+
+	try:
+		while True:
+			item = ready.get()
+			if item is None:
+				break
+			if isinstance(item, Exception):
+				raise item
+
+			curr, block = item
+			if whole:
+				yield curr, block
+			else:
+				for j in range(0, len(curr)):
+					yield curr[j], block[j,:,:]
+
+			# Give the buffer back to the pool:
+			free.put(block)
+
+	finally:
+		stop_event.set()
+		thread.join()
+
+def iter_tomos ( dataset, start, stop, step=1, depth=DEPTH, max_bytes=MAX_BYTES, rows=None, cols=None ):
+	"""Iterate over the tomographic projections in the range [start, stop) of the HDF5 
+	dataset as tdf.iter_tomos does, but the next slabs of projections are read on a 
+	background thread while the current one is processed.
+
+	Parameters
+	----------
+	dataset : HDF5 dataset 
+		HDF5 dataset as returned by the h5py API (or TDFDataset).
+	start : int
+		Relative position of the first tomographic projection within the dataset.
+	stop : int
+		Relative position of the last tomographic projection (excluded) within the dataset.
+	step : int, optional
+		Stride between two consecutive projections (default = 1).
+	depth : int, optional
+		Number of slabs read in advance (default = DEPTH).
+	max_bytes : int, optional
+		Maximum size in bytes of each slab (default = 64 MB). The buffers take at most 
+		(depth + 1) * max_bytes.
+	rows : slice, optional
+		Rows of each image to read with an optional positive stride (default = all). Only 
+		the selected data are read from disk (see tdf.read_tomo and tdf.read_sino).
+	cols : slice, optional
+		Columns of each image to read with an optional positive stride (default = all).
+
+	Returns
+	-------
+	A generator of (index, image) tuples. The image is a float32 view of a buffer of the 
+	pool and it is overwritten after the next slab is requested: copy it if it has to be 
+	kept. Call close() on the generator to stop the thread before the end of the range.
+
+	Example (using h5py)
+	--------------------------
+	>>> f    = getHDF5('dataset.tdf', 'r')
+	>>> dset = tdf.TDFDataset(f['exchange/data'])
+	>>> for i, im in prefetch.iter_tomos(dset, 0, tdf.get_nr_projs(dset)):
+	>>>     out = tiehom(im, plan)
+
+	"""
+	slab_size = tdf.get_slab_size(dataset, max_bytes, False, rows, cols)
+	return _iter_prefetch(tdf.read_tomos, dataset, start, stop, step, slab_size, max(depth, 1), rows, cols)
+
+def iter_sinos ( dataset, start, stop, step=1, depth=DEPTH, max_bytes=MAX_BYTES, rows=None, cols=None ):
+	"""Iterate over the sinograms in the range [start, stop) of the HDF5 dataset as 
+	tdf.iter_sinos does, but the next slabs of sinograms are read on a background thread 
+	while the current one is processed.
+
+	Parameters
+	----------
+	dataset : HDF5 dataset 
+		HDF5 dataset as returned by the h5py API (or TDFDataset).
+	start : int
+		Relative position of the first sinogram within the dataset.
+	stop : int
+		Relative position of the last sinogram (excluded) within the dataset.
+	step : int, optional
+		Stride between two consecutive sinograms (default = 1).
+	depth : int, optional
+		Number of slabs read in advance (default = DEPTH).
+	max_bytes : int, optional
+		Maximum size in bytes of each slab (default = 64 MB). The buffers take at most 
+		(depth + 1) * max_bytes.
+	rows : slice, optional
+		Rows of each image to read with an optional positive stride (default = all). Only 
+		the selected data are read from disk (see tdf.read_tomo and tdf.read_sino).
+	cols : slice, optional
+		Columns of each image to read with an optional positive stride (default = all).
+
+	Returns
+	-------
+	A generator of (index, image) tuples. The image is a float32 view of a buffer of the 
+	pool and it is overwritten after the next slab is requested: copy it if it has to be 
+	kept. Call close() on the generator to stop the thread before the end of the range.
+
+	"""
+	slab_size = tdf.get_slab_size(dataset, max_bytes, True, rows, cols)
+	return _iter_prefetch(tdf.read_sinos, dataset, start, stop, step, slab_size, max(depth, 1), rows, cols)
+
+def iter_sino_slabs ( dataset, start, stop, step=1, depth=DEPTH, max_bytes=MAX_BYTES, rows=None, cols=None ):
+	"""Iterate over the slabs of sinograms in the range [start, stop) of the HDF5 dataset 
+	as iter_sinos does, but each slab is yielded as a whole so that it can be processed 
+	in a single pass (e.g. with flat_fielding_slab).
+
+	Parameters
+	----------
+	dataset, start, stop, step, depth, max_bytes, rows, cols :
+		See iter_sinos.
+
+	Returns
+	-------
+	A generator of (indexes, block) tuples, where indexes is the list of the sinograms in 
+	the slab and block is a float32 array with shape (len(indexes), nr_projs, det_size). 
+	The block is a buffer of the pool and it is overwritten after the next slab is 
+	requested: copy it if it has to be kept.
+
+	Example (using h5py)
+	--------------------------
+	>>> for idx, block in prefetch.iter_sino_slabs(dset, 0, tdf.get_nr_sinos(dset)):
+	>>>     block = flat_fielding_slab(block, idx, plan, True, False, 0, 0, 0)
+
+	"""
+	slab_size = tdf.get_slab_size(dataset, max_bytes, True, rows, cols)
+	return _iter_prefetch(tdf.read_sinos, dataset, start, stop, step, slab_size, max(depth, 1), rows, cols, True)
+
+def iter_sinos_binned ( dataset, start, stop, factor, mode='mean', depth=DEPTH, max_bytes=MAX_BYTES, rows=None ):
+	"""Iterate over the binned sinograms in the range [start, stop) of the HDF5 dataset as 
+	tdf.iter_sinos_binned does (the indexes refer to the binned dataset), but the next 
+	slabs are read and binned on a background thread while the current one is processed.
+
+	Parameters
+	----------
+	dataset : HDF5 dataset 
+		HDF5 dataset as returned by the h5py API (or TDFDataset).
+	start : int
+		Relative position of the first binned sinogram.
+	stop : int
+		Relative position of the last binned sinogram (excluded).
+	factor : int
+		Binning factor (blocks of factor x factor detector pixels).
+	mode : string, optional
+		'mean' to average the pixels of each block or 'sum' to sum them (default = 'mean').
+	depth : int, optional
+		Number of slabs read in advance (default = DEPTH).
+	max_bytes : int, optional
+		Maximum size in bytes of each slab of sinograms read at full resolution 
+		(default = 64 MB).
+	rows : slice, optional
+		Rows of each sinogram (i.e. projections) to read (see tdf.read_sino).
+
+	Returns
+	-------
+	A generator of (index, image) tuples. Call close() on the generator to stop the thread 
+	before the end of the range.
+
+	"""
+	slab_size = max(1, tdf.get_slab_size(dataset, max_bytes, True, rows) // max(factor, 1))
+	return _iter_prefetch(tdf._read_sinos_binned_func(factor, mode), dataset, start, stop, 1, slab_size, 
+		max(depth, 1), rows)
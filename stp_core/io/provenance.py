@@ -0,0 +1,187 @@
+﻿###########################################################################
+# (C) 2016 Elettra - Sincrotrone Trieste S.C.p.A.. All rights reserved.   #
+#                                                                         #
+#                                                                         #
+# This file is part of STP-Core, the Python core of SYRMEP Tomo Project,  #
+# a software tool for the reconstruction of experimental CT datasets.     #
+#                                                                         #
+# STP-Core is free software: you can redistribute it and/or modify it     #
+# under the terms of the GNU General Public License as published by the   #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# STP-Core is distributed in the hope that it will be useful, but WITHOUT #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License    #
+# for more details.                                                       #
+#                                                                         #
+# You should have received a copy of the GNU General Public License       #
+# along with STP-Core. If not, see <http://www.gnu.org/licenses/>.        #
+#                                                                         #
+###########################################################################
+
+#
+# This module indexes the provenance dataset of a TDF file (the table with
+# the name of the original file and the acquisition timestamp of each flat,
+# dark and tomographic image). The table is read with a single call and the
+# filenames and timestamps are parsed with vectorized numpy operations. The
+# index is cached per file, therefore the extraction of flat and dark images
+# acquired before and after the projections parses the table only once.
+#
+
+from numpy import asarray, arange, array, char, int64, uint32, nonzero, zeros
+
+CACHE_SIZE = 8      # Max nr of indexes kept in memory
+
+_cache = {}
+
+def _as_str ( arr ):
+	"""Convert an array of byte or unicode strings (also as objects) into a unicode
+	string array.
+
+	"""
+	arr = asarray(arr)
+	if (arr.dtype.kind == 'O'):
+		if (arr.size > 0) and isinstance(arr.flat[0], bytes):
+			arr = arr.astype(bytes)
+		else:
+			arr = arr.astype(str)
+	if (arr.dtype.kind == 'S'):
+		arr = char.decode(arr, 'utf-8')
+
+	return arr
+
+def _to_str ( val ):
+	"""Convert a prefix (e.g. an attribute of the provenance dataset) to a string.
+
+	"""
+	return val.decode('utf-8') if isinstance(val, bytes) else str(val)
+
+def _parse_numbers ( names ):
+	"""Get the number coded by the last four characters of each filename without
+	extension (e.g. 'flat_0012.tif' -> 12) as int64 array.
+
+	"""
+	names = asarray(names)
+	if (names.size == 0):
+		return zeros(0, dtype=int64)
+
+	# Characters as a matrix of code points:
+	width = names.dtype.itemsize // 4
+	codes = names.astype('U%d' % width).view(uint32).reshape(names.size, width)
+
+	# Position of the extension (if any):
+	pos = char.rfind(names, '.')
+	pos[pos <= 0] = char.str_len(names)[pos <= 0]
+
+	cols = pos[:,None] - 4 + arange(4)[None,:]
+	if (cols < 0).any():
+		raise ValueError("Invalid filename in provenance dataset.")
+	digits = codes[arange(names.size)[:,None], cols].astype(int64) - ord('0')
+	if ((digits < 0) | (digits > 9)).any():
+		raise ValueError("Invalid filename in provenance dataset.")
+
+	return (digits * array([1000, 100, 10, 1])).sum(axis=1)
+
+
+class ProvenanceIndex(object):
+	"""Index of the provenance dataset: for each prefix (e.g. the one of the flat or of
+	the dark images) it returns the relative position within the images dataset of the
+	ones acquired before or after the projections (timestamps are compared with a
+	resolution of one second).
+
+	Parameters
+	----------
+	provenance_dset : HDF5 dataset
+		Provenance dataset (e.g. 'provenance/detector_output') with the 'filename' and
+		'timestamp' fields and the 'first_index' attribute.
+	tomoprefix : string
+		Prefix of the filenames of the projections.
+
+	"""
+	def __init__(self, provenance_dset, tomoprefix):
+
+		# Read the whole table at once:
+		table = provenance_dset[...]
+		self.names = _as_str(table['filename'])
+		self.first_index = int(provenance_dset.attrs['first_index'])
+		self._selected = {}
+
+		# Acquisition time in seconds:
+		stamps = char.replace(_as_str(table['timestamp']), ' ', 'T')
+		self.times = stamps.astype('datetime64[us]').astype('datetime64[s]').astype(int64)
+
+		# Time range of the projections:
+		tomo = char.startswith(self.names, _to_str(tomoprefix))
+		if tomo.any():
+			self.min_t = self.times[tomo].min()
+			self.max_t = self.times[tomo].max()
+		else:
+			self.min_t = None
+			self.max_t = None
+
+	def select(self, prefix, after=False):
+		"""Get the relative positions (in the order of the provenance dataset) of the
+		images with the specified prefix acquired before (or after) the projections.
+
+		Parameters
+		----------
+		prefix : string
+			Prefix of the filenames (e.g. the flat or the dark prefix).
+		after : bool, optional
+			True for the images acquired after the projections (default = False).
+
+		Return value
+		----------
+		The positions as int64 numpy array.
+
+		"""
+		key = (_to_str(prefix), bool(after))
+		if key not in self._selected:
+			sel = char.startswith(self.names, key[0])
+			if (self.min_t is not None):
+				if after:
+					sel &= (self.times > self.max_t)
+				else:
+					sel &= (self.times <= self.min_t)
+			rows = nonzero(sel)[0]
+			names = char.rpartition(self.names[rows], '/')[:,2] if (rows.size > 0) else self.names[rows]
+			self._selected[key] = _parse_numbers(names) - self.first_index
+
+		return self._selected[key]
+
+
+def get_index ( provenance_dset, tomoprefix=None ):
+	"""Get the index of the provenance dataset. The index is built once for each file
+	(and size of the dataset) and then taken from a cache.
+
+	Parameters
+	----------
+	provenance_dset : HDF5 dataset
+		Provenance dataset (e.g. 'provenance/detector_output').
+	tomoprefix : string, optional
+		Prefix of the filenames of the projections (default = the 'tomo_prefix'
+		attribute of the dataset).
+
+	Return value
+	----------
+	A ProvenanceIndex.
+
+	Example (using h5py)
+	--------------------------
+	>>> f     = getHDF5('dataset.tdf', 'r')
+	>>> prov  = f['provenance/detector_output']
+	>>> idx   = provenance.get_index(prov)
+	>>> flats = idx.select(prov.attrs['flat_prefix'], after=True)
+
+	"""
+	if tomoprefix is None:
+		tomoprefix = provenance_dset.attrs['tomo_prefix']
+
+	key = (provenance_dset.file.filename, provenance_dset.name, provenance_dset.shape, _to_str(tomoprefix))
+	if key not in _cache:
+		if (len(_cache) >= CACHE_SIZE):
+			_cache.clear()
+		_cache[key] = ProvenanceIndex(provenance_dset, tomoprefix)
+
+	return _cache[key]
@@ -0,0 +1,298 @@
+﻿###########################################################################
+# (C) 2016 Elettra - Sincrotrone Trieste S.C.p.A.. All rights reserved.   #
+#                                                                         #
+#                                                                         #
+# This file is part of STP-Core, the Python core of SYRMEP Tomo Project,  #
+# a software tool for the reconstruction of experimental CT datasets.     #
+#                                                                         #
+# STP-Core is free software: you can redistribute it and/or modify it     #
+# under the terms of the GNU General Public License as published by the   #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# STP-Core is distributed in the hope that it will be useful, but WITHOUT #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License    #
+# for more details.                                                       #
+#                                                                         #
+# You should have received a copy of the GNU General Public License       #
+# along with STP-Core. If not, see <http://www.gnu.org/licenses/>.        #
+#                                                                         #
+###########################################################################
+
+#
+# This module writes and reads a multi-resolution pyramid of the images of
+# a TDF file: the projections, flat and dark images are binned (blocks of
+# factor x factor detector pixels are averaged, the projections are kept)
+# and stored in the 'pyramid' group of the same file, e.g. the 4x binned
+# projections as 'pyramid/4/exchange/data'. The levels are computed in a
+# single pass over each dataset (each level is binned from the previous
+# one). Preview tools open the file through open_level that exposes the
+# coarsest level compatible with the requested binning factor with the
+# same names of the full resolution datasets, therefore they need to bin
+# in memory by the remaining factor only.
+#
+
+import h5py
+import numpy as np
+
+from os import linesep
+from time import time
+
+# pystp-specific:
+import stp_core.io.tdf as tdf
+import stp_core.io.chunks as chunks
+import stp_core.io.compression as compression
+
+GROUP = 'pyramid'       # Group of the file with the levels
+LEVELS = [2, 4, 8]      # Default binning factors
+
+# Datasets with projections, flat or dark images (the ones that get a pyramid):
+IMAGE_DSETS = ['tomo', 'flat', 'dark', 'flat_post', 'dark_post', 'flat_after', 'dark_after',
+			   'exchange/data', 'exchange/data_white', 'exchange/data_dark']
+
+def _get_name ( name, level ):
+	"""Get the name of the dataset with the specified level of the pyramid.
+
+	"""
+	return "%s/%d/%s" % (GROUP, level, name.strip('/'))
+
+def _bin_block ( block, factor, sino ):
+	"""Bin a slab of sinograms (nr_sinos, nr_projs, det_size) or of projections 
+	(nr_projs, nr_sinos, det_size) along the detector rows and columns.
+
+	"""
+	if (factor <= 1):
+		return block
+	if sino:
+		return tdf._bin_axis(tdf._bin_axis(block, 0, factor, 'mean'), 2, factor, 'mean')
+	else:
+		return tdf._bin_axis(tdf._bin_axis(block, 1, factor, 'mean'), 2, factor, 'mean')
+
+def get_levels ( f, name=None ):
+	"""Get the sorted list of the levels (binning factors) available for the specified 
+	dataset (default: the dataset with the projections).
+
+	Parameters
+	----------
+	f : h5py File
+		The TDF file.
+	name : string, optional
+		Name of the full resolution dataset (e.g. 'exchange/data_white').
+
+	"""
+	if name is None:
+		name = 'tomo' if ("/tomo" in f) else 'exchange/data'
+	if GROUP not in f:
+		return []
+
+	levels = []
+	for key in f[GROUP].keys():
+		if key.isdigit() and (_get_name(name, int(key)) in f):
+			levels.append(int(key))
+
+	return sorted(levels)
+
+def get_level ( f, factor, name=None ):
+	"""Get the coarsest level of the pyramid that can be binned in memory to the 
+	requested binning factor, i.e. the largest available level that divides it 
+	(1 for the full resolution dataset).
+
+	Parameters
+	----------
+	f : h5py File
+		The TDF file.
+	factor : int
+		Requested binning factor.
+	name : string, optional
+		Name of the full resolution dataset (default: a level available for all the
+		projections, flat and dark images of the file).
+
+	"""
+	if name is None:
+		names = [key for key in IMAGE_DSETS if (key in f) and isinstance(f[key], h5py.Dataset)]
+		levels = set(get_levels(f))
+		for key in names:
+			levels &= set(get_levels(f, key))
+	else:
+		levels = get_levels(f, name)
+
+	level = 1
+	for l in sorted(levels):
+		if (l <= factor) and (factor % l == 0):
+			level = l
+
+	return level
+
+
+class PyramidLevel(object):
+	"""A TDF file seen at a level of its pyramid: the projections, flat and dark 
+	images are the binned ones while all the other objects (e.g. provenance and 
+	metadata) are the ones of the file. It can be used wherever an h5py file is 
+	read with absolute names (e.g. extract_flatdark).
+
+	"""
+	def __init__(self, f, level):
+		self.file = f
+		self.level = level
+
+	def _map(self, name):
+		key = name.strip('/')
+		if (self.level > 1) and (key in IMAGE_DSETS):
+			return _get_name(key, self.level)
+		return name
+
+	def __contains__(self, name):
+		return self._map(name) in self.file
+
+	def __getitem__(self, name):
+		return self.file[self._map(name)]
+
+	def __getattr__(self, name):
+		return getattr(self.file, name)
+
+
+def open_level ( f, factor ):
+	"""Get a view of the file at the coarsest level of its pyramid compatible with 
+	the requested binning factor (see get_level). The remaining factor is 
+	factor // view.level.
+
+	Parameters
+	----------
+	f : h5py File
+		The TDF file.
+	factor : int
+		Requested binning factor.
+
+	Example (using h5py)
+	--------------------------
+	>>> f    = h5cache.open_file('dataset.tdf', 'sino')
+	>>> fl   = pyramid.open_level(f, 8)
+	>>> dset = tdf.TDFDataset(fl['exchange/data'])
+	>>> im   = tdf.read_sino_binned(dset, 100, 8 // fl.level)
+
+	"""
+	return PyramidLevel(f, get_level(f, factor))
+
+def build_dataset ( f, name, levels=LEVELS, max_bytes=268435456, logfilename=None ):
+	"""Write the levels of the pyramid of the specified dataset (existing levels are 
+	overwritten). The dataset is read once, in slabs along its privileged direction. 
+	The levels have the data type, the storage order and the compression (gzip if 
+	compressed) of the dataset.
+
+	Parameters
+	----------
+	f : h5py File
+		The TDF file (opened for writing).
+	name : string
+		Name of the full resolution dataset (e.g. 'exchange/data').
+	levels : list, optional
+		Binning factors (default = LEVELS).
+	max_bytes : int, optional
+		Maximum size in bytes of each slab read at full resolution (default = 256 MB).
+	logfilename : string, optional
+		Absolute path of the log file.
+
+	"""
+	src = tdf.TDFDataset(f[name])
+	order = tdf.get_order(src)
+	sino = (order == 1)
+	levels = sorted(levels)
+	compressed = (len(chunks.get_pipeline(src.dataset)) > 0)
+	rounded = np.issubdtype(src.dtype, np.integer)
+
+	# Create the datasets:
+	dsets = []
+	for level in levels:
+		dsetname = _get_name(name, level)
+		if dsetname in f:
+			del f[dsetname]
+		shape = tdf.get_dset_shape(tdf.get_det_size(src) // level, tdf.get_nr_sinos(src) // level, 
+			tdf.get_nr_projs(src), order)
+		if (min(shape) == 0):
+			break
+		if compressed:
+			dset = f.create_dataset(dsetname, shape, src.dtype, chunks=tdf.get_dset_chunks(shape[2], shape, 
+				src.dtype, True, 'both', order), **compression.get_compression_args(1))
+		else:
+			dset = f.create_dataset(dsetname, shape, src.dtype)
+		tdf.set_axes_attr(dset, order)
+		dset.attrs['factor'] = level
+		dset.attrs['mode'] = 'mean'
+		dsets.append((level, tdf.TDFDataset(dset)))
+
+	if (len(dsets) == 0):
+		return
+
+	# Slabs of sinograms have to be made of whole blocks of every level (i.e. of the least
+	# common multiple of the levels, also when a level does not divide the coarsest one):
+	t0 = time()
+	if sino:
+		length = tdf.get_nr_sinos(src)
+		multiple = 1
+		for level, dset in dsets:
+			multiple = multiple * level // tdf._gcd(multiple, level)
+		step = max(tdf.get_slab_size(src, max_bytes, True) // multiple, 1) * multiple
+	else:
+		length = tdf.get_nr_projs(src)
+		step = tdf.get_slab_size(src, max_bytes, False)
+
+	for start in range(0, length, step):
+		stop = min(start + step, length)
+		if sino:
+			block = tdf.read_sinos(src, start, stop)
+		else:
+			block = tdf.read_tomos(src, start, stop)
+
+		# Each level is binned from the previous one (if possible):
+		prev, prev_level = block, 1
+		for level, dset in dsets:
+			if (level % prev_level == 0):
+				binned = _bin_block(prev, level // prev_level, sino)
+			else:
+				binned = _bin_block(block, level, sino)
+			prev, prev_level = binned, level
+
+			out = np.rint(binned) if rounded else binned
+			if sino:
+				tdf.write_sinos(dset, start // level, out)
+			else:
+				tdf.write_tomos(dset, start, out)
+
+	if logfilename is not None:
+		log = open(logfilename,"a")
+		log.write(linesep + "\t%s: levels %s written (%0.3f sec)." % (name, 
+			", ".join(["%dx" % level for level, dset in dsets]), time() - t0))
+		log.close()
+
+def build ( filename, levels=LEVELS, max_bytes=268435456, logfilename=None ):
+	"""Write the pyramid of all the projections, flat and dark images of a TDF file
+	(a previous pyramid is removed).
+
+	Parameters
+	----------
+	filename : string
+		Absolute path of the TDF file (it is modified).
+	levels : list, optional
+		Binning factors (default = LEVELS).
+	max_bytes : int, optional
+		Maximum size in bytes of each slab read at full resolution (default = 256 MB).
+	logfilename : string, optional
+		Absolute path of the log file.
+
+	Example
+	--------------------------
+	>>> pyramid.build('S:\\dataset.tdf', [2, 4, 8])
+
+	"""
+	f = h5py.File(filename, 'a')
+	try:
+		if GROUP in f:
+			del f[GROUP]
+		for name in IMAGE_DSETS:
+			if (name in f) and isinstance(f[name], h5py.Dataset) and (len(f[name].shape) == 3):
+				build_dataset(f, name, levels, max_bytes, logfilename)
+		if GROUP in f:
+			f[GROUP].attrs['levels'] = np.array(get_levels(f), dtype=np.int32)
+	finally:
+		f.close()
@@ -0,0 +1,225 @@
+﻿###########################################################################
+# (C) 2016 Elettra - Sincrotrone Trieste S.C.p.A.. All rights reserved.   #
+#                                                                         #
+#                                                                         #
+# This file is part of STP-Core, the Python core of SYRMEP Tomo Project,  #
+# a software tool for the reconstruction of experimental CT datasets.     #
+#                                                                         #
+# STP-Core is free software: you can redistribute it and/or modify it     #
+# under the terms of the GNU General Public License as published by the   #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# STP-Core is distributed in the hope that it will be useful, but WITHOUT #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License    #
+# for more details.                                                       #
+#                                                                         #
+# You should have received a copy of the GNU General Public License       #
+# along with STP-Core. If not, see <http://www.gnu.org/licenses/>.        #
+#                                                                         #
+###########################################################################
+
+#
+# The functions of this module compute streaming statistics (min, max, mean
+# and a histogram with a fixed number of bins) of the images written to a
+# TDF dataset. Each worker updates its own RunningStats object without any
+# locking and the objects are merged only once at the end. The result is
+# stored as typed attributes of the dataset, so that the limits required by
+# e.g. the [0,1] scaling before the reconstruction or the conversion to 8-bit
+# or 16-bit can be computed without scanning the data again.
+#
+
+import numpy as np
+
+HIST_BINS = 4096    # Fixed number of bins of the histogram (even)
+
+class RunningStats(object):
+	"""Streaming min, max, mean and histogram of a set of images. The histogram
+	has a fixed number of bins and its range grows (by doubling the bin width)
+	when new values fall outside it. Non finite values are ignored.
+
+	Example
+	--------------------------
+	>>> st = stats.RunningStats()
+	>>> for im in images:
+	>>>     st.update(im)
+	>>> low, high = st.get_limits(0.003, 0.9995)
+
+	"""
+	def __init__(self, bins=HIST_BINS):
+		self.bins = bins + (bins % 2)
+		self.min = np.inf
+		self.max = -np.inf
+		self.sum = 0.0
+		self.count = 0
+		self.low = 0.0
+		self.width = 0.0
+		self.hist = np.zeros(self.bins, dtype=np.int64)
+
+	def _high(self):
+		return self.low + self.bins * self.width
+
+	def _extend(self, mn, mx):
+		"""Extend the range of the histogram to include [mn, mx]. Pairs of adjacent
+		bins are merged so that the counts are preserved exactly.
+
+		"""
+		if (self.width == 0.0):
+			# First values: a range slightly larger than [mn, mx]:
+			self.width = max(float(mx) - float(mn), max(abs(float(mn)), 1.0) * 1e-3) / (self.bins - 1)
+			self.low = float(mn) - 0.5 * self.width
+			return
+
+		half = self.bins // 2
+		while (mn < self.low) or (mx >= self._high()):
+			merged = self.hist[0::2] + self.hist[1::2]
+			self.hist[:] = 0
+			if (mn < self.low):
+				# Grow to the left:
+				self.hist[half:] = merged
+				self.low = self.low - self.bins * self.width
+			else:
+				# Grow to the right:
+				self.hist[:half] = merged
+			self.width = 2.0 * self.width
+
+	def update(self, im):
+		"""Account the values of the specified image (or block of images).
+
+		"""
+		a = np.asarray(im).ravel()
+		if (a.size == 0):
+			return
+		mn = a.min()
+		mx = a.max()
+		if not (np.isfinite(mn) and np.isfinite(mx)):
+			a = a[np.isfinite(a)]
+			if (a.size == 0):
+				return
+			mn = a.min()
+			mx = a.max()
+
+		self._extend(mn, mx)
+		h, _ = np.histogram(a, self.bins, (self.low, self._high()))
+		self.hist += h
+
+		self.min = min(self.min, float(mn))
+		self.max = max(self.max, float(mx))
+		self.sum += float(a.sum(dtype=np.float64))
+		self.count += a.size
+
+	def merge(self, other):
+		"""Merge the statistics of another RunningStats object into this one.
+
+		"""
+		if (other.count == 0):
+			return
+		self._extend(other.min, other.max)
+
+		if (other.low == self.low) and (other.width == self.width):
+			self.hist += other.hist
+		else:
+			# Re-bin the counts of the other histogram (at the bin centers):
+			centers = other.low + (np.arange(other.bins) + 0.5) * other.width
+			h, _ = np.histogram(centers, self.bins, (self.low, self._high()), weights=other.hist)
+			self.hist += np.round(h).astype(np.int64)
+
+		self.min = min(self.min, other.min)
+		self.max = max(self.max, other.max)
+		self.sum += other.sum
+		self.count += other.count
+
+	def mean(self):
+		"""Get the mean of the accounted values.
+
+		"""
+		return self.sum / self.count if (self.count > 0) else 0.0
+
+	def percentile(self, q):
+		"""Get the value below which the specified fraction q (in the range [0,1])
+		of the accounted values lie. The value is linearly interpolated within the
+		bin of the histogram.
+
+		"""
+		total = self.hist.sum()
+		if (total == 0):
+			return 0.0
+		cum = np.cumsum(self.hist)
+		target = min(max(q, 0.0), 1.0) * total
+		i = min(int(np.searchsorted(cum, target)), self.bins - 1)
+		before = cum[i - 1] if (i > 0) else 0
+		frac = (target - before) / float(self.hist[i]) if (self.hist[i] > 0) else 0.0
+		val = self.low + (i + frac) * self.width
+
+		return float(min(max(val, self.min), self.max))
+
+	def get_limits(self, low=0.0, high=1.0):
+		"""Get the values corresponding to the specified fractions of the accounted
+		values (e.g. 0.003 and 0.9995 to skip the 0.30% of "black" tail and the
+		0.05% of "white" tail). The extrema are returned by default.
+
+		"""
+		vmin = self.min if (low <= 0.0) else self.percentile(low)
+		vmax = self.max if (high >= 1.0) else self.percentile(high)
+
+		return (vmin, vmax)
+
+
+def write_stats ( dset, st ):
+	"""Store the statistics as typed attributes of the dataset: 'min', 'max' and
+	'mean' (float64), 'histogram' (int64) and 'histogram_range' (float64).
+
+	Parameters
+	----------
+	dset : h5py dataset or TDFDataset
+		The dataset described by the statistics.
+	st : RunningStats
+		The statistics of all the images of the dataset.
+
+	"""
+	if (st.count == 0):
+		return
+	dset.attrs['min'] = np.float64(st.min)
+	dset.attrs['max'] = np.float64(st.max)
+	dset.attrs['mean'] = np.float64(st.mean())
+	dset.attrs['histogram'] = st.hist
+	dset.attrs['histogram_range'] = np.array([st.low, st._high()], dtype=np.float64)
+
+def read_stats ( dset ):
+	"""Get the statistics stored as attributes of the dataset (None if the dataset
+	has no histogram, e.g. files written by previous versions).
+
+	Parameters
+	----------
+	dset : h5py dataset or TDFDataset
+		The dataset described by the statistics.
+
+	Return value
+	----------
+	A RunningStats object (or None).
+
+	Example (using h5py)
+	--------------------------
+	>>> f    = getHDF5('dataset.tdf', 'r')
+	>>> st   = stats.read_stats(f['exchange/data'])
+	>>> if st is not None:
+	>>>     low, high = st.get_limits(0.003, 0.9995)
+
+	"""
+	if ('histogram' not in dset.attrs) or ('histogram_range' not in dset.attrs):
+		return None
+
+	hist = np.asarray(dset.attrs['histogram'], dtype=np.int64)
+	rng = np.asarray(dset.attrs['histogram_range'], dtype=np.float64)
+
+	st = RunningStats(hist.shape[0])
+	st.hist = hist.copy()
+	st.low = float(rng[0])
+	st.width = (float(rng[1]) - float(rng[0])) / hist.shape[0]
+	st.count = int(hist.sum())
+	st.min = float(dset.attrs['min'])
+	st.max = float(dset.attrs['max'])
+	st.sum = float(dset.attrs['mean']) * st.count if ('mean' in dset.attrs) else 0.0
+
+	return st
@@ -26,8 +26,6 @@
 #
 
 # TO DO: 
-# - investigate the proper chunk size for performant I/O on both SSDs
-#   and spinning disks.
 # - check the newer versions of h5py (things changed in require_dataset)
 #
 
@@ -37,39 +35,122 @@ import numpy as np
 import collections
 import xml.etree.ElementTree as et
 
+from math import ceil, sqrt
 from numpy import isnan, isinf, nonzero, reshape, interp, float32, concatenate, zeros
 
+# Register the HDF5 filters of the fast compression codecs (if available) for reading:
+import stp_core.io.compression
+import stp_core.io.chunks as chunks
+
 DATA_ORDER = 1 # 0 for faster read/write projections, 1 for faster read/write sinograms, everything else for the other direction
+AXES_VERSION = '1.1' # Tag of the datasets whose axes attribute describes the storage order (the legacy converters 
+                     # always stored DATA_ORDER, also when the attribute said otherwise)
+
+CHUNK_BYTES = 1048576            # Target size of a chunk of a compressed dataset (i.e. the default HDF5 chunk cache)
+CHUNK_BYTES_UNCOMPRESSED = 4194304 # Target size of a chunk of an uncompressed dataset
+
+def _interp_rows ( rows ):
+	"""Replace NaN and Inf pixels of the specified 2D array by linear interpolation
+	along each row (in place). Only the rows containing outliers are processed.
+
+	Parameters
+	----------
+	rows : array_like
+		Floating point 2D array as numpy array.
+	
+	"""
+	dirty = nonzero(~np.isfinite(rows.sum(axis=1, dtype=np.float64)))[0]
+	if (dirty.shape[0] == 0):
+		return
+
+	# Padding for better interpolation in case of outliers close to the margins. The 
+	# zero padding of each row also prevents the interpolation across two rows:
+	im_f = zeros((dirty.shape[0], rows.shape[1] + 2), dtype=rows.dtype)
+	im_f[:,1:-1] = rows[dirty,:]
+	im_f = im_f.ravel()
+
+	# Remove NaNs and Infs:
+	val = np.isfinite(im_f)
+	x_bad, x_good = nonzero(~val)[0], nonzero(val)[0]
+	im_f[x_bad] = interp(x_bad, x_good, im_f[x_good])
+
+	rows[dirty,:] = reshape(im_f, (dirty.shape[0], rows.shape[1] + 2))[:,1:-1]
 
 def _remove_outliers ( im ):
-	"""Correct NaN pixels by inteporlation
+	"""Correct NaN and Inf pixels by interpolation along the rows of the image. 
+	Floating point images are corrected in place and returned without any copy 
+	when no outlier is found (a single pass on the data is required to check it). 
+	Integer images cannot have outliers and they are returned as they are.
 
 	Parameters
 	----------
 	im : array_like
-		Image data as numpy array. 
+		Image data as numpy array (or a stack of images with the rows along the
+		last axis). 
 	
 	"""
-	dt   = im.dtype
-	im_f = im.flatten().astype(float32)	
+	# Fast path:
+	if not np.issubdtype(im.dtype, np.floating):
+		return im
+	if np.isfinite(im.sum(dtype=np.float64)):
+		return im
 
-	# Padding for better interpolation in case of outliers close to the margins:
-	im_f = concatenate((zeros(1),im_f), axis=0)
-	im_f = concatenate((im_f,zeros(1)), axis=0)	
+	# Interpolate on the dirty rows (the reshape is a view for contiguous images):
+	rows = im.reshape(-1, im.shape[-1])
+	_interp_rows(rows)
+	if not np.may_share_memory(rows, im):
+		im[...] = reshape(rows, im.shape)
 
-	# Remove NaNs:
-	val, x = isnan(im_f), lambda z: z.nonzero()[0]
-	im_f[val] = interp(x(val), x(~val), im_f[~val])
+	# Return:
+	return im
 
-	# Remove Infs:
-	val, x = isinf(im_f), lambda z: z.nonzero()[0]
-	im_f[val] = interp(x(val), x(~val), im_f[~val])
+def _remove_outliers_view ( im ):
+	"""Same as _remove_outliers for a (read-only) view of a memory-mapped dataset: the 
+	view is returned as it is (zero-copy) unless it contains outliers, in which case a 
+	corrected copy is returned.
 
-	# Reshape:
-	im = reshape(im_f[1:-1], (im.shape[1], im.shape[0]), order='F').copy().T
+	"""
+	if np.issubdtype(im.dtype, np.floating) and not np.isfinite(im.sum(dtype=np.float64)):
+		return _remove_outliers(np.array(im))
+	return im
 
-	# Return:
-	return im.astype(dt)
+def _get_slice ( sel ):
+	"""Get the slice to use for a row or column selection (None means all).
+
+	"""
+	if sel is None:
+		return slice(None)
+	if (sel.step is not None) and (sel.step < 1):
+		raise ValueError("Only positive strides are supported by the HDF5 selections.")
+	return sel
+
+def _get_slice_len ( sel, length ):
+	"""Get the number of elements of an axis with the specified length selected by 
+	the slice (None means all).
+
+	"""
+	return len(range(*_get_slice(sel).indices(length)))
+
+def _read_image ( dataset, axis, index, rows, cols ):
+	"""Read the image at the specified index along axis 0 or 1 of the dataset with a 
+	single (strided) hyperslab selection: rows are taken along the other of the first 
+	two axes and columns along the last one.
+
+	"""
+	sel = [None, None, _get_slice(cols)]
+	sel[axis] = index
+	sel[1 - axis] = _get_slice(rows)
+	sel = tuple(sel)
+
+	mm = _get_memmap(dataset)
+	if mm is not None:
+		return _remove_outliers_view(mm[sel])
+
+	out = np.empty((_get_slice_len(sel[1 - axis], dataset.shape[1 - axis]), 
+		_get_slice_len(sel[2], dataset.shape[2])), dtype=dataset.dtype)
+	if (out.size > 0):
+		dataset.read_direct(out, sel)
+	return _remove_outliers(out)
 
 def parse_metadata( f, xml_command ):
 	"""Fill the specified HDF5 file with metadata according to the DataExchange initiative.
@@ -185,7 +266,7 @@ def parse_metadata( f, xml_command ):
 		dset = slits_vacuum.create_dataset('y2', data = float(val[0]), dtype = 'f')
 		dset.attrs['units'] = val[1]
 		
-def read_tomo( dataset, index ):
+def read_tomo( dataset, index, rows=None, cols=None ):
 	"""Extract the tomographic projection at the specified relative index from the HDF5 dataset.
 
 	Parameters
@@ -194,6 +275,18 @@ def read_tomo( dataset, index ):
 		HDF5 dataset as returned by the h5py API.
 	index : int
 		Relative position of the tomographic projection within the dataset.
+	rows : slice, optional
+		Rows of the projection (i.e. sinograms) to read with an optional positive stride, 
+		e.g. slice(0, 512, 2) (default = all). Only the selected data are read from disk.
+	cols : slice, optional
+		Columns of the projection (i.e. detector pixels) to read with an optional positive 
+		stride (default = all).
+
+	Returns
+	-------
+	The image as numpy array. For a TDFDataset stored contiguous and uncompressed in a 
+	file opened for reading only, this is a read-only view of the memory-mapped file 
+	(no copy): use astype or copy if it has to be modified.
 
 	"""
 	
@@ -203,16 +296,12 @@ def read_tomo( dataset, index ):
 	#	return dataset[:,index,:]	
 	#else:
 	#	return dataset[:,:,index]
-	if (DATA_ORDER == 0):
-		out = np.empty((dataset.shape[1],dataset.shape[2]), dtype=dataset.dtype)
-		dataset.read_direct(out, np.s_[index,:,:])
-		return _remove_outliers(out)
-	else: # (DATA_ORDER == 1):	
-		out = np.empty((dataset.shape[0],dataset.shape[2]), dtype=dataset.dtype)
-		dataset.read_direct(out, np.s_[:,index,:])
-		return _remove_outliers(out)
-
-def read_sino( dataset, index ):
+	if (get_order(dataset) == 0):
+		return _read_image(dataset, 0, index, rows, cols)
+	else: # (order == 1):	
+		return _read_image(dataset, 1, index, rows, cols)
+
+def read_sino( dataset, index, rows=None, cols=None ):
 	"""Extract the sinogram at the specified relative index from the HDF5 dataset.
 
 	Parameters
@@ -221,6 +310,19 @@ def read_sino( dataset, index ):
 		HDF5 dataset as returned by the h5py API.
 	index : int
 		Relative position of the sinogram within the dataset.
+	rows : slice, optional
+		Rows of the sinogram (i.e. projections) to read with an optional positive stride, 
+		e.g. slice(0, 1800, 4) for a decimation factor of 4 (default = all). Only the 
+		selected data are read from disk.
+	cols : slice, optional
+		Columns of the sinogram (i.e. detector pixels) to read with an optional positive 
+		stride, e.g. slice(None, None, 2) for a downscaling factor of 2 (default = all).
+
+	Returns
+	-------
+	The image as numpy array. For a TDFDataset stored contiguous and uncompressed in a 
+	file opened for reading only, this is a read-only view of the memory-mapped file 
+	(no copy): use astype or copy if it has to be modified.
 
 	"""
 
@@ -230,14 +332,418 @@ def read_sino( dataset, index ):
 	#	return dataset[index,:,:]		
 	#else:
 	#	return dataset[:,:,index]		
-	if (DATA_ORDER == 0):
-		out = np.empty((dataset.shape[0],dataset.shape[2]), dtype=dataset.dtype)
-		dataset.read_direct(out, np.s_[:,index,:])		
-		return _remove_outliers(out)
-	else: # (DATA_ORDER == 1):
-		out = np.empty((dataset.shape[1],dataset.shape[2]), dtype=dataset.dtype)
-		dataset.read_direct(out, np.s_[index,:,:])
-		return _remove_outliers(out)
+	if (get_order(dataset) == 0):
+		return _read_image(dataset, 1, index, rows, cols)
+	else: # (order == 1):
+		return _read_image(dataset, 0, index, rows, cols)
+
+def _remove_outliers_slab ( block ):
+	"""Correct NaN and Inf pixels by interpolation on the whole 3D slab (in place).
+
+	Parameters
+	----------
+	block : array_like
+		Float32 slab of images as numpy array with shape (nr_images, height, width).
+	
+	"""
+	_remove_outliers(block)
+
+def _slab_buffer ( out, shape ):
+	"""Get a C-contiguous float32 view with the specified shape from the buffer passed 
+	by the user (or allocate a new one).
+
+	Parameters
+	----------
+	out : array_like
+		Float32 buffer as numpy array (or None to allocate a new one). It can also be the 
+		(transposed) array returned by a previous call of read_sinos or read_tomos.
+	shape : tuple
+		Shape of the slab according to the storage order of the dataset.
+
+	"""
+	if out is None:
+		return np.empty(shape, dtype=float32)
+
+	if (out.dtype == float32) and (out.size == shape[0] * shape[1] * shape[2]):
+		if out.flags.c_contiguous:
+			return out.reshape(shape)
+		if (out.ndim == 3) and out.swapaxes(0,1).flags.c_contiguous:
+			return out.swapaxes(0,1).reshape(shape)
+
+	raise ValueError("The output buffer must be a contiguous float32 array with room for %d x %d x %d elements." % shape)
+
+def _read_slab ( dataset, axis, start, stop, step, out, rows=None, cols=None ):
+	"""Read with a single HDF5 call the images in the range [start, stop) along the specified axis.
+
+	Parameters
+	----------
+	dataset : HDF5 dataset 
+		HDF5 dataset as returned by the h5py API.
+	axis : int
+		Axis of the dataset (0 or 1) along which the images are stacked.
+	start : int
+		Relative position of the first image within the dataset.
+	stop : int
+		Relative position of the last image (excluded) within the dataset.
+	step : int
+		Stride between two consecutive images.
+	out : array_like
+		Float32 buffer to reuse (or None).
+	rows : slice
+		Rows of each image to read (None for all).
+	cols : slice
+		Columns of each image to read (None for all).
+
+	"""
+	sel = [None, None, _get_slice(cols)]
+	sel[axis] = slice(start, stop, step)
+	sel[1 - axis] = _get_slice(rows)
+	shape = tuple([_get_slice_len(sel[i], dataset.shape[i]) for i in range(0, 3)])
+	block = _slab_buffer(out, shape)
+
+	if (block.size > 0):
+		mm = _get_memmap(dataset)
+		nr_threads = _get_threads(dataset)
+		if mm is not None:
+			block[...] = mm[tuple(sel)]
+		elif (nr_threads > 1):
+			# Chunks are decompressed in parallel:
+			chunks.read_slab(dataset, tuple(sel), block, nr_threads)
+		else:
+			dataset.read_direct(block, tuple(sel))
+
+	# Outliers are corrected on the contiguous block (rows are the same in both orders):
+	_remove_outliers_slab(block)
+
+	# Images are always returned along the first axis:
+	if (axis == 1):
+		block = block.swapaxes(0,1)
+
+	return block
+
+def read_tomos( dataset, start, stop, step=1, out=None, rows=None, cols=None ):
+	"""Extract a slab of tomographic projections from the HDF5 dataset with a single read.
+
+	Parameters
+	----------
+	dataset : HDF5 dataset 
+		HDF5 dataset as returned by the h5py API.
+	start : int
+		Relative position of the first tomographic projection within the dataset.
+	stop : int
+		Relative position of the last tomographic projection (excluded) within the dataset.
+	step : int, optional
+		Stride between two consecutive projections (default = 1).
+	out : array_like, optional
+		Float32 buffer to be reused across calls in order to avoid a new allocation for each 
+		slab. Usually this is the array returned by a previous call with the same number of 
+		projections.
+	rows : slice, optional
+		Rows of each projection to read (see read_tomo).
+	cols : slice, optional
+		Columns of each projection to read (see read_tomo).
+
+	Returns
+	-------
+	A float32 array with shape (nr_projs, nr_sinos, det_size) (or the shape of the selected 
+	rows and columns). Depending on the storage 
+	order of the dataset, this can be a (non-contiguous) view of the buffer.
+
+	Example (using h5py)
+	--------------------------
+	>>> f   = getHDF5('dataset.h5', 'r')
+	>>> buf = None
+	>>> for i in range(0, 1800, 16):
+	>>>     buf = tdf.read_tomos(f['exchange/data'], i, i + 16, out=buf)
+
+	"""
+	if (get_order(dataset) == 0):
+		return _read_slab(dataset, 0, start, stop, step, out, rows, cols)
+	else: # (order == 1):
+		return _read_slab(dataset, 1, start, stop, step, out, rows, cols)
+
+def read_sinos( dataset, start, stop, step=1, out=None, rows=None, cols=None ):
+	"""Extract a slab of sinograms from the HDF5 dataset with a single read.
+
+	Parameters
+	----------
+	dataset : HDF5 dataset 
+		HDF5 dataset as returned by the h5py API.
+	start : int
+		Relative position of the first sinogram within the dataset.
+	stop : int
+		Relative position of the last sinogram (excluded) within the dataset.
+	step : int, optional
+		Stride between two consecutive sinograms (default = 1).
+	out : array_like, optional
+		Float32 buffer to be reused across calls in order to avoid a new allocation for each 
+		slab. Usually this is the array returned by a previous call with the same number of 
+		sinograms.
+	rows : slice, optional
+		Rows of each sinogram to read (see read_sino).
+	cols : slice, optional
+		Columns of each sinogram to read (see read_sino).
+
+	Returns
+	-------
+	A float32 array with shape (nr_sinos, nr_projs, det_size) (or the shape of the selected 
+	rows and columns). Depending on the storage 
+	order of the dataset, this can be a (non-contiguous) view of the buffer.
+
+	"""
+	if (get_order(dataset) == 0):
+		return _read_slab(dataset, 1, start, stop, step, out, rows, cols)
+	else: # (order == 1):
+		return _read_slab(dataset, 0, start, stop, step, out, rows, cols)
+
+def _iter_slabs( read_func, dataset, start, stop, step, slab_size, rows=None, cols=None ):
+	"""Generator reading with the specified function the images in the range [start, stop) 
+	in slabs of slab_size images and yielding them one by one. The same buffer is reused for
+	all the slabs having the same size.
+
+	"""
+	indexes = list(range(start, stop, step))
+	block = None
+	for k in range(0, len(indexes), slab_size):
+		curr = indexes[k:k + slab_size]
+		if (block is not None) and (block.shape[0] != len(curr)):
+			block = None
+		block = read_func(dataset, curr[0], curr[-1] + 1, step, block, rows, cols)
+		for j in range(0, len(curr)):
+			yield curr[j], block[j,:,:]
+
+def iter_tomos( dataset, start, stop, step=1, max_bytes=268435456, rows=None, cols=None ):
+	"""Iterate over the tomographic projections in the range [start, stop) of the HDF5 dataset.
+	Projections are read in slabs with read_tomos so that the number of HDF5 calls is reduced.
+
+	Parameters
+	----------
+	dataset : HDF5 dataset 
+		HDF5 dataset as returned by the h5py API.
+	start : int
+		Relative position of the first tomographic projection within the dataset.
+	stop : int
+		Relative position of the last tomographic projection (excluded) within the dataset.
+	step : int, optional
+		Stride between two consecutive projections (default = 1).
+	max_bytes : int, optional
+		Maximum size in bytes of each slab (default = 256 MB).
+	rows : slice, optional
+		Rows of each image to read (see read_tomo and read_sino).
+	cols : slice, optional
+		Columns of each image to read (see read_tomo and read_sino).
+
+	Returns
+	-------
+	A generator of (index, image) tuples. The image is a float32 view of the slab buffer and 
+	it is overwritten when the next slab is read: copy it if it has to be kept.
+
+	"""
+	slab_size = get_slab_size(dataset, max_bytes, False, rows, cols)
+	return _iter_slabs(read_tomos, dataset, start, stop, step, slab_size, rows, cols)
+
+def iter_sinos( dataset, start, stop, step=1, max_bytes=268435456, rows=None, cols=None ):
+	"""Iterate over the sinograms in the range [start, stop) of the HDF5 dataset. Sinograms 
+	are read in slabs with read_sinos so that the number of HDF5 calls is reduced.
+
+	Parameters
+	----------
+	dataset : HDF5 dataset 
+		HDF5 dataset as returned by the h5py API.
+	start : int
+		Relative position of the first sinogram within the dataset.
+	stop : int
+		Relative position of the last sinogram (excluded) within the dataset.
+	step : int, optional
+		Stride between two consecutive sinograms (default = 1).
+	max_bytes : int, optional
+		Maximum size in bytes of each slab (default = 256 MB).
+	rows : slice, optional
+		Rows of each image to read (see read_tomo and read_sino).
+	cols : slice, optional
+		Columns of each image to read (see read_tomo and read_sino).
+
+	Returns
+	-------
+	A generator of (index, image) tuples. The image is a float32 view of the slab buffer and 
+	it is overwritten when the next slab is read: copy it if it has to be kept.
+
+	Example (using h5py)
+	--------------------------
+	>>> f = getHDF5('dataset.h5', 'r')
+	>>> for i, im in tdf.iter_sinos(f['exchange/data'], 0, 2048):
+	>>>     imsave('sino_' + str(i).zfill(4) + '.tif', im)
+
+	"""
+	slab_size = get_slab_size(dataset, max_bytes, True, rows, cols)
+	return _iter_slabs(read_sinos, dataset, start, stop, step, slab_size, rows, cols)
+
+def parse_downsc ( spec ):
+	"""Parse a downscaling setting: an integer factor (pixels are decimated, i.e. one 
+	pixel every factor pixels is kept) optionally followed by ':mean' or ':sum' to bin 
+	the pixels instead (blocks of factor x factor pixels are averaged or summed).
+
+	Parameters
+	----------
+	spec : string
+		Downscaling setting, e.g. "2", "2:mean" or "4:sum".
+
+	Return value
+	----------
+	The tuple (factor, mode) where mode is None for decimation or 'mean' or 'sum' 
+	for binning. A ValueError is raised for an invalid setting.
+
+	"""
+	parts = str(spec).strip().split(':')
+	factor = max(int(parts[0]), 1)
+	mode = parts[1].strip().lower() if (len(parts) > 1) and (parts[1].strip() != '') else None
+	if mode not in (None, 'mean', 'sum'):
+		raise ValueError("Binning mode '%s' not supported (use 'mean' or 'sum')." % mode)
+	if (factor == 1):
+		mode = None
+
+	return (factor, mode)
+
+def _bin_axis ( block, axis, factor, mode ):
+	"""Sum (or average) groups of factor consecutive elements along the specified axis. 
+	The trailing elements that do not fill a whole group are discarded.
+
+	"""
+	n = (block.shape[axis] // factor) * factor
+	if (n < block.shape[axis]):
+		sel = [slice(None)] * block.ndim
+		sel[axis] = slice(0, n)
+		block = block[tuple(sel)]
+	shape = block.shape[:axis] + (n // factor, factor) + block.shape[axis + 1:]
+	out = block.reshape(shape).sum(axis=axis + 1, dtype=float32)
+	if (mode == 'mean'):
+		out /= factor
+
+	return out
+
+def bin_image ( im, factor, mode='mean' ):
+	"""Bin an image (e.g. a flat or a dark image) in blocks of factor x factor pixels. 
+	Additional trailing axes (e.g. the components of the dynamic flat fielding) are 
+	preserved. The last rows and columns that do not fill a whole block are discarded.
+
+	Parameters
+	----------
+	im : array_like
+		Image data as numpy array with the detector rows and columns along the first 
+		two axes.
+	factor : int
+		Binning factor.
+	mode : string, optional
+		'mean' to average the pixels of each block or 'sum' to sum them (default = 'mean').
+
+	Returns
+	-------
+	The binned image as float32 numpy array.
+
+	"""
+	im = np.asarray(im, dtype=float32)
+	if (factor <= 1):
+		return im
+	return _bin_axis(_bin_axis(im, 0, factor, mode), 1, factor, mode)
+
+def downscale_image ( im, factor, mode=None ):
+	"""Downscale an image either by decimation (mode = None, i.e. im[::factor,::factor]) 
+	or by binning (mode = 'mean' or 'sum', see bin_image) as returned by parse_downsc.
+
+	"""
+	if mode is None:
+		return im[::factor,::factor]
+	return bin_image(im, factor, mode)
+
+def read_sinos_binned( dataset, start, stop, factor, mode='mean', rows=None ):
+	"""Extract a slab of binned sinograms from the HDF5 dataset: each binned sinogram is 
+	obtained from factor consecutive sinograms by binning blocks of factor x factor 
+	detector pixels (detector rows x columns), i.e. the projections are binned as 
+	bin_image does. The indexes refer to the binned dataset.
+
+	Parameters
+	----------
+	dataset : HDF5 dataset 
+		HDF5 dataset as returned by the h5py API.
+	start : int
+		Relative position of the first binned sinogram.
+	stop : int
+		Relative position of the last binned sinogram (excluded).
+	factor : int
+		Binning factor.
+	mode : string, optional
+		'mean' to average the pixels of each block or 'sum' to sum them (default = 'mean').
+	rows : slice, optional
+		Rows of each sinogram (i.e. projections) to read (see read_sino). Projections are 
+		not binned.
+
+	Returns
+	-------
+	A float32 array with shape (nr_sinos, nr_projs, det_size // factor).
+
+	"""
+	block = read_sinos(dataset, start * factor, stop * factor, rows=rows)
+	if (factor <= 1):
+		return block
+	return _bin_axis(_bin_axis(block, 0, factor, mode), 2, factor, mode)
+
+def read_sino_binned( dataset, index, factor, mode='mean', rows=None ):
+	"""Extract the binned sinogram at the specified relative index (with reference to the 
+	binned dataset) from the HDF5 dataset (see read_sinos_binned).
+
+	Example (using h5py)
+	--------------------------
+	>>> f  = getHDF5('dataset.h5', 'r')
+	>>> im = tdf.read_sino_binned(f['exchange/data'], 256, 2)
+
+	"""
+	return read_sinos_binned(dataset, index, index + 1, factor, mode, rows)[0,:,:]
+
+def read_tomo_binned( dataset, index, factor, mode='mean' ):
+	"""Extract the tomographic projection at the specified relative index from the HDF5 
+	dataset binned in blocks of factor x factor pixels (see bin_image).
+
+	"""
+	return bin_image(read_tomo(dataset, index), factor, mode)
+
+def _read_sinos_binned_func( factor, mode ):
+	"""Get a function with the same arguments of read_sinos that reads binned sinograms.
+
+	"""
+	def _read ( dataset, start, stop, step=1, out=None, rows=None, cols=None ):
+		return read_sinos_binned(dataset, start, stop, factor, mode, rows)
+	return _read
+
+def iter_sinos_binned( dataset, start, stop, factor, mode='mean', max_bytes=268435456, rows=None ):
+	"""Iterate over the binned sinograms in the range [start, stop) of the HDF5 dataset 
+	(the indexes refer to the binned dataset, see read_sinos_binned). Sinograms are read 
+	in slabs so that the number of HDF5 calls is reduced.
+
+	Parameters
+	----------
+	dataset : HDF5 dataset 
+		HDF5 dataset as returned by the h5py API.
+	start : int
+		Relative position of the first binned sinogram.
+	stop : int
+		Relative position of the last binned sinogram (excluded).
+	factor : int
+		Binning factor.
+	mode : string, optional
+		'mean' to average the pixels of each block or 'sum' to sum them (default = 'mean').
+	max_bytes : int, optional
+		Maximum size in bytes of each slab of sinograms read at full resolution 
+		(default = 256 MB).
+	rows : slice, optional
+		Rows of each sinogram (i.e. projections) to read (see read_sino).
+
+	Returns
+	-------
+	A generator of (index, image) tuples.
+
+	"""
+	slab_size = max(1, get_slab_size(dataset, max_bytes, True, rows) // max(factor, 1))
+	return _iter_slabs(_read_sinos_binned_func(factor, mode), dataset, start, stop, 1, slab_size, rows)
 
 def write_tomo( dataset, index, im ):
 	"""Modify the tomographic projection at the specified relative index from the HDF5 dataset 
@@ -253,9 +759,9 @@ def write_tomo( dataset, index, im ):
 		Image data as numpy array.
 
 	"""
-	if (DATA_ORDER == 0):
+	if (get_order(dataset) == 0):
 		dataset[index,:,:] = im	
-	else: # (DATA_ORDER == 1):
+	else: # (order == 1):
 		dataset[:,index,:] = im	
 
 def write_sino( dataset, index, im ):
@@ -272,11 +778,125 @@ def write_sino( dataset, index, im ):
 		Image data as numpy array.
 
 	"""
-	if (DATA_ORDER == 0):
+	if (get_order(dataset) == 0):
 		dataset[:,index,:] = im
-	else: # (DATA_ORDER == 1):
+	else: # (order == 1):
 		dataset[index,:,:] = im		
 	
+def _write_slab ( dataset, axis, start, block ):
+	"""Write with a single HDF5 call the images of the block (stacked along the first axis)
+	starting at the specified position along the specified axis of the dataset.
+
+	"""
+	nr_images = block.shape[0]
+	if (nr_images == 0):
+		return
+
+	sel = [slice(None), slice(None), slice(None)]
+	sel[axis] = slice(start, start + nr_images)
+	if (axis == 1):
+		block = block.swapaxes(0,1)
+	dataset[tuple(sel)] = np.ascontiguousarray(block, dtype=dataset.dtype)
+
+def write_tomos( dataset, start, block ):
+	"""Modify a slab of consecutive tomographic projections of the HDF5 dataset with a 
+	single write.
+
+	Parameters
+	----------
+	dataset : HDF5 dataset 
+		HDF5 dataset as returned by the h5py API.
+	start : int
+		Relative position of the first tomographic projection within the dataset.
+	block : array_like
+		Projections stacked along the first axis, i.e. a numpy array with shape 
+		(nr_projs, nr_sinos, det_size) as returned by read_tomos.
+
+	"""
+	if (get_order(dataset) == 0):
+		_write_slab(dataset, 0, start, block)
+	else: # (order == 1):
+		_write_slab(dataset, 1, start, block)
+
+def write_sinos( dataset, start, block ):
+	"""Modify a slab of consecutive sinograms of the HDF5 dataset with a single write.
+
+	Parameters
+	----------
+	dataset : HDF5 dataset 
+		HDF5 dataset as returned by the h5py API.
+	start : int
+		Relative position of the first sinogram within the dataset.
+	block : array_like
+		Sinograms stacked along the first axis, i.e. a numpy array with shape 
+		(nr_sinos, nr_projs, det_size) as returned by read_sinos.
+
+	"""
+	if (get_order(dataset) == 0):
+		_write_slab(dataset, 1, start, block)
+	else: # (order == 1):
+		_write_slab(dataset, 0, start, block)
+	
+def append_tomos( dataset, block ):
+	"""Append a slab of tomographic projections at the end of an HDF5 dataset that can grow 
+	along the axis of the projections (i.e. created with maxshape = None along such axis). The 
+	dataset is flushed so that the new projections are seen by the readers of a file written
+	in SWMR mode (see open_swmr).
+
+	Parameters
+	----------
+	dataset : HDF5 dataset 
+		HDF5 dataset as returned by the h5py API.
+	block : array_like
+		Projections stacked along the first axis, i.e. a numpy array with shape 
+		(nr_projs, nr_sinos, det_size).
+
+	Return value
+	----------
+	The number of projections of the dataset.
+
+	"""
+	start = get_nr_projs(dataset)
+	dataset.resize(start + block.shape[0], axis=_get_axes(get_order(dataset))[1])
+	write_tomos(dataset, start, block)
+	dataset.flush()
+
+	return start + block.shape[0]
+
+def open_swmr( filename ):
+	"""Open for reading a TDF file that is still being written in SWMR mode (single writer, 
+	multiple readers), e.g. by a converter in watch mode. The datasets grow while the file is
+	open: call refresh to see the projections written in the meanwhile.
+
+	Parameters
+	----------
+	filename : string
+		Absolute path of the TDF file.
+
+	Example (using h5py)
+	--------------------------
+	>>> f    = tdf.open_swmr('dataset.tdf')
+	>>> dset = tdf.TDFDataset(f['exchange/data'])
+	>>> while (tdf.refresh(dset) < 100):
+	>>>     time.sleep(1.0)
+	>>> im   = tdf.read_tomo(dset, 99)
+
+	"""
+	return h5py.File(filename, 'r', libver='latest', swmr=True)
+
+def refresh( dataset ):
+	"""Refresh a dataset of a file opened with open_swmr and get the number of projections 
+	written so far.
+
+	Parameters
+	----------
+	dataset : HDF5 dataset 
+		HDF5 dataset as returned by the h5py API.
+
+	"""
+	dataset.refresh()
+	return get_nr_projs(dataset)
+
 def get_nr_projs ( dataset ):
 	"""Get the number of projections of the input dataset.
 
@@ -286,9 +906,9 @@ def get_nr_projs ( dataset ):
 		HDF5 dataset as returned by the h5py API.
 
 	"""
-	if (DATA_ORDER == 0):
+	if (get_order(dataset) == 0):
 		return dataset.shape[0]	
-	else: # (DATA_ORDER == 1):
+	else: # (order == 1):
 		return dataset.shape[1]		
 	
 def get_nr_sinos ( dataset ):
@@ -300,11 +920,27 @@ def get_nr_sinos ( dataset ):
 		HDF5 dataset as returned by the h5py API.
 
 	"""
-	if (DATA_ORDER == 0):
+	if (get_order(dataset) == 0):
 		return dataset.shape[1]	
-	else: # (DATA_ORDER == 1):
+	else: # (order == 1):
 		return dataset.shape[0]	
 		
+def get_order ( dataset ):
+	"""Get the storage order of the input dataset: 0 if projections are stored contiguously
+	(theta:y:x) or 1 if sinograms are stored contiguously (y:theta:x). The order is the one
+	read from the axes attribute for a TDFDataset and DATA_ORDER for plain h5py datasets.
+
+	Parameters
+	----------
+	dataset : HDF5 dataset 
+		HDF5 dataset as returned by the h5py API (or TDFDataset).
+
+	"""
+	if isinstance(dataset, TDFDataset):
+		return dataset.order
+	else:
+		return DATA_ORDER
+
 def get_det_size ( dataset ):
 	"""Get the width of the detector (nr of pixels) of the input dataset.
 
@@ -316,7 +952,33 @@ def get_det_size ( dataset ):
 	"""
 	return dataset.shape[2]	
 	
-def get_dset_shape ( det_size, fov_height, nr_proj ):
+def get_slab_size ( dataset, max_bytes=268435456, sino=True, rows=None, cols=None ):
+	"""Get the number of sinograms (or projections) that can be read as a single float32 
+	slab without exceeding the specified amount of memory.
+
+	Parameters
+	----------
+	dataset : HDF5 dataset 
+		HDF5 dataset as returned by the h5py API.
+	max_bytes : int, optional
+		Maximum size in bytes of the slab (default = 256 MB).
+	sino : bool, optional
+		True if the slab is made of sinograms, False for projections (default = True).
+	rows : slice, optional
+		Rows of each image that are read (default = all).
+	cols : slice, optional
+		Columns of each image that are read (default = all).
+
+	"""
+	if sino:
+		nr_rows = _get_slice_len(rows, get_nr_projs(dataset))
+	else:
+		nr_rows = _get_slice_len(rows, get_nr_sinos(dataset))
+	im_bytes = nr_rows * _get_slice_len(cols, get_det_size(dataset)) * 4
+	
+	return max(1, int(max_bytes // max(1, im_bytes)))
+	
+def get_dset_shape ( det_size, fov_height, nr_proj, order=None ):
 	"""Get the shape of the dataset by arranging the input parameters.
 
 	Parameters
@@ -327,23 +989,417 @@ def get_dset_shape ( det_size, fov_height, nr_proj ):
 		Height of the FOV, i.e. the number of sinograms (or slices) of the dataset.
 	nr_proj : int
 		Number of collected projections.
+	order : int, optional
+		Storage order of the dataset: 0 for theta:y:x or 1 for y:theta:x (default = DATA_ORDER).
 
 	"""
-	if (DATA_ORDER == 0):
+	if (_get_order(order) == 0):
 		return (nr_proj, fov_height, det_size)
-	else: # (DATA_ORDER == 1):
+	else: # (order == 1):
 		return (fov_height, nr_proj, det_size)		
 		
-def get_dset_chunks ( det_size ):
-	"""Get a good chunk combination. This function needs improvement...
+def _get_order ( order=None ):
+	"""Get the specified storage order or DATA_ORDER if not specified.
+
+	"""
+	return DATA_ORDER if order is None else order
+
+def _get_axes ( order=None ):
+	"""Get the axes of the dataset related to sinograms and projections as the
+	tuple (sino_axis, tomo_axis) for the specified storage order.
+
+	"""
+	if (_get_order(order) == 0):
+		return (1, 0)
+	else: # (order == 1):
+		return (0, 1)
+
+def _split_evenly ( length, max_length ):
+	"""Get the size of the blocks that split the specified length into the minimum number of 
+	blocks not longer than max_length. The returned size avoids a tiny last block (it is 1
+	for an empty length).
+
+	"""
+	if (length <= 0):
+		return 1
+	max_length = max(1, min(int(max_length), length))
+	nr_blocks = int(ceil(length / float(max_length)))
+
+	return int(ceil(length / float(nr_blocks)))
+
+def get_dset_chunks ( det_size, dset_shape=None, dtype=None, compressed=True, access='sino', order=None ):
+	"""Get a good chunk combination. If only the detector width is specified, one row of the 
+	detector is returned (legacy behavior). Otherwise the chunk shape is tuned according to the 
+	shape, the data type and the compression of the dataset as well as to the access pattern
+	that has to be privileged:
+
+	- 'sino': each chunk contains a portion of one sinogram only, i.e. the reading of a sinogram
+	  touches only the chunks it needs and it decompresses each of them once;
+	- 'tomo': each chunk contains a portion of one projection only (the same for projections);
+	- 'both': chunks are (almost) cubic so that sinograms and projections are both read with a
+	  reasonable amount of chunks (a chunk cache able to host a row of chunks is required).
+
+	The chunk size is about CHUNK_BYTES for compressed datasets and CHUNK_BYTES_UNCOMPRESSED 
+	otherwise. The detector rows are never split unless a single row exceeds such a size.
 
 	Parameters
 	----------
 	det_size : int
 		Width of the detector.	
+	dset_shape : tuple, optional
+		Shape of the dataset as returned by get_dset_shape.
+	dtype : numpy dtype, optional
+		Data type of the dataset (default = uint16).
+	compressed : bool, optional
+		True if the dataset is compressed (default = True).
+	access : string, optional
+		Access pattern to privilege: 'sino', 'tomo' or 'both' (default = 'sino'). A 
+		ValueError is raised for any other value.
+	order : int, optional
+		Storage order of the dataset: 0 for theta:y:x or 1 for y:theta:x (default = DATA_ORDER).
+
+	Example
+	--------------------------
+	>>> shape  = tdf.get_dset_shape(2048, 2048, 1800)
+	>>> chunks = tdf.get_dset_chunks(2048, shape, numpy.uint16, True, 'sino')
 
 	"""
-	if (DATA_ORDER == 0):
+	if access not in ('sino', 'tomo', 'both'):
+		raise ValueError("Access pattern '%s' not supported (use 'sino', 'tomo' or 'both')." % access)
+	if dset_shape is None:
 		return (1, 1, det_size)
-	else: # (DATA_ORDER == 1):
-		return (1, 1, det_size)		
+
+	sino_axis, tomo_axis = _get_axes(order)
+
+	itemsize = np.dtype(np.uint16 if dtype is None else dtype).itemsize
+	max_bytes = CHUNK_BYTES if compressed else CHUNK_BYTES_UNCOMPRESSED
+
+	# Full detector rows (if possible):
+	chunk_x = _split_evenly(dset_shape[2], max_bytes // itemsize)
+	nr_rows = max(1, max_bytes // (chunk_x * itemsize))
+
+	chunks = [1, 1, chunk_x]
+	if (access == 'tomo'):
+		chunks[sino_axis] = _split_evenly(dset_shape[sino_axis], nr_rows)
+	elif (access == 'both'):
+		side = int(sqrt(nr_rows))
+		chunks[sino_axis] = _split_evenly(dset_shape[sino_axis], side)
+		chunks[tomo_axis] = _split_evenly(dset_shape[tomo_axis], nr_rows // chunks[sino_axis])
+	else: # (access == 'sino'):
+		chunks[tomo_axis] = _split_evenly(dset_shape[tomo_axis], nr_rows)
+		
+	return tuple(chunks)
+
+def _gcd ( a, b ):
+	"""Greatest common divisor of two positive integers.
+
+	"""
+	while b:
+		a, b = b, a % b
+	return a
+
+def get_rechunk_size ( src, dst, max_bytes=268435456 ):
+	"""Get the number of images (sinograms or projections according to the storage order of
+	the destination dataset) to transpose at a time with iter_rechunk. The size is a multiple
+	of the chunk size of both datasets along the involved axes (if the memory budget allows 
+	it) so that every chunk is read and written only once and as a whole.
+
+	Parameters
+	----------
+	src : HDF5 dataset
+		Source dataset (h5py dataset or TDFDataset).
+	dst : HDF5 dataset
+		Destination dataset (h5py dataset or TDFDataset).
+	max_bytes : int, optional
+		Memory budget in bytes for the buffers (default = 256 MB).
+
+	"""
+	transpose = (get_order(src) != get_order(dst))
+	src_axis = 1 if transpose else 0
+
+	# One buffer is required for reading and another one for the transposed block:
+	im_bytes = dst.shape[1] * dst.shape[2] * np.dtype(dst.dtype).itemsize
+	nr_buffers = 2 if transpose else 1
+	max_images = max(1, int(max_bytes // (nr_buffers * im_bytes)))
+
+	dst_c = dst.chunks[0] if (dst.chunks is not None) else 1
+	src_c = src.chunks[src_axis] if (src.chunks is not None) else 1
+	lcm = dst_c * src_c // _gcd(dst_c, src_c)
+
+	if (lcm <= max_images):
+		step = lcm
+	elif (dst_c <= max_images):
+		step = dst_c
+	else:
+		step = 1
+
+	return min(dst.shape[0], max_images // step * step)
+
+def iter_rechunk ( src, dst, max_bytes=268435456 ):
+	"""Generator copying the source dataset into the destination dataset (which has the same
+	sinograms and projections but possibly a different storage order and chunk layout) block
+	by block within the specified memory budget. Each block is read with a single HDF5 call, 
+	transposed in memory (if required) and written with a single HDF5 call. Data are copied 
+	as they are, i.e. with no type conversion and no outlier correction. After each block the
+	range [start, stop) of the copied images (along the first axis of the destination) is 
+	yielded.
+
+	Parameters
+	----------
+	src : HDF5 dataset
+		Source dataset (h5py dataset or TDFDataset).
+	dst : HDF5 dataset
+		Destination dataset (h5py dataset or TDFDataset) as created e.g. with the shape 
+		returned by get_dset_shape for the desired order.
+	max_bytes : int, optional
+		Memory budget in bytes for the buffers (default = 256 MB).
+
+	Example (using h5py)
+	--------------------------
+	>>> src   = tdf.TDFDataset(f_in['exchange/data'])
+	>>> shape = tdf.get_dset_shape(tdf.get_det_size(src), tdf.get_nr_sinos(src), tdf.get_nr_projs(src), 1)
+	>>> dst   = f_out.create_dataset('exchange/data', shape, src.dtype)
+	>>> tdf.set_axes_attr(dst, 1)
+	>>> for start, stop in tdf.iter_rechunk(src, tdf.TDFDataset(dst)):
+	>>>     print(stop)
+
+	"""
+	transpose = (get_order(src) != get_order(dst))
+	expected = (dst.shape[1], dst.shape[0], dst.shape[2]) if transpose else dst.shape
+	if (tuple(src.shape) != tuple(expected)):
+		raise ValueError("Source and destination datasets have incompatible shapes.")
+
+	nr_images = dst.shape[0]
+	size = get_rechunk_size(src, dst, max_bytes)
+
+	# Buffers are allocated once and reused for all the blocks:
+	if transpose:
+		buf = np.empty((src.shape[0], size, src.shape[2]), dtype=src.dtype)
+		out = np.empty((size, dst.shape[1], dst.shape[2]), dtype=dst.dtype)
+	else:
+		buf = np.empty((size, src.shape[1], src.shape[2]), dtype=src.dtype)
+
+	for start in range(0, nr_images, size):
+		stop = min(start + size, nr_images)
+		n = stop - start
+
+		if transpose:
+			src.read_direct(buf, np.s_[:,start:stop,:], np.s_[:,0:n,:])
+			out[0:n,:,:] = buf[:,0:n,:].swapaxes(0,1)
+			dst.write_direct(out, np.s_[0:n,:,:], np.s_[start:stop,:,:])
+		else:
+			src.read_direct(buf, np.s_[start:stop,:,:], np.s_[0:n,:,:])
+			if (buf.dtype != dst.dtype):
+				dst[start:stop,:,:] = buf[0:n,:,:]
+			else:
+				dst.write_direct(buf, np.s_[0:n,:,:], np.s_[start:stop,:,:])
+
+		yield (start, stop)
+
+def rechunk ( src, dst, max_bytes=268435456 ):
+	"""Copy the source dataset into the destination dataset (possibly with a different 
+	storage order) block by block within the specified memory budget. See iter_rechunk.
+
+	"""
+	for start, stop in iter_rechunk(src, dst, max_bytes):
+		pass
+
+def get_axes_attr ( order=None ):
+	"""Get the value of the axes attribute describing the specified storage order.
+
+	Parameters
+	----------
+	order : int, optional
+		Storage order of the dataset: 0 for theta:y:x or 1 for y:theta:x (default = DATA_ORDER).
+
+	"""
+	if (_get_order(order) == 0):
+		return "theta:y:x"
+	else: # (order == 1):
+		return "y:theta:x"
+
+def set_axes_attr ( dataset, order=None ):
+	"""Set the axes attribute of the dataset and tag it as reliable (see AXES_VERSION), so 
+	that the dataset is read according to the specified storage order.
+
+	Parameters
+	----------
+	dataset : HDF5 dataset 
+		HDF5 dataset as returned by the h5py API.
+	order : int, optional
+		Storage order of the dataset: 0 for theta:y:x or 1 for y:theta:x (default = DATA_ORDER).
+
+	"""
+	dataset.attrs['axes'] = get_axes_attr(order)
+	dataset.attrs['axes_version'] = AXES_VERSION
+
+def _parse_axes_attr ( dataset ):
+	"""Get the storage order of the dataset from its axes attribute (DATA_ORDER if the
+	attribute is missing or unknown or if the dataset was written by the legacy converters,
+	i.e. it is not tagged with the axes_version attribute).
+
+	"""
+	attrs = getattr(dataset, 'attrs', {})
+	if not ('axes_version' in attrs):
+		return DATA_ORDER
+	axes = attrs['axes'] if ('axes' in attrs) else None
+	if isinstance(axes, bytes):
+		axes = axes.decode('ascii', 'ignore')
+	axes = str(axes).strip().lower()
+
+	if (axes == "theta:y:x"):
+		return 0
+	elif (axes == "y:theta:x"):
+		return 1
+	else:
+		return DATA_ORDER
+
+
+def get_memmap ( dataset ):
+	"""Map the whole dataset into memory if it is stored contiguous and uncompressed (e.g. 
+	as written by the converters when compression is off) in a file opened for reading 
+	only. The data are then accessed with plain numpy slicing, without any HDF5 call, and 
+	several processes reading the same file share the operating system page cache.
+
+	Parameters
+	----------
+	dataset : HDF5 dataset 
+		HDF5 dataset as returned by the h5py API (or TDFDataset).
+
+	Returns
+	-------
+	A read-only numpy.memmap with the shape of the dataset or None if the dataset cannot
+	be mapped (chunked, compressed, not yet allocated, stored in external files, etc.).
+
+	"""
+	if isinstance(dataset, TDFDataset):
+		dataset = dataset.dataset
+	try:
+		if (dataset.chunks is not None) or (dataset.file.mode != 'r') or (dataset.size == 0):
+			return None
+		if (dataset.dtype.fields is not None) or dataset.dtype.hasobject or dataset.external:
+			return None
+		if (dataset.file.driver not in ['sec2', 'windows', 'stdio']) or (dataset.file.userblock_size != 0):
+			return None
+		offset = dataset.id.get_offset()
+		if offset is None:
+			return None
+
+		return np.memmap(dataset.file.filename, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape)
+	except Exception:
+		return None
+
+def _get_memmap ( dataset ):
+	"""Get the (cached) memory map of a TDFDataset (None for plain h5py datasets or if
+	the dataset cannot be mapped).
+
+	"""
+	if isinstance(dataset, TDFDataset):
+		return dataset.get_memmap()
+	else:
+		return None
+
+
+def _get_threads ( dataset ):
+	"""Get the number of threads decompressing the chunks of a TDFDataset (1 for plain 
+	h5py datasets or if the chunks cannot be decompressed outside HDF5).
+
+	"""
+	if isinstance(dataset, TDFDataset):
+		return dataset.get_threads()
+	else:
+		return 1
+
+
+class TDFDataset(object):
+	"""Wrapper of an HDF5 dataset that knows its own storage order. The order is read from 
+	the axes attribute of the dataset (y:theta:x or theta:y:x) so that sinograms and 
+	projections are always read along the right axis, also when datasets with different 
+	layouts are used together. Datasets without the axes_version attribute (written by the 
+	legacy converters) are read as DATA_ORDER unless the order is specified. All the 
+	functions of this module accept a TDFDataset in place of an h5py dataset and the 
+	attributes of the h5py dataset are still available.
+
+	Parameters
+	----------
+	dataset : HDF5 dataset 
+		HDF5 dataset as returned by the h5py API (or another TDFDataset).
+	order : int, optional
+		Storage order to use instead of the one read from the axes attribute: 0 for 
+		theta:y:x or 1 for y:theta:x.
+	memmap : bool, optional
+		Read through a memory map when the dataset is contiguous and uncompressed (see
+		get_memmap). Default = True.
+	threads : int, optional
+		Number of threads decompressing the chunks when slabs of a gzip-compressed dataset 
+		are read (see stp_core.io.chunks). Default = 1, i.e. decompression within HDF5 (or
+		the number of threads of the wrapped TDFDataset).
+
+	Example (using h5py)
+	--------------------------
+	>>> f    = getHDF5('dataset.h5', 'r')
+	>>> dset = tdf.TDFDataset(f['exchange/data'])
+	>>> im   = dset.read_sino(1024)
+
+	"""
+	def __init__(self, dataset, order=None, memmap=True, threads=None):
+		if isinstance(dataset, TDFDataset):
+			if order is None:
+				order = dataset.order
+			if threads is None:
+				threads = dataset.threads
+			memmap = memmap and dataset.memmap
+			dataset = dataset.dataset
+		self.dataset = dataset
+		self.order = _parse_axes_attr(dataset) if order is None else order
+		self.memmap = memmap
+		self._mmap = None
+		self.threads = 1 if threads is None else threads
+		self._chunked = None
+
+	def get_memmap(self):
+		if self.memmap and (self._mmap is None):
+			self._mmap = get_memmap(self.dataset)
+			self.memmap = self._mmap is not None
+		return self._mmap
+
+	def get_threads(self):
+		if (self.threads > 1) and (self._chunked is None):
+			self._chunked = chunks.is_supported(self.dataset)
+		return self.threads if (self.threads > 1) and self._chunked else 1
+
+	def __getattr__(self, name):
+		return getattr(self.dataset, name)
+
+	def __getitem__(self, args):
+		return self.dataset[args]
+
+	def __setitem__(self, args, val):
+		self.dataset[args] = val
+
+	def __len__(self):
+		return len(self.dataset)
+
+	def read_tomo(self, index, rows=None, cols=None):
+		return read_tomo(self, index, rows, cols)
+
+	def read_sino(self, index, rows=None, cols=None):
+		return read_sino(self, index, rows, cols)
+
+	def read_tomos(self, start, stop, step=1, out=None, rows=None, cols=None):
+		return read_tomos(self, start, stop, step, out, rows, cols)
+
+	def read_sinos(self, start, stop, step=1, out=None, rows=None, cols=None):
+		return read_sinos(self, start, stop, step, out, rows, cols)
+
+	def write_tomo(self, index, im):
+		write_tomo(self, index, im)
+
+	def write_sino(self, index, im):
+		write_sino(self, index, im)
+
+	def write_tomos(self, start, block):
+		write_tomos(self, start, block)
+
+	def write_sinos(self, start, block):
+		write_sinos(self, start, block)
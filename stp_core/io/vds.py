@@ -0,0 +1,378 @@
+﻿###########################################################################
+# (C) 2016 Elettra - Sincrotrone Trieste S.C.p.A.. All rights reserved.   #
+#                                                                         #
+#                                                                         #
+# This file is part of STP-Core, the Python core of SYRMEP Tomo Project,  #
+# a software tool for the reconstruction of experimental CT datasets.     #
+#                                                                         #
+# STP-Core is free software: you can redistribute it and/or modify it     #
+# under the terms of the GNU General Public License as published by the   #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# STP-Core is distributed in the hope that it will be useful, but WITHOUT #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License    #
+# for more details.                                                       #
+#                                                                         #
+# You should have received a copy of the GNU General Public License       #
+# along with STP-Core. If not, see <http://www.gnu.org/licenses/>.        #
+#                                                                         #
+###########################################################################
+
+#
+# This module assembles a TDF file out of several source files without
+# copying the images: the projections, flat and dark images spread over
+# several files (e.g. flat and dark images acquired apart or the rings of
+# a vertical multi-ring scan) are exposed as single datasets by means of
+# HDF5 virtual datasets. A dataset found in one file only is exposed with
+# an external link, i.e. its chunks and its contiguous storage are read
+# as they are (direct chunk reads and memory mapping keep working). The
+# source files are referenced with paths relative to the assembled file,
+# therefore the whole folder can be moved.
+#
+
+import h5py
+import numpy as np
+
+from os import linesep
+from os.path import abspath, dirname, relpath, splitext
+
+# pystp-specific:
+import stp_core.io.tdf as tdf
+import stp_core.io.stats as stats
+import stp_core.io.provenance as provenance
+
+# Datasets with projections, flat or dark images (all the other objects are copied as they are):
+IMAGE_DSETS = ['tomo', 'flat', 'dark', 'flat_post', 'dark_post', 'flat_after', 'dark_after',
+			   'exchange/data', 'exchange/data_white', 'exchange/data_dark']
+
+# Provenance dataset and the attribute with the filename prefix of the images of each dataset:
+PROVENANCE = 'provenance/detector_output'
+PREFIX_ATTRS = [('exchange/data', 'tomo_prefix'), ('exchange/data_white', 'flat_prefix'), 
+				('exchange/data_dark', 'dark_prefix')]
+
+def is_available ( ):
+	"""Check if virtual datasets are supported by the installed h5py and HDF5 
+	(HDF5 1.10 or later is required).
+
+	"""
+	return hasattr(h5py, 'VirtualLayout') and (h5py.version.hdf5_version_tuple >= (1, 10, 0))
+
+def _get_path ( filename, outfile ):
+	"""Get the path of the source file relative to the folder of the assembled file
+	(the absolute path if there is no relative path, e.g. on another drive).
+
+	"""
+	try:
+		return relpath(abspath(filename), dirname(abspath(outfile)))
+	except ValueError:
+		return abspath(filename)
+
+def _get_axis ( shape, order, along ):
+	"""Get the axis along which the sources are stacked: the projection axis ('tomo') 
+	or the sinogram axis ('sino') for images and the first axis for anything else.
+
+	"""
+	if (len(shape) != 3):
+		return 0
+	sino_axis, tomo_axis = tdf._get_axes(order)
+
+	return tomo_axis if (along == 'tomo') else sino_axis
+
+def _merge_attrs ( dset, srcs ):
+	"""Copy the attributes of the first source to the virtual dataset and merge the
+	statistics (min, max and histogram) of all the sources.
+
+	"""
+	for key in srcs[0].attrs.keys():
+		dset.attrs[key] = srcs[0].attrs[key]
+
+	# Statistics written by stp_core.io.stats (all the sources are required):
+	sts = [stats.read_stats(src) for src in srcs]
+	if all(st is not None for st in sts):
+		st = sts[0]
+		for other in sts[1:]:
+			st.merge(other)
+		stats.write_stats(dset, st)
+
+	# Legacy string attributes:
+	elif all(('min' in src.attrs) and ('max' in src.attrs) for src in srcs):
+		for key in ['mean', 'histogram', 'histogram_range']:
+			if key in dset.attrs:
+				del dset.attrs[key]
+		vals = [float(src.attrs['min']) for src in srcs]
+		dset.attrs['min'] = str(min(vals))
+		vals = [float(src.attrs['max']) for src in srcs]
+		dset.attrs['max'] = str(max(vals))
+
+def _write_log ( logfilename, line ):
+	"""Append a line to the log file (if any).
+
+	"""
+	if logfilename is not None:
+		log = open(logfilename,"a")
+		log.write(linesep + "\t" + line)
+		log.close()
+
+def _renumber ( name, prefix, new_prefix, shift ):
+	"""Replace the prefix of the filename and shift the number coded by its last four 
+	characters (before the extension), e.g. 'flat_0012.tif' -> 'flat_0032.tif'.
+
+	"""
+	root, ext = splitext(name)
+	number = int(root[-4:]) + shift
+
+	return new_prefix + root[len(prefix):-4] + str(number).zfill(4) + ext
+
+def merge_provenance ( f, filenames, sources, along='tomo', logfilename=None ):
+	"""Write to the assembled file the provenance dataset with the rows of all the 
+	source files. When the images are stacked along the projection axis, the numbers 
+	coded in the filenames of each file are shifted by the position of its images 
+	within the stacked dataset (and the prefixes and first index of the first file are
+	used), so that the flat and dark images of all the files are found. When the 
+	sinograms are stacked, the rows of the first file with each dataset are kept.
+
+	Parameters
+	----------
+	f : h5py File
+		The assembled file (opened for writing).
+	filenames : list
+		Paths of the source TDF files in the order the images are stacked.
+	sources : dict
+		Image datasets of the assembled file with the list of (filename, dsetname) 
+		tuples of their sources (as collected by assemble).
+	along : string, optional
+		'tomo' (default) or 'sino' (see assemble).
+	logfilename : string, optional
+		Absolute path of the log file where warnings are written.
+
+	"""
+	# Provenance table and attributes of each file (if any):
+	provs = {}
+	for filename in filenames:
+		fs = h5py.File(filename, 'r')
+		if PROVENANCE in fs:
+			provs[filename] = (fs[PROVENANCE][...], dict(fs[PROVENANCE].attrs.items()))
+		fs.close()
+	if (len(provs) == 0):
+		return
+
+	# Images that will not be listed:
+	for item, attr in PREFIX_ATTRS:
+		for filename, dsetname in sources.get(item, []):
+			if filename not in provs:
+				_write_log(logfilename, "Warning: no provenance in %s, its %s images are not listed." % 
+					(filename, item))
+
+	first = [filename for filename in filenames if filename in provs][0]
+	table, attrs = provs[first]
+	first_index = int(attrs.get('first_index', 0))
+
+	# Position of the images of each file within the stacked datasets:
+	offsets = {}
+	for item, attr in PREFIX_ATTRS:
+		start = 0
+		fs_list = sources.get(item, [])
+		for filename, dsetname in fs_list:
+			if (along == 'tomo'):
+				offsets[(item, filename)] = start
+				fs = h5py.File(filename, 'r')
+				start += tdf.get_nr_projs(tdf.TDFDataset(fs[dsetname]))
+				fs.close()
+			elif (filename == fs_list[0][0]):
+				offsets[(item, filename)] = 0
+
+	rows = []
+	for filename in filenames:
+		if filename not in provs:
+			continue
+		table_k, attrs_k = provs[filename]
+		names = provenance._as_str(table_k['filename'])
+		for j in range(0, table_k.shape[0]):
+			name = str(names[j])
+			for item, attr in PREFIX_ATTRS:
+				prefix = provenance._to_str(attrs_k.get(attr, ''))
+				if (len(prefix) > 0) and name.startswith(prefix):
+					if (item, filename) in offsets:
+						shift = offsets[(item, filename)] + first_index - int(attrs_k.get('first_index', 0))
+						name = _renumber(name, prefix, provenance._to_str(attrs.get(attr, prefix)), shift)
+						rows.append((name.encode('utf-8'), table_k['timestamp'][j]))
+					break
+			else:
+				# Rows of other images are taken from the first file only:
+				if (filename == first):
+					rows.append(tuple(table_k[j]))
+
+	dset = f.create_dataset(PROVENANCE, data=np.array(rows, dtype=table.dtype))
+	for key in attrs.keys():
+		dset.attrs[key] = attrs[key]
+
+def create_virtual ( f, name, sources, along='tomo' ):
+	"""Create a virtual dataset made of the specified source datasets stacked along 
+	the projection axis (e.g. projections acquired in several files) or along the 
+	sinogram axis (e.g. the rings of a vertical multi-ring scan). The sources must 
+	have the same data type, the same storage order (axes attribute) and the same 
+	size along the other axes. No image is copied.
+
+	Parameters
+	----------
+	f : h5py File
+		The assembled file (opened for writing).
+	name : string
+		Name of the virtual dataset within the file (e.g. 'exchange/data').
+	sources : list
+		List of (filename, dsetname) tuples with the source datasets in the order 
+		they have to be stacked.
+	along : string, optional
+		'tomo' to stack the projections (default) or 'sino' to stack the sinograms. 
+		Datasets that are not 3D are always stacked along their first axis.
+
+	Return value
+	----------
+	The virtual dataset.
+
+	Example (using h5py)
+	--------------------------
+	>>> f    = getHDF5('sample.tdf', 'w')
+	>>> dset = vds.create_virtual(f, 'exchange/data', [('ring_0.tdf', 'exchange/data'), 
+	>>>        ('ring_1.tdf', 'exchange/data')], 'sino')
+	>>> f.close()
+
+	"""
+	if not is_available():
+		raise ValueError("Virtual datasets are not supported by the installed h5py/HDF5.")
+
+	files = [h5py.File(filename, 'r') for filename, dsetname in sources]
+	try:
+		srcs = [fs[dsetname] for fs, (filename, dsetname) in zip(files, sources)]
+
+		# Check that the sources can be stacked:
+		order = tdf._parse_axes_attr(srcs[0])
+		axis = _get_axis(srcs[0].shape, order, along)
+		for src, (filename, dsetname) in zip(srcs, sources):
+			if (src.dtype != srcs[0].dtype) or (tdf._parse_axes_attr(src) != order) or \
+				(len(src.shape) != len(srcs[0].shape)):
+				raise ValueError("Dataset %s of %s cannot be stacked with %s." % (dsetname, filename, sources[0][0]))
+			if any((src.shape[i] != srcs[0].shape[i]) for i in range(len(src.shape)) if (i != axis)):
+				raise ValueError("Dataset %s of %s has shape %s (%s expected along the other axes)." % 
+					(dsetname, filename, str(src.shape), str(srcs[0].shape)))
+
+		# Map each source to its slab of the virtual dataset:
+		shape = list(srcs[0].shape)
+		shape[axis] = sum(src.shape[axis] for src in srcs)
+		layout = h5py.VirtualLayout(shape=tuple(shape), dtype=srcs[0].dtype)
+
+		start = 0
+		for src, (filename, dsetname) in zip(srcs, sources):
+			sel = [slice(None)] * len(shape)
+			sel[axis] = slice(start, start + src.shape[axis])
+			layout[tuple(sel)] = h5py.VirtualSource(_get_path(filename, f.filename), dsetname, shape=src.shape)
+			start += src.shape[axis]
+
+		dset = f.create_virtual_dataset(name, layout, fillvalue=0)
+		_merge_attrs(dset, srcs)
+
+		# Actual storage order of the sources (also for the ones of the legacy converters):
+		if ('axes' in dset.attrs):
+			tdf.set_axes_attr(dset, order)
+	finally:
+		for fs in files:
+			fs.close()
+
+	return dset
+
+def create_link ( f, name, filename, dsetname ):
+	"""Create an external link to a dataset of another file. The dataset is read with 
+	its own storage (chunks, compression) as if it were part of the file.
+
+	Parameters
+	----------
+	f : h5py File
+		The assembled file (opened for writing).
+	name : string
+		Name of the link within the file (e.g. 'exchange/data_white').
+	filename : string
+		Path of the source file.
+	dsetname : string
+		Name of the dataset within the source file.
+
+	"""
+	f[name] = h5py.ExternalLink(_get_path(filename, f.filename), dsetname)
+
+def assemble ( outfile, filenames, along='tomo', logfilename=None ):
+	"""Assemble the specified TDF files into a single TDF file without copying the 
+	images. Each image dataset (e.g. 'exchange/data', 'exchange/data_white' and 
+	'exchange/data_dark') found in several files becomes a virtual dataset with the 
+	images of all the files stacked in the specified order, while a dataset found in 
+	one file only is linked. The provenance tables of all the files are merged (see 
+	merge_provenance) while all the other objects (metadata, etc.) are copied from the 
+	first file that contains them.
+
+	Parameters
+	----------
+	outfile : string
+		Absolute path of the assembled TDF file (overwritten if it exists). The source
+		files are referenced relative to its folder.
+	filenames : list
+		Paths of the source TDF files in the order the images have to be stacked.
+	along : string, optional
+		'tomo' to stack the projections (default) or 'sino' to stack the sinograms, as
+		for a vertical multi-ring scan.
+	logfilename : string, optional
+		Absolute path of the log file where a line for each dataset is written.
+
+	Example
+	--------------------------
+	>>> vds.assemble('S:\\sample.tdf', ['S:\\sample_proj.tdf', 'S:\\sample_flat.tdf'])
+
+	"""
+	# Collect the objects of each file:
+	sources = {}
+	names = []
+	for filename in filenames:
+		fs = h5py.File(filename, 'r')
+		items = []
+		fs.visit(items.append)
+		for item in items:
+			if (item in IMAGE_DSETS) and isinstance(fs[item], h5py.Dataset):
+				sources.setdefault(item, []).append((filename, item))
+			elif item not in names:
+				names.append(item)
+		fs.close()
+
+	f = h5py.File(outfile, 'w')
+	try:
+		# Groups and other objects (groups are listed before their members):
+		for filename in filenames:
+			fs = h5py.File(filename, 'r')
+			if (filename == filenames[0]):
+				for key in fs.attrs.keys():
+					f.attrs[key] = fs.attrs[key]
+			for item in names:
+				if (item in f) or (item not in fs) or (item == PROVENANCE):
+					continue
+				if isinstance(fs[item], h5py.Group):
+					grp = f.create_group(item)
+					for key in fs[item].attrs.keys():
+						grp.attrs[key] = fs[item].attrs[key]
+				else:
+					fs.copy(item, f, name=item)
+			fs.close()
+
+		# Provenance of the images of all the files:
+		merge_provenance(f, filenames, sources, along, logfilename)
+
+		# Image datasets:
+		for item in IMAGE_DSETS:
+			if item not in sources:
+				continue
+			if (len(sources[item]) == 1):
+				create_link(f, item, sources[item][0][0], item)
+				line = "%s: linked to %s." % (item, sources[item][0][0])
+			else:
+				dset = create_virtual(f, item, sources[item], along)
+				line = "%s: %d files stacked as %s." % (item, len(sources[item]), str(dset.shape))
+			_write_log(logfilename, line)
+	finally:
+		f.close()
@@ -0,0 +1,441 @@
+﻿###########################################################################
+# (C) 2016 Elettra - Sincrotrone Trieste S.C.p.A.. All rights reserved.   #
+#                                                                         #
+#                                                                         #
+# This file is part of STP-Core, the Python core of SYRMEP Tomo Project,  #
+# a software tool for the reconstruction of experimental CT datasets.     #
+#                                                                         #
+# STP-Core is free software: you can redistribute it and/or modify it     #
+# under the terms of the GNU General Public License as published by the   #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# STP-Core is distributed in the hope that it will be useful, but WITHOUT #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License    #
+# for more details.                                                       #
+#                                                                         #
+# You should have received a copy of the GNU General Public License       #
+# along with STP-Core. If not, see <http://www.gnu.org/licenses/>.        #
+#                                                                         #
+###########################################################################
+
+#
+# The functions of this module let several worker processes write their
+# results to the same TDF (HDF5) file through a single writer process. The
+# workers push each image (or each row of a 1D dataset), or a slab of
+# consecutive images (or rows), into a bounded queue while the writer keeps the file open, coalesces consecutive indexes into
+# slab writes and flushes them either when enough images are pending or
+# periodically. Workers can also send whole chunks already compressed (see
+# stp_core.io.chunks.ChunkStacker): they are stored as they are with direct
+# chunk writes, so that compression does not happen within the writer. The
+# statistics of the images computed by each worker are merged and stored
+# once at the end. If a write fails, the data still sent by the workers are
+# discarded (so that they never block) and the writer exits with an error
+# code: the main process checks the exit codes of all the processes (see
+# wait).
+#
+
+import numpy as np
+
+from os import linesep
+from sys import exit
+from time import time
+from multiprocessing import Process, Queue
+from h5py import File as getHDF5
+
+try:
+	from queue import Empty
+except ImportError:
+	from Queue import Empty
+
+# pystp-specific:
+import stp_core.io.tdf as tdf
+import stp_core.io.stats as stats
+import stp_core.io.chunks as chunks
+
+QUEUE_SIZE = 32     # Max number of messages (images or slabs) waiting in the queue (it bounds the memory)
+FLUSH_IMAGES = 64   # Nr of pending images that triggers a write to disk
+FLUSH_TIME = 5.0    # Max time (in sec) between two writes to disk
+
+def _runs ( indexes ):
+	"""Split a sorted list of indexes into runs of consecutive indexes as a list of
+	(start, stop) tuples.
+
+	"""
+	runs = []
+	start = indexes[0]
+	prev = indexes[0]
+	for i in indexes[1:]:
+		if (i != prev + 1):
+			runs.append((start, prev + 1))
+			start = i
+		prev = i
+	runs.append((start, prev + 1))
+
+	return runs
+
+def _flush ( f, dsets, pending ):
+	"""Write all the pending data to the file with one write for each run of
+	consecutive indexes (or one direct write for each compressed chunk). The 
+	pending data are removed.
+
+	"""
+	for key in sorted(pending.keys()):
+		dsetname, kind = key
+		items = pending[key]
+		if dsetname not in dsets:
+			dsets[dsetname] = tdf.TDFDataset(f[dsetname])
+		dset = dsets[dsetname]
+
+		if (kind == 'chunk'):
+			chunks.write_chunks(dset, sorted(items.items()))
+			continue
+
+		for start, stop in _runs(sorted(items.keys())):
+			if (kind == 'row'):
+				block = np.array([items[i] for i in range(start, stop)], dtype=dset.dtype)
+				dset[start:stop] = block
+			else:
+				block = np.stack([items[i] for i in range(start, stop)])
+				if (kind == 'tomo'):
+					tdf.write_tomos(dset, start, block)
+				else: # (kind == 'sino'):
+					tdf.write_sinos(dset, start, block)
+
+	pending.clear()
+	f.flush()
+
+def _write_log ( logfilename, lock, lines ):
+	"""Append the specified lines to the log file.
+
+	"""
+	if logfilename is None:
+		return
+	if lock is not None:
+		lock.acquire()
+	try:
+		log = open(logfilename,"a")
+		for line in lines:
+			log.write(linesep + "\t" + line)
+		log.close()
+	finally:
+		if lock is not None:
+			lock.release()
+
+def _writer ( queue, outfile, nr_producers, logfilename, lock, flush_images, flush_time ):
+	"""Body of the writer process.
+
+	"""
+	f = getHDF5(outfile, 'a')
+	dsets = {}
+	pending = {}
+	dset_stats = {}
+	lines = []
+	nr_pending = 0
+	nr_chunks = 0
+	nr_done = 0
+	failed = False
+	t_flush = time()
+
+	while (nr_done < nr_producers):
+
+		# Wait for a message until the next scheduled flush:
+		try:
+			msg = queue.get(True, max(0.01, flush_time - (time() - t_flush)))
+		except Empty:
+			msg = False
+
+		if msg is None:
+			nr_done += 1
+		elif (msg is False) or failed:
+			# Nothing to do (or data discarded after an error):
+			pass
+		elif (msg[1] == 'stats'):
+			if msg[0] not in dset_stats:
+				dset_stats[msg[0]] = stats.RunningStats(msg[3].bins)
+			dset_stats[msg[0]].merge(msg[3])
+		elif (msg[1] == 'slab'):
+			dsetname, _, (kind, start), data, line = msg
+			items = pending.setdefault((dsetname, kind), {})
+			for k in range(0, len(data)):
+				items[start + k] = data[k]
+			if line is not None:
+				lines.append(line)
+			if (kind != 'row'):
+				nr_pending += len(data)
+		else:
+			dsetname, kind, index, data, line = msg
+			pending.setdefault((dsetname, kind), {})[index] = data
+			if line is not None:
+				lines.append(line)
+			if (kind == 'chunk'):
+				nr_chunks += 1
+			elif (kind != 'row'):
+				nr_pending += 1
+
+		if ((nr_pending + nr_chunks >= flush_images) or (time() - t_flush >= flush_time) or (nr_done == nr_producers)):
+			if (len(pending) > 0):
+				t0 = time()
+				try:
+					_flush(f, dsets, pending)
+					if (nr_chunks > 0):
+						lines.append("%d images and %d compressed chunks written (I/O: %0.3f sec)." % (nr_pending, 
+							nr_chunks, time() - t0))
+					elif (nr_pending > 0):
+						lines.append("%d images written (I/O: %0.3f sec)." % (nr_pending, time() - t0))
+				except Exception as e:
+					pending.clear()
+					failed = True
+					lines.append("Error: %s. Output file not written correctly." % str(e))
+			_write_log(logfilename, lock, lines)
+			lines = []
+			nr_pending = 0
+			nr_chunks = 0
+			t_flush = time()
+
+	# Store the statistics merged from all the producers:
+	try:
+		if not failed:
+			for dsetname in dset_stats:
+				stats.write_stats(f[dsetname], dset_stats[dsetname])
+	except Exception as e:
+		failed = True
+		_write_log(logfilename, lock, ["Error: %s" % str(e)])
+
+	f.close()
+
+	# Exit code of the process:
+	if failed:
+		exit(1)
+
+def start_writer ( outfile, nr_producers, logfilename=None, lock=None, queue_size=QUEUE_SIZE,
+				   flush_images=FLUSH_IMAGES, flush_time=FLUSH_TIME ):
+	"""Start the process that writes to the specified file all the data put in the
+	returned queue. The datasets have to be created in advance and the file has to
+	be closed by the other processes. The writer ends when all the producers have
+	called producer_done (in a finally clause, so that a failing producer does not 
+	leave the writer waiting). Its exit code is not zero if any data could not be 
+	written.
+
+	Parameters
+	----------
+	outfile : string
+		Absolute path of the TDF file.
+	nr_producers : int
+		Number of processes that will put data in the queue.
+	logfilename : string, optional
+		Absolute path of the log file where the lines sent with the data are written.
+	lock : multiprocessing.Lock, optional
+		Lock to acquire when writing to the log file (if shared with other processes).
+	queue_size : int, optional
+		Max number of messages in the queue. Producers wait when the queue is full.
+	flush_images : int, optional
+		Number of pending images that triggers a write to disk.
+	flush_time : float, optional
+		Max time in seconds between two writes to disk.
+
+	Return value
+	----------
+	The tuple (process, queue).
+
+	Example
+	--------------------------
+	>>> proc, queue = writer.start_writer('output.tdf', 1)
+	>>> try:
+	>>>     writer.put_image(queue, 'exchange/data', 'sino', 0, im)
+	>>> finally:
+	>>>     writer.producer_done(queue)
+	>>> proc.join()
+
+	"""
+	queue = Queue(queue_size)
+	proc = Process(target=_writer, args=(queue, outfile, nr_producers, logfilename, lock,
+		flush_images, flush_time))
+	proc.start()
+
+	return (proc, queue)
+
+def put_image ( queue, dsetname, kind, index, im, line=None ):
+	"""Send an image to the writer process.
+
+	Parameters
+	----------
+	queue : multiprocessing.Queue
+		Queue returned by start_writer.
+	dsetname : string
+		Name of the dataset within the file (e.g. 'exchange/data').
+	kind : string
+		'sino' if the image is a sinogram or 'tomo' if it is a projection.
+	index : int
+		Relative position of the image within the dataset.
+	im : array_like
+		Image data as numpy array.
+	line : string, optional
+		Line to write to the log file after the image has been written.
+
+	"""
+	queue.put((dsetname, kind, index, im, line))
+
+def put_images ( queue, dsetname, kind, start, block, line=None ):
+	"""Send a slab of images with consecutive indexes to the writer process with a 
+	single message.
+
+	Parameters
+	----------
+	queue : multiprocessing.Queue
+		Queue returned by start_writer.
+	dsetname : string
+		Name of the dataset within the file (e.g. 'exchange/data').
+	kind : string
+		'sino' if the images are sinograms or 'tomo' if they are projections.
+	start : int
+		Relative position of the first image within the dataset.
+	block : array_like
+		Images as numpy array stacked along the first axis (whatever the kind).
+	line : string, optional
+		Line to write to the log file after the images have been written.
+
+	"""
+	queue.put((dsetname, 'slab', (kind, start), block, line))
+
+def put_row ( queue, dsetname, index, row, line=None ):
+	"""Send a row (i.e. an element) of a 1D dataset (e.g. the provenance dataset) to
+	the writer process.
+
+	Parameters
+	----------
+	queue : multiprocessing.Queue
+		Queue returned by start_writer.
+	dsetname : string
+		Name of the dataset within the file (e.g. 'provenance/detector_output').
+	index : int
+		Position of the row within the dataset.
+	row : tuple
+		Value of the row (a tuple for compound data types).
+	line : string, optional
+		Line to write to the log file after the row has been written.
+
+	"""
+	queue.put((dsetname, 'row', index, row, line))
+
+def put_rows ( queue, dsetname, start, rows, line=None ):
+	"""Send consecutive rows of a 1D dataset (e.g. the provenance dataset) to the writer
+	process with a single message.
+
+	Parameters
+	----------
+	queue : multiprocessing.Queue
+		Queue returned by start_writer.
+	dsetname : string
+		Name of the dataset within the file (e.g. 'provenance/detector_output').
+	start : int
+		Position of the first row within the dataset.
+	rows : list
+		Values of the rows (tuples for compound data types).
+	line : string, optional
+		Line to write to the log file after the rows have been written.
+
+	"""
+	queue.put((dsetname, 'slab', ('row', start), rows, line))
+
+def put_chunk ( queue, dsetname, offsets, data, line=None ):
+	"""Send a compressed chunk to the writer process, which stores it as it is with a 
+	direct chunk write.
+
+	Parameters
+	----------
+	queue : multiprocessing.Queue
+		Queue returned by start_writer.
+	dsetname : string
+		Name of the dataset within the file (e.g. 'exchange/data').
+	offsets : tuple
+		Position of the first element of the chunk within the dataset.
+	data : bytes
+		Chunk with the filters of the dataset already applied (see 
+		stp_core.io.chunks.encode_chunks).
+	line : string, optional
+		Line to write to the log file after the chunk has been written.
+
+	"""
+	queue.put((dsetname, 'chunk', tuple(offsets), data, line))
+
+def put_stats ( queue, dsetname, st ):
+	"""Send the statistics of the images put in the queue by the calling producer
+	to the writer process. The statistics of all the producers are merged and
+	stored as attributes of the dataset when the writer ends.
+
+	Parameters
+	----------
+	queue : multiprocessing.Queue
+		Queue returned by start_writer.
+	dsetname : string
+		Name of the dataset within the file (e.g. 'exchange/data').
+	st : RunningStats
+		Statistics of the images (see stp_core.io.stats).
+
+	"""
+	queue.put((dsetname, 'stats', -1, st, None))
+
+def producer_done ( queue ):
+	"""Notify the writer process that the calling producer has no more data.
+
+	"""
+	queue.put(None)
+
+def wait ( workers, proc, queue, logfilename=None, lock=None ):
+	"""Wait for the producer processes and for the writer process and check their exit 
+	codes. If the writer ends before the producers (e.g. it cannot open the file), the 
+	producers are terminated instead of being left waiting on the full queue. Producers 
+	that crashed without calling producer_done are accounted for the writer.
+
+	Parameters
+	----------
+	workers : list
+		The producer processes (multiprocessing.Process), already started.
+	proc : multiprocessing.Process
+		Writer process returned by start_writer.
+	queue : multiprocessing.Queue
+		Queue returned by start_writer.
+	logfilename : string, optional
+		Absolute path of the log file where the errors are written.
+	lock : multiprocessing.Lock, optional
+		Lock to acquire when writing to the log file.
+
+	Return value
+	----------
+	True if all the processes ended successfully, False otherwise.
+
+	"""
+	# Wait for the producers (as long as the writer is alive):
+	for worker in workers:
+		while worker.is_alive():
+			worker.join(0.5)
+			if worker.is_alive() and not proc.is_alive():
+				for other in workers:
+					if other.is_alive():
+						other.terminate()
+				break
+	for worker in workers:
+		worker.join()
+
+	# Producers that did not end correctly (one more notification is harmless, as all
+	# the producers have ended):
+	nr_failed = 0
+	for worker in workers:
+		if (worker.exitcode != 0):
+			nr_failed += 1
+			if proc.is_alive():
+				producer_done(queue)
+
+	proc.join()
+
+	lines = []
+	if (nr_failed > 0):
+		lines.append("Error: %d of %d processes failed. Output file not written correctly." % (nr_failed, 
+			len(workers)))
+	if (proc.exitcode != 0):
+		lines.append("Error: the output file could not be written correctly.")
+	_write_log(logfilename, lock, lines)
+
+	return (len(lines) == 0)
@@ -0,0 +1,184 @@
+﻿###########################################################################
+# (C) 2016 Elettra - Sincrotrone Trieste S.C.p.A.. All rights reserved.   #
+#                                                                         #
+#                                                                         #
+# This file is part of STP-Core, the Python core of SYRMEP Tomo Project,  #
+# a software tool for the reconstruction of experimental CT datasets.     #
+#                                                                         #
+# STP-Core is free software: you can redistribute it and/or modify it     #
+# under the terms of the GNU General Public License as published by the   #
+# Free Software Foundation, either version 3 of the License, or (at your  #
+# option) any later version.                                              #
+#                                                                         #
+# STP-Core is distributed in the hope that it will be useful, but WITHOUT #
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or   #
+# FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License    #
+# for more details.                                                       #
+#                                                                         #
+# You should have received a copy of the GNU General Public License       #
+# along with STP-Core. If not, see <http://www.gnu.org/licenses/>.        #
+#                                                                         #
+###########################################################################
+
+#
+# This module finds the defective pixels of the detector (dead, i.e. without
+# signal, and hot, i.e. with an anomalous dark current) once from the flat
+# and dark images and stores for each of them the closest good pixels of the
+# same detector row together with the weights of the linear interpolation.
+# The correction of a slab of sinograms is then a gather of the good pixels
+# plus a weighted sum on the defective pixels only.
+#
+
+from numpy import float32, int64, arange, asarray, empty, full, zeros, ndarray
+from numpy import median, absolute, isfinite, nonzero, where, maximum, minimum
+
+HOT_SIGMA = 10.0   # Dark pixels above median + HOT_SIGMA * (robust std) are hot
+
+def _find_bad ( im_flat, im_dark, hot_sigma ):
+	"""Get the boolean mask of the defective pixels for a pair of flat and dark images.
+
+	"""
+	flat = asarray(im_flat, dtype=float32)
+	dark = asarray(im_dark, dtype=float32)
+
+	# Dead pixels (no signal above the dark current) and invalid values:
+	bad = ~(flat > 0.0) | ~(flat > dark) | ~isfinite(dark)
+
+	# Hot pixels of the dark image (robust estimate of the standard deviation):
+	good = dark[~bad]
+	if (good.size > 0):
+		med = median(good)
+		mad = 1.4826 * median(absolute(good - med))
+		if (mad > 0.0):
+			bad |= (dark > med + hot_sigma * mad)
+
+	return bad
+
+
+class DefectMap(object):
+	"""Map of the defective pixels of the detector. For each defective pixel it stores
+	the detector row and column, the columns of the closest good pixels on the left and
+	on the right within the same row and the weight of the left one for the linear
+	interpolation (pixels at the borders get the value of the closest good pixel). Rows
+	without good pixels are left as they are.
+
+	Parameters
+	----------
+	bad : array_like
+		Boolean image (detector rows x columns) with True for the defective pixels.
+
+	"""
+	def __init__(self, bad):
+
+		bad = asarray(bad, dtype=bool)
+		self.shape = bad.shape
+		cols = arange(bad.shape[1])
+
+		# Closest good column on the left and on the right of each pixel (-1 and
+		# nr of columns if not found):
+		left = maximum.accumulate(where(bad, -1, cols[None,:]), axis=1)
+		right = minimum.accumulate(where(bad, bad.shape[1], cols[None,:])[:,::-1], axis=1)[:,::-1]
+
+		rows, cols = nonzero(bad)
+		left = left[rows, cols]
+		right = right[rows, cols]
+
+		# Rows without good pixels are skipped:
+		keep = (left >= 0) | (right < bad.shape[1])
+		rows, cols, left, right = rows[keep], cols[keep], left[keep], right[keep]
+
+		# Borders of the row:
+		left = where(left < 0, right, left)
+		right = where(right >= bad.shape[1], left, right)
+
+		w = empty(left.shape, dtype=float32)
+		dist = right - left
+		inner = (dist > 0)
+		w[inner] = (right[inner] - cols[inner]) / dist[inner].astype(float32)
+		w[~inner] = 1.0
+
+		self.rows = rows
+		self.cols = cols
+		self.left = left
+		self.right = right
+		self.w_left = w
+
+	def __len__(self):
+		return self.rows.size
+
+	def correct(self, block, rows):
+		"""Correct the defective pixels of a slab of sinograms (modified in place).
+
+		Parameters
+		----------
+		block : array_like
+			Sinograms stacked along the first axis as a float32 numpy array with shape
+			(nr_sinos, nr_projs, det_size).
+		rows : array_like
+			Index of each sinogram with reference to the height of a projection.
+
+		Return value
+		----------
+		The corrected block.
+
+		"""
+		rows = asarray(rows, dtype=int64)
+		if (self.rows.size == 0) or (rows.size == 0):
+			return block
+
+		# Position within the slab of the defective pixels of the required rows:
+		pos = full(self.shape[0], -1, dtype=int64)
+		pos[rows] = arange(rows.size)
+		k = pos[self.rows]
+		sel = nonzero(k >= 0)[0]
+		if (sel.size == 0):
+			return block
+		k = k[sel]
+
+		# One gather of the good pixels plus a weighted sum:
+		w = self.w_left[sel][:,None]
+		vals = w * block[k,:,self.left[sel]] + (1.0 - w) * block[k,:,self.right[sel]]
+		block[k,:,self.cols[sel]] = vals
+
+		return block
+
+
+def find_defects ( plan, hot_sigma=HOT_SIGMA ):
+	"""Find the defective (dead and hot) pixels of the detector from the flat and dark
+	images of the structure created by extract_flatdark. A pixel is defective if it is
+	defective in any of the available pairs of flat and dark images.
+
+	Parameters
+	----------
+	plan : structure
+		Structure created by the extract_flatdark function (see extract_flatdark.py).
+	hot_sigma : float, optional
+		Threshold for the hot pixels of the dark images as multiple of the (robust)
+		standard deviation above the median (default = HOT_SIGMA).
+
+	Return value
+	----------
+	A DefectMap (None if there are no flat images).
+
+	Example (using h5py)
+	--------------------------
+	>>> plan    = extract_flatdark(f_in, True, 'logfile.txt')
+	>>> defects = find_defects(plan)
+	>>> plan    = FlatFieldPlan(plan, True, True, 900, 0, 0, defects=defects)
+
+	"""
+	pairs = [(plan['im_flat'], plan['im_dark']), (plan['im_flat_after'], plan['im_dark_after'])]
+
+	bad = None
+	for im_flat, im_dark in pairs:
+		if not isinstance(im_flat, ndarray):
+			continue
+		if not isinstance(im_dark, ndarray):
+			im_dark = zeros(im_flat.shape, dtype=float32)
+		curr = _find_bad(im_flat, im_dark, hot_sigma)
+		bad = curr if bad is None else (bad | curr)
+
+	if bad is None:
+		return None
+
+	return DefectMap(bad)
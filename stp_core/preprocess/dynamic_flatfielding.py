@@ -41,7 +41,7 @@ from scipy.optimize import fmin
 from scipy.ndimage.filters import median_filter
 from warnings import simplefilter
 
-from io.tdf import get_det_size, get_nr_projs, get_nr_sinos, read_tomo
+from io.tdf import get_det_size, get_nr_projs, get_nr_sinos, read_tomo, TDFDataset
 
 def _parallelAnalysis(ff, n):
 
@@ -174,6 +174,9 @@ def dff_prepare_plan(white_dset, repetitions, dark):
 	in X-ray imaging", Optics Express, 23(11), 27975-27989, 2015.
 
 	"""	
+	# Read the flat images along the right axis of the dataset:
+	white_dset = TDFDataset(white_dset)
+
 	# Get dimensions of flat-field (or white-field) images:
 	num_flats = get_nr_projs(white_dset)
 	num_rows  = get_nr_sinos(white_dset)
@@ -25,85 +25,217 @@
 # Last modified: July, 8th 2016
 #
 
-from sys import maxint
 from os import linesep
-from os.path import splitext
-from time import time, mktime
-from datetime import datetime
+
+from multiprocessing import Pool
 
 from h5py import File as getHDF5
-from numpy import float32, ndarray, zeros
+from numpy import float32, float64, ndarray, zeros, full, empty, arange, cumsum, sqrt, maximum, minimum, where
 
-from stp_core.io.tdf import get_nr_projs, read_tomo
+from stp_core.io.tdf import get_nr_projs, get_nr_sinos, get_det_size, read_tomo, read_tomos, TDFDataset
 
+# pystp-specific:
+import stp_core.io.provenance as provenance
 
+REDUCE_METHODS = ['mean', 'median', 'sigmaclip']
+MAX_BYTES = 268435456     # Maximum size in bytes of the images read at once (per process)
+CLIP_SIGMA = 3.0          # Threshold of the sigma-clipped mean (nr of standard deviations)
+CLIP_ITERS = 5            # Max nr of iterations of the sigma-clipped mean
 
-def _medianize_withprovenance(dset, provenance_dset, tomoprefix, darkorflatprefix, flagafter):	
-	
-	# Get minimum and max timestamps for projection
-	min_t  = maxint
-	max_t = -1
-	
-	for i in range(0, provenance_dset.shape[0]):  
-		if provenance_dset["filename", i].startswith(tomoprefix):
-			t = int(mktime(datetime.strptime(provenance_dset["timestamp", i], "%Y-%m-%d %H:%M:%S.%f").timetuple()))							
-			if (t < min_t):
-				min_t = t
-			if (t > max_t):
-				max_t = t	
-
-	flag_first = False
-	ct = 0	
-
-	im = read_tomo(dset,0).astype(float32)
-		
-	for i in range(0, provenance_dset.shape[0]):  
-		if provenance_dset["filename", i].startswith(darkorflatprefix):
-			t = int(mktime(datetime.strptime(provenance_dset["timestamp", i], "%Y-%m-%d %H:%M:%S.%f").timetuple()))							
+def _runs ( indexes ):
+	"""Split a list of indexes into runs of consecutive indexes (in the same order) as 
+	a list of (start, stop) tuples.
 
-			if flagafter:
-				if (t > max_t):				
-				
-					# Get "angle":
-					name = splitext(provenance_dset["filename", i])[0]
-					idx = int(name[-4:])
-					idx = idx - int(provenance_dset.attrs['first_index'])
-					
-					# Get image and sum it to the series:
-					if not flag_first:
-						flag_first = True					
-						im = read_tomo(dset,idx).astype(float32)
-						ct = ct + 1
-					else:
-						im = im + read_tomo(dset,idx).astype(float32) 
-						ct = ct + 1
-			else:
-				if (t <= min_t):					
-				
-					# Get "angle":
-					name = splitext(provenance_dset["filename", i])[0]
-					idx = int(name[-4:])
-					idx = idx - int(provenance_dset.attrs['first_index'])
-					
-					# Get image and sum it to the series:
-					if not flag_first:
-						flag_first = True					
-						im = read_tomo(dset,idx).astype(float32)					
-					else:
-						im = im + read_tomo(dset,idx).astype(float32) 
-					
-					ct = ct + 1
-	
+	"""
+	runs = []
+	start = indexes[0]
+	prev = indexes[0]
+	for i in indexes[1:]:
+		if (i != prev + 1):
+			runs.append((start, prev + 1))
+			start = i
+		prev = i
+	runs.append((start, prev + 1))
+
+	return runs
+
+def _clip_interval ( w, cs, cs2, sigma ):
+	"""Get the interval [lo, hi) of the values of each (sorted) row of w that are within 
+	sigma standard deviations from the median, iteratively.
+
+	"""
+	m, n = w.shape
+	r = arange(m)
+	lo = zeros(m, dtype=int)
+	hi = full(m, n, dtype=int)
+
+	for it in range(0, CLIP_ITERS):
+
+		# Median and standard deviation of the values within the interval:
+		k = hi - lo
+		mid = lo + (k - 1) // 2
+		med = where(k % 2 == 1, w[r, mid], (w[r, mid] + w[r, minimum(mid + 1, n - 1)]) / 2)
+		mean = (cs[r, hi] - cs[r, lo]) / k
+		std = sqrt(maximum((cs2[r, hi] - cs2[r, lo]) / k - mean * mean, 0.0))
+
+		# Values farther than sigma standard deviations are rejected:
+		new_lo = maximum(lo, (w < (med - sigma * std)[:,None]).sum(axis=1))
+		new_hi = minimum(hi, (w <= (med + sigma * std)[:,None]).sum(axis=1))
+		ok = (new_hi > new_lo)
+		new_lo = where(ok, new_lo, lo)
+		new_hi = where(ok, new_hi, hi)
+		if (new_lo == lo).all() and (new_hi == hi).all():
+			break
+		lo, hi = new_lo, new_hi
+
+	return lo, hi
+
+def _reduce_block ( block, method, sigma ):
+	"""Reduce a stack of (partial) images along the first axis with the specified method.
+
+	"""
+	if (method == 'mean'):
+		# Values are accumulated sequentially in single precision:
+		return (block.sum(axis=0, dtype=float32) / block.shape[0]).astype(float32)
+
+	# The values of each pixel are sorted once (as contiguous rows):
+	n = block.shape[0]
+	w = block.reshape(n, -1).T.copy()
+	w.sort(axis=1)
+
+	if (method == 'median'):
+		if (n % 2 == 1):
+			im = w[:, n // 2]
+		else:
+			im = (w[:, n // 2 - 1] + w[:, n // 2]) / 2
+
+	else: # (method == 'sigmaclip'):
+		# Mean of the values within sigma standard deviations from the median (zingers 
+		# and outlier images are rejected), with the sums taken from prefix sums:
+		cs = zeros((w.shape[0], n + 1), dtype=float64)
+		cs2 = zeros((w.shape[0], n + 1), dtype=float64)
+		cumsum(w, axis=1, dtype=float64, out=cs[:, 1:])
+		cumsum(w.astype(float64) ** 2, axis=1, out=cs2[:, 1:])
+		lo, hi = _clip_interval(w, cs, cs2, sigma)
+		r = arange(w.shape[0])
+		im = (cs[r, hi] - cs[r, lo]) / (hi - lo)
+
+	return im.reshape(block.shape[1:]).astype(float32)
+
+def _reduce_band ( dset, runs, nr_imgs, start, stop, method, sigma ):
+	"""Reduce the rows [start, stop) of the selected images of the dataset.
+
+	"""
+	block = empty((nr_imgs, stop - start, get_det_size(dset)), dtype=float32)
+	pos = 0
+	for first, last in runs:
+		block[pos:pos + last - first] = read_tomos(dset, first, last, rows=slice(start, stop))
+		pos += last - first
+
+	return _reduce_block(block, method, sigma)
+
+def _reduce_band_job ( args ):
+	"""Body of the worker processes: open the file and reduce a band of rows.
+
+	"""
+	filename, dsetname, order, runs, nr_imgs, start, stop, method, sigma = args
+	f = getHDF5(filename, 'r')
+	try:
+		return _reduce_band(TDFDataset(f[dsetname], order), runs, nr_imgs, start, stop, method, sigma)
+	finally:
+		f.close()
+
+def reduce_images ( dset, indexes=None, method='mean', sigma=CLIP_SIGMA, max_bytes=MAX_BYTES, nr_procs=1 ):
+	"""Reduce a series of flat (or dark) images into a single reference image. Images 
+	are read in slabs restricted to bands of detector rows, so that the memory required 
+	is bounded by max_bytes (per process) whatever the number of images is. The bands 
+	can be processed by several processes.
+
+	Parameters
+	----------
+	dset : HDF5 dataset 
+		HDF5 dataset with the images as returned by the h5py API (or TDFDataset).
+	indexes : list of int, optional
+		Relative positions of the images to reduce (default = all).
+	method : string, optional
+		'mean' (default), 'median' or 'sigmaclip' (mean of the values within sigma 
+		standard deviations from the median, iteratively). Median and sigma-clipped mean
+		reject zingers and outlier images.
+	sigma : float, optional
+		Threshold of the sigma-clipped mean (default = CLIP_SIGMA).
+	max_bytes : int, optional
+		Maximum size in bytes of the images read at once by each process (default = 256 MB).
+	nr_procs : int, optional
+		Number of processes reducing the bands of rows (default = 1).
+
+	Return value
+	----------
+	The reference image as float32 numpy array or -1 if there are no images. A ValueError 
+	is raised for an unknown method.
+
+	Example (using h5py)
+	--------------------------
+	>>> f       = getHDF5('dataset.tdf', 'r')
+	>>> im_flat = reduce_images(f['exchange/data_white'], method='median', nr_procs=4)
+
+	"""
+	if method not in REDUCE_METHODS:
+		raise ValueError("Reduction method '%s' not supported (use %s)." % (method, ", ".join(REDUCE_METHODS)))
+
+	dset = TDFDataset(dset)
+	if indexes is None:
+		indexes = list(range(0, get_nr_projs(dset)))
+	indexes = [int(i) for i in indexes]
+
+	# Return error if there are no images:
+	if (len(indexes) == 0):
+		return -1 # Error:
+
+	runs = _runs(indexes)
+	nr_rows = get_nr_sinos(dset)
+	det_size = get_det_size(dset)
+
+	# Rows of each band (median and sigma clipping need a sorted copy, the latter also 
+	# the prefix sums in double precision):
+	factor = {'mean': 1, 'median': 2}.get(method, 6)
+	row_bytes = len(indexes) * det_size * 4 * factor
+	band = max(1, min(nr_rows, max_bytes // max(row_bytes, 1)))
+	bands = [(start, min(start + band, nr_rows)) for start in range(0, nr_rows, band)]
+
+	im = empty((nr_rows, det_size), dtype=float32)
+	if (nr_procs > 1) and (len(bands) > 1):
+		jobs = [(dset.file.filename, dset.name, dset.order, runs, len(indexes), start, stop, method, sigma) 
+			for start, stop in bands]
+		pool = Pool(min(nr_procs, len(bands)))
+		try:
+			for (start, stop), res in zip(bands, pool.imap(_reduce_band_job, jobs)):
+				im[start:stop] = res
+		finally:
+			pool.close()
+			pool.join()
+	else:
+		for start, stop in bands:
+			im[start:stop] = _reduce_band(dset, runs, len(indexes), start, stop, method, sigma)
+
+	return im
+
+
+
+def _medianize_withprovenance(dset, provenance_dset, tomoprefix, darkorflatprefix, flagafter, method='mean', nr_procs=1):	
 	
-	if ( ct > 0 ):
-		im = im / ct
-		return im.astype(float32)  	
+	# Read the images along the right axis of the dataset:
+	dset = TDFDataset(dset)
+
+	# Get the "angles" of the images acquired before (or after) the projections from
+	# the index of the provenance dataset (built once per file):
+	indexes = provenance.get_index(provenance_dset, tomoprefix).select(darkorflatprefix, flagafter)
 	
-	else:		
-		return -1 # Error:
+	# Reduce the selected images (-1 if none):
+	return reduce_images(dset, indexes, method, nr_procs=nr_procs)
 
-def _medianize(dset):
+def _medianize(dset, method='mean', nr_procs=1):
 
+	dset = TDFDataset(dset)
 	num_imgs = get_nr_projs ( dset )
 
 	# Return error if there are no images:
@@ -114,26 +246,10 @@ def _medianize(dset):
 	elif (num_imgs == 1):
 		return read_tomo(dset,0).astype(float32)
 	
-	# Do the median of all the images if there is more than one image:
-	if num_imgs > 1:
-
-		# Get first image:
-		im = read_tomo(dset,0).astype(float32)
-		
-		# Read all the remaining files (if any) and save it in a volume:
-		for i in range(1, num_imgs):                 
-		
-			# Read i-th image from input folder:
-			#im = im + dset[i,:,:].astype(float32)   
-			im = im + read_tomo(dset,i).astype(float32) 
-		
-		# Medianize volume along the third-dimension:
-		im = im / num_imgs
-
-		# Reshape output and return:
-		return im.astype(float32)  	
+	# Reduce all the images if there is more than one image:
+	return reduce_images(dset, None, method, nr_procs=nr_procs)
 
-def extract_flatdark(f_in, flat_end, logfilename):
+def extract_flatdark(f_in, flat_end, logfilename, method='mean', nr_procs=1):
 	"""Extract the flat and dark reference images to be used during the pre-processing step.
 
 	Parameters
@@ -146,6 +262,13 @@ def extract_flatdark(f_in, flat_end, logfilename):
 
 	logilename : string
 		Absolute file of a log text file where infos are appended.
+
+	method : string, optional
+		Reduction of each series of flat/dark images: 'mean' (default), 'median' or 
+		'sigmaclip' (see reduce_images).
+
+	nr_procs : int, optional
+		Number of processes reducing each series of images (default = 1).
 	
 	"""
 	skip_flat = False
@@ -176,7 +299,7 @@ def extract_flatdark(f_in, flat_end, logfilename):
 
 	# Get dark images:
 	if "/dark" in f_in:
-		im_dark = _medianize(f_in['dark'])			
+		im_dark = _medianize(f_in['dark'], method, nr_procs)			
 			
 		if not isinstance(im_dark, ndarray):
 			log = open(logfilename,"a")
@@ -195,7 +318,7 @@ def extract_flatdark(f_in, flat_end, logfilename):
 	elif "/exchange/data_dark" in f_in:
 		
 		# Get the dark files acquired before the projections:	
-		im_dark = _medianize_withprovenance(f_in['exchange/data_dark'], f_in['provenance/detector_output'], tomoprefix, darkprefix, False)		
+		im_dark = _medianize_withprovenance(f_in['exchange/data_dark'], f_in['provenance/detector_output'], tomoprefix, darkprefix, False, method, nr_procs)		
 			
 		if not isinstance(im_dark, ndarray):
 			log = open(logfilename,"a")
@@ -225,7 +348,7 @@ def extract_flatdark(f_in, flat_end, logfilename):
 	# Get flat images:		
 	if "/flat" in f_in:
 		
-		im_flat = _medianize(f_in['flat'])	
+		im_flat = _medianize(f_in['flat'], method, nr_procs)	
 			
 		if not isinstance(im_flat, ndarray):
 			log = open(logfilename,"a")
@@ -243,7 +366,7 @@ def extract_flatdark(f_in, flat_end, logfilename):
 	elif "/exchange/data_white" in f_in:
 
 		# Get the flat files acquired before the projections:						
-		im_flat = _medianize_withprovenance(f_in['exchange/data_white'], f_in['provenance/detector_output'], tomoprefix, flatprefix, False)
+		im_flat = _medianize_withprovenance(f_in['exchange/data_white'], f_in['provenance/detector_output'], tomoprefix, flatprefix, False, method, nr_procs)
 			
 		if not isinstance(im_flat, ndarray):
 			log = open(logfilename,"a")
@@ -284,7 +407,7 @@ def extract_flatdark(f_in, flat_end, logfilename):
 			
 			if "/dark_post" in f_in:
 				
-				im_dark_after = _medianize(f_in['dark_post'])			
+				im_dark_after = _medianize(f_in['dark_post'], method, nr_procs)			
 					
 				if not isinstance(im_dark_after, ndarray):
 					log = open(logfilename,"a")
@@ -302,7 +425,7 @@ def extract_flatdark(f_in, flat_end, logfilename):
 						
 			elif "/dark_after" in f_in:
 				
-				im_dark_after = _medianize(f_in['dark_after'])			
+				im_dark_after = _medianize(f_in['dark_after'], method, nr_procs)			
 					
 				if not isinstance(im_dark_after, ndarray):
 					log = open(logfilename,"a")
@@ -320,7 +443,7 @@ def extract_flatdark(f_in, flat_end, logfilename):
 						
 			elif "/exchange/data_dark" in f_in:			
 			
-				im_dark_after = _medianize_withprovenance(f_in['exchange/data_dark'], f_in['provenance/detector_output'], tomoprefix, darkprefix, True)		
+				im_dark_after = _medianize_withprovenance(f_in['exchange/data_dark'], f_in['provenance/detector_output'], tomoprefix, darkprefix, True, method, nr_procs)		
 					
 				if not isinstance(im_dark_after, ndarray):
 					log = open(logfilename,"a")
@@ -348,7 +471,7 @@ def extract_flatdark(f_in, flat_end, logfilename):
 					
 			if "/flat_post" in f_in:
 				
-				im_flat_after = _medianize(f_in['flat_post'])	
+				im_flat_after = _medianize(f_in['flat_post'], method, nr_procs)	
 					
 				if not isinstance(im_flat_after, ndarray):
 					log = open(logfilename,"a")
@@ -371,7 +494,7 @@ def extract_flatdark(f_in, flat_end, logfilename):
 						
 			elif "/flat_after" in f_in:
 				
-				im_flat_after = _medianize(f_in['flat_after'])	
+				im_flat_after = _medianize(f_in['flat_after'], method, nr_procs)	
 					
 				if not isinstance(im_flat_after, ndarray):
 					log = open(logfilename,"a")
@@ -394,7 +517,7 @@ def extract_flatdark(f_in, flat_end, logfilename):
 						
 			elif "/exchange/data_white" in f_in:
 				
-				im_flat_after = _medianize_withprovenance(f_in['exchange/data_white'], f_in['provenance/detector_output'], tomoprefix, flatprefix, True)		
+				im_flat_after = _medianize_withprovenance(f_in['exchange/data_white'], f_in['provenance/detector_output'], tomoprefix, flatprefix, True, method, nr_procs)		
 					
 				if not isinstance(im_flat_after, ndarray):
 					log = open(logfilename,"a")
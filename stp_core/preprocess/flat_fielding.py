@@ -28,6 +28,8 @@
 from numpy import float32, finfo, ndarray, isnan
 from numpy import median, amin, amax, nonzero
 from numpy import tile, concatenate, reshape, interp
+from numpy import arange, asarray, empty, newaxis, subtract, divide
+from numpy import bincount, searchsorted, maximum, minimum, cumsum, where, inf, nan
 
 from scipy.ndimage.filters import median_filter
 
@@ -53,29 +55,340 @@ def _dead_correction (im):
 
 	return im 
 
-def _afterglow_correction (im):
-	"""Correct dead pixels by adaptive median filtering
+def _interp_slab (im_f, bad, size):
+	"""Replace the bad elements of a flattened stack of images of the specified size 
+	(nr of pixels) by linear interpolation between the closest good elements of the 
+	same image, i.e. as if numpy.interp were called for each image.
+
+	Return value
+	----------
+	A boolean array with True for the images having bad elements but no good ones 
+	(they are left as they are).
+
+	"""
+	nr_imgs = im_f.size // size
+	x = nonzero(bad)[0]
+	xp = nonzero(~bad)[0]
+	failed = (bincount(x // size, minlength=nr_imgs) > 0) & (bincount(xp // size, minlength=nr_imgs) == 0)
+	if (x.size == 0) or (xp.size == 0):
+		return failed
+
+	im_f[x] = interp(x, xp, im_f[xp])
+
+	# Elements whose closest good elements belong to other images get the value 
+	# of the closest good element of their own image (as numpy.interp does):
+	img = x // size
+	pos = searchsorted(xp, x)
+	left = xp[maximum(pos - 1, 0)]
+	right = xp[minimum(pos, xp.size - 1)]
+	left_out = (pos == 0) | (left // size != img)
+	right_out = (pos == xp.size) | (right // size != img)
+	sel = left_out & ~right_out
+	im_f[x[sel]] = im_f[right[sel]]
+	sel = right_out & ~left_out
+	im_f[x[sel]] = im_f[left[sel]]
+
+	return failed
+
+def _dead_correction_slab (block):
+	"""Correct dead pixels (zeros and NaNs) of a stack of images (e.g. sinograms) as 
+	_dead_correction does for each image.
 
 	Parameters
 	----------
-	im : array_like
-		Image data (sinogram) as numpy array. 
+	block : array_like
+		Images stacked along the first axis as a C-contiguous float32 numpy array 
+		(modified in place).
+
+	Return value
+	----------
+	A boolean array with True for the images that cannot be corrected (no valid pixels).
+
+	"""
+	size = block[0].size
+	block[ block < 0.0 ] = 0.0
+	im_f = block.reshape(-1)
+
+	failed = _interp_slab(im_f, (im_f == 0), size)
+	failed |= _interp_slab(im_f, isnan(im_f), size)
+
+	return failed
+
+def _afterglow_correction_slab (block):
+	"""Correct dead pixels by adaptive median filtering each image of the stack.
+
+	Parameters
+	----------
+	block : array_like
+		Images (e.g. sinograms) stacked along the first axis as float32 numpy array 
+		(modified in place). 
 	
 	"""
+	eps = finfo(float32).eps
 
-	# Quick and dirty compensation for detector afterglow (it works well for isolated spots):
+	# Quick and dirty compensation for detector afterglow (it works well for isolated spots),
+	# only the images with negative values are filtered:
 	size_ct = 3
-	while ( ( float(amin(im)) <  0.0) and (size_ct <= 7) ):			
-		im_f = median_filter(im, size_ct)
-		im[im < 0.0] = im_f[im < 0.0]					
+	sel = nonzero(amin(block, axis=(1,2)) < 0.0)[0]
+	while ( (sel.size > 0) and (size_ct <= 7) ):
+		sub = block[sel]
+		sub_f = median_filter(sub, (1, size_ct, size_ct))
+		neg = (sub < 0.0)
+		sub[neg] = sub_f[neg]
+		block[sel] = sub
+		sel = sel[amin(sub, axis=(1,2)) < 0.0]
 		size_ct += 2
 
-	# Compensate negative values by replacing them with the average value of the image:		
-	if (float(amin(im)) <  finfo(float32).eps):			
-		rplc_value = sum(im [im > finfo(float32).eps]) / sum(im > finfo(float32).eps)		
-		im [im < finfo(float32).eps] = rplc_value
+	return _mean_replacement(block)
+
+def _reflect (idx, n):
+	"""Map the indexes outside [0, n) as the 'reflect' mode of scipy.ndimage does.
+
+	"""
+	idx = where(idx < 0, -idx - 1, idx)
+	return where(idx >= n, 2 * n - idx - 1, idx)
+
+def _afterglow_correction_local (block):
+	"""Correct negative (and NaN) pixels of each image of the stack by adaptive median 
+	filtering computed only in the neighbourhood of those pixels. The result is the 
+	same of _afterglow_correction_slab for images without NaNs.
+
+	Parameters
+	----------
+	block : array_like
+		Images (e.g. sinograms) stacked along the first axis as float32 numpy array 
+		(modified in place). 
+	
+	"""
+	k, r, c = nonzero(~(block >= 0.0))
+	block[k, r, c] = where(isnan(block[k, r, c]), -inf, block[k, r, c])
+
+	# Median of a growing window around the pixels still negative:
+	size_ct = 3
+	while ( (k.size > 0) and (size_ct <= 7) ):
+		offs = arange(-(size_ct // 2), size_ct // 2 + 1)
+		rr = _reflect(r[:,newaxis,newaxis] + offs[newaxis,:,newaxis], block.shape[1])
+		cc = _reflect(c[:,newaxis,newaxis] + offs[newaxis,newaxis,:], block.shape[2])
+		vals = median(block[k[:,newaxis,newaxis], rr, cc].reshape(k.size, -1), axis=1)
+		block[k, r, c] = vals
+		neg = (vals < 0.0)
+		k, r, c = k[neg], r[neg], c[neg]
+		size_ct += 2
+
+	return _mean_replacement(block)
+
+def _mean_replacement (block):
+	"""Compensate the values below the machine epsilon of each image of the stack by 
+	replacing them with the average value of the image (accumulated sequentially in 
+	single precision).
+
+	"""
+	eps = finfo(float32).eps
+
+	for k in nonzero(amin(block, axis=(1,2)) < eps)[0]:
+		im = block[k]
+		valid = (im > eps)
+		nr_valid = int(valid.sum())
+		if (nr_valid > 0):
+			im[im < eps] = cumsum(im[valid], dtype=float32)[-1] / nr_valid
+
+	return block
+
+class FlatFieldPlan(object):
+	"""Flat fielding plan compiled once from the structure created by extract_flatdark
+	for a given configuration (flat_end, half-half mode and normalization windows). For
+	each row of the detector it stores the dark row and the denominator (flat - dark) 
+	with the dead pixels of the flat already corrected, both as float32 arrays, as well 
+	as the median of the flat within the normalization windows. The correction of a 
+	sinogram is then performed with broadcasting, without replicating the rows.
+
+	Dead pixels of each flat row are corrected as for the inner rows of the replicated 
+	flat image of the previous versions (i.e. interpolating across the row boundaries 
+	with the same row). If a map of the defective pixels is specified (see 
+	stp_core.preprocess.defect_map), the flat and dark rows as well as each sinogram 
+	are corrected with it instead, and negative values are filtered only in their 
+	neighbourhood. Transient zeros and NaNs of the sinograms (i.e. not in the map) 
+	are then replaced by the median of their neighbourhood as well.
+
+	Parameters
+	----------
+	plan : structure
+		Structure created by the extract_flatdark function (see extract_flatdark.py).
+	flat_end, half_half, half_half_line, norm_sx, norm_dx : 
+		See flat_fielding.
+	rows : slice, optional
+		Rows of the detector (i.e. sinograms) to compile (default = all).
+	defects : DefectMap, optional
+		Map of the defective pixels of the detector as returned by find_defects.
+
+	Example (using h5py, tdf.py)
+	--------------------------
+	>>> plan = extract_flatdark(f_in, True, 'logfile.txt') 
+	>>> plan = FlatFieldPlan(plan, True, True, 900, 0, 0)
+	>>> im   = flat_fielding(tdf.read_sino(dset, 512), 512, plan, True, True, 900, 0, 0)
+
+	"""
+	def __init__(self, plan, flat_end, half_half, half_half_line, norm_sx, norm_dx, rows=None, defects=None):
+
+		# Extract plan values:
+		im_flat = plan['im_flat']
+		im_dark = plan['im_dark']
+		im_flat_after = plan['im_flat_after']	
+		im_dark_after = plan['im_dark_after']
+
+		self.skip_flat = plan['skip_flat']
+		self.defects = defects
+		self.skip_flat_after = plan['skip_flat_after']
+	
+		if not isinstance(im_dark, ndarray):
+			im_dark = im_dark_after	
+		if not isinstance(im_flat, ndarray):
+			im_flat = im_flat_after
+
+		# Half-and-half mode or the same flat for all the images:
+		self.half_half = flat_end and not self.skip_flat_after and half_half
+		self.half_half_line = half_half_line
+		if flat_end and not self.skip_flat_after and not self.half_half:
+			# Use the ones acquired after the projections:
+			im_flat = im_flat_after
+			im_dark = im_dark_after
+
+		refs = [im_flat, im_dark, im_flat_after, im_dark_after] if self.half_half else [im_flat, im_dark]
+		if not all(isinstance(ref, ndarray) for ref in refs):
+			self.skip_flat = True
+		if self.skip_flat:
+			return
+
+		# Rows of the detector to compile:
+		if rows is None:
+			rows = slice(0, im_flat.shape[0])
+		self.start = rows.start if (rows.start is not None) else 0
+
+		# Columns of the normalization windows:
+		cols = arange(im_flat.shape[1])
+		if ((norm_sx == 0) and (norm_dx == 0)):
+			self.air = None
+		elif (norm_dx == 0):
+			self.air = cols[0:norm_sx]
+		else:
+			self.air = concatenate((cols[0:norm_sx], cols[-norm_dx:]))
+
+		self.parts = [self._compile(im_flat[rows], im_dark[rows])]
+		if self.half_half:
+			self.parts.append(self._compile(im_flat_after[rows], im_dark_after[rows]))
+
+	def _compile(self, im_flat, im_dark):
+		"""Get the tuple (dark, denominator, flat median within the normalization windows) 
+		of the specified flat and dark rows.
+
+		"""
+		eps = finfo(float32).eps
+
+		flat_air = None
+		if self.air is not None:
+			flat_air = median(im_flat[:,self.air], axis=1) + eps
+
+		flat = asarray(im_flat, dtype=float32).copy()
+		dark = asarray(im_dark, dtype=float32)
+
+		if self.defects is not None:
+			# Defective pixels of the flat and dark rows:
+			rows = self.start + arange(flat.shape[0])
+			self.defects.correct(flat[:,newaxis,:], rows)
+			dark = self.defects.correct(dark.copy()[:,newaxis,:], rows)[:,0,:]
+		else:
+			# Dead pixel correction of the rows that need it:
+			for r in nonzero(((flat <= 0.0) | isnan(flat)).any(axis=1))[0]:
+				valid = (flat[r] > 0.0)
+				if valid.any():
+					flat[r] = _dead_correction(tile(flat[r], (3,1)))[1]
+
+		den = flat - dark
+		if self.air is None:
+			# Normalization coefficient equal to one:
+			den += eps
+
+		return (dark, den, flat_air)
+
+	def apply(self, im, i):
+		"""Flat field the specified sinogram.
+
+		Parameters
+		----------
+		im : array_like
+			Image data (sinogram) as numpy array.
+		i : int
+			Index of the sinogram with reference to the height of a projection.
+
+		"""
+		return self.apply_slab(asarray(im)[newaxis], [i])[0]
+
+	def apply_slab(self, block, rows):
+		"""Flat field a slab of sinograms in a single pass.
+
+		Parameters
+		----------
+		block : array_like
+			Sinograms stacked along the first axis, i.e. a numpy array with shape 
+			(nr_sinos, nr_projs, det_size) as returned by tdf.read_sinos.
+		rows : array_like
+			Index of each sinogram with reference to the height of a projection.
+
+		"""
+		block = asarray(block)
+		if self.skip_flat:
+			return block.astype(float32)
+
+		rows = asarray(rows, dtype=int) - self.start
+		eps = finfo(float32).eps
+
+		# Median within the normalization windows (before the dead pixel correction):
+		if self.air is not None:
+			im_air = median(block[:,:,self.air], axis=2)
+
+		# Dead pixel correction:
+		out = block.astype(float32)
+		if self.defects is not None:
+			self.defects.correct(out, rows + self.start)
+
+			# Transient zeros and NaNs are left to the local median filtering below:
+			bad = ~(out > 0.0)
+			failed = bad.all(axis=(1,2))
+			out[bad] = nan
+		else:
+			failed = _dead_correction_slab(out)
+			
+		# Rows of the sinograms flat fielded with each part of the plan:
+		if self.half_half:
+			line = min(max(self.half_half_line, 0), block.shape[1])
+			segments = [(0, line), (line, block.shape[1])]
+		else:
+			segments = [(0, block.shape[1])]
+
+		# Do actual flat fielding:
+		for (start, stop), (dark, den, flat_air) in zip(segments, self.parts):
+			seg = out[:,start:stop]
+			if self.air is not None:
+				# Set a norm coefficient for each row of each sinogram:
+				norm_coeff = im_air[:,start:stop] / flat_air[rows][:,newaxis]
+				den_curr = den[rows][:,newaxis,:] * norm_coeff[:,:,newaxis] + eps
+			else:
+				den_curr = den[rows][:,newaxis,:]
+			subtract(seg, dark[rows][:,newaxis,:], out=seg)
+			divide(seg, den_curr, out=seg)
+
+		# Correct for afteglow:
+		if self.defects is not None:
+			out = _afterglow_correction_local(out)
+		else:
+			out = _afterglow_correction_slab(out)
+
+		# Sinograms without valid pixels are left as they are:
+		for k in nonzero(failed)[0]:
+			out[k] = block[k]
+
+		return out
 
-	return im
 
 def flat_fielding (im, i, plan, flat_end, half_half, half_half_line, norm_sx, norm_dx):
 	"""Process a sinogram with conventional flat fielding plus reference normalization.
@@ -86,11 +399,13 @@ def flat_fielding (im, i, plan, flat_end, half_half, half_half_line, norm_sx, no
 		Image data as numpy array
 	i : int
 		Index of the sinogram with reference to the height of a projection
-	plan : structure
+	plan : structure or FlatFieldPlan
 		Structure created by the extract_flatdark function (see extract_flatdark.py). 
 		This structure contains the flat/dark images acquired before the acquisition of 
 		the projections and the flat/dark images acquired after the acquisition of the
-		projections as well as a few flags.
+		projections as well as a few flags. When several sinograms are processed, the 
+		FlatFieldPlan compiled once from such structure has to be used instead (the
+		following parameters are then the ones used to compile it).
 	flat_end : bool
 		True if the process considers the flat/dark images (if any) acquired after the 
 		acquisition of the projections.
@@ -122,140 +437,45 @@ def flat_fielding (im, i, plan, flat_end, half_half, half_half_line, norm_sx, no
 	
 	try:
 
-		# Extract plan values:
-		im_flat = plan['im_flat']
-		im_dark = plan['im_dark']
-		im_flat_after = plan['im_flat_after']	
-		im_dark_after = plan['im_dark_after']
+		# Compile the plan for the i-th row only (if required):
+		if not isinstance(plan, FlatFieldPlan):
+			plan = FlatFieldPlan(plan, flat_end, half_half, half_half_line, norm_sx, norm_dx, slice(i, i + 1))
 
-		skip_flat = plan['skip_flat']
-		skip_flat_after = plan['skip_flat_after']
-	
-		if not isinstance(im_dark, ndarray):
-			im_dark = im_dark_after
-	
-		if not isinstance(im_flat, ndarray):
-			im_flat = im_flat_after
-			
-		# Flat correct the image to process:
-		if not skip_flat:
-					
-			im_flat_curr = im_flat
-			im_dark_curr = im_dark
-			if flat_end and not skip_flat_after and half_half:
-				# Half-and-half mode
-				if ((norm_sx == 0) and (norm_dx == 0)):
-					norm_coeff = 1.0
-				else:
-					# Get the air image:
-					if (norm_dx == 0):
-						im_air = im[:,0:norm_sx]							
-					else:
-						im_sx = im[:,0:norm_sx]							
-						im_dx = im[:,-norm_dx:]					
-						im_air = concatenate((im_sx,im_dx), axis=1)	
-						
-					# Get only the i-th row from flat and dark:					
-					if (norm_dx == 0):
-						im_flat_air_before = im_flat[i,0:norm_sx]
-						im_flat_air_after = im_flat_after[i,0:norm_sx]						
-					else:	
-						im_flat_sx_before = im_flat[i,0:norm_sx]						
-						im_flat_dx_before = im_flat[i,-norm_dx:]					
-						im_flat_air_before = concatenate((im_flat_sx_before,im_flat_dx_before), axis=1)
-						im_flat_sx_after = im_flat_after[i,0:norm_sx]								
-						im_flat_dx_after = im_flat_after[i,-norm_dx:]					
-						im_flat_air_after = concatenate((im_flat_sx_after,im_flat_dx_after), axis=1)		
-						
-					im_flat_air_before = tile(im_flat_air_before, (half_half_line,1)) 
-					im_flat_air_after = tile(im_flat_air_after, (im.shape[0]-half_half_line,1)) 
-					im_flat_air = concatenate((im_flat_air_before,im_flat_air_after), axis=0)					
-					
-					if (norm_dx == 0):
-						im_dark_air_before = im_dark[i,0:norm_sx]
-						im_dark_air_after = im_dark_after[i,0:norm_sx]	
-					else:
-						im_dark_sx_before = im_dark[i,0:norm_sx]								
-						im_dark_dx_before = im_dark[i,-norm_dx:]
-						im_dark_air_before = concatenate((im_dark_sx_before,im_dark_dx_before), axis=1)
-						im_dark_sx_after = im_dark_after[i,0:norm_sx]								
-						im_dark_dx_after = im_dark_after[i,-norm_dx:]					
-						im_dark_air_after = concatenate((im_dark_sx_after,im_dark_dx_after), axis=1)					
-					
-					im_dark_air_before = tile(im_dark_air_before, (half_half_line,1)) 
-					im_dark_air_after = tile(im_dark_air_after, (im.shape[0]-half_half_line,1)) 
-					im_dark_air = concatenate((im_dark_air_before,im_dark_air_after), axis=0)		
-								
-					# Set a norm coefficient for avoiding for cycle:
-					norm_coeff = median(im_air, axis=1) / (median(im_flat_air, axis=1) + finfo(float32).eps)
-					norm_coeff = tile(norm_coeff, (im.shape[1],1)) 
-					norm_coeff = norm_coeff.T
-						
-				# Create flat and dark images replicating the i-th row the proper number of times:
-				tmp_flat_before = tile(im_flat[i,:], (half_half_line,1)) 
-				tmp_flat_after = tile(im_flat_after[i,:], (im.shape[0]-half_half_line,1)) 
-				tmp_flat = concatenate((tmp_flat_before,tmp_flat_after), axis=0)				
-				tmp_dark_before = tile(im_dark[i,:], (half_half_line,1)) 
-				tmp_dark_after = tile(im_dark_after[i,:], (im.shape[0]-half_half_line,1)) 
-				tmp_dark = concatenate((tmp_dark_before,tmp_dark_after), axis=0)
-			
-			else:
-				# The same flat for all the images:				
-				if flat_end and not skip_flat_after:
-					# Use the ones acquired after the projections:
-					im_flat = im_flat_after
-					im_dark = im_dark_after
-
-				if ((norm_sx == 0) and (norm_dx == 0)):
-					norm_coeff = 1.0								
-				else:					
-					# Get the air image:
-					if (norm_dx == 0):
-						im_air = im[:,0:norm_sx]							
-					else:
-						im_sx = im[:,0:norm_sx]							
-						im_dx = im[:,-norm_dx:]
-						im_air = concatenate((im_sx,im_dx), axis=1)		
-						
-					# Get only the i-th row from flat and dark:
-					if (norm_dx == 0):
-						im_flat_air = im_flat[i,0:norm_sx]	
-					else:
-						im_flat_sx = im_flat[i,0:norm_sx]								
-						im_flat_dx = im_flat[i,-norm_dx:]
-						im_flat_air = concatenate((im_flat_sx,im_flat_dx), axis=1)	
-						
-					im_flat_air = tile(im_flat_air, (im.shape[0],1)) 
-					
-					if (norm_dx == 0):
-						im_dark_air = im_dark[i,0:norm_sx]								
-					else:
-						im_dark_sx = im_dark[i,0:norm_sx]								
-						im_dark_dx = im_dark[i,-norm_dx:]
-						im_dark_air = concatenate((im_dark_sx,im_dark_dx), axis=1)						
-						
-					im_dark_air = tile(im_dark_air, (im.shape[0],1)) 	
-								
-					# Set a norm coefficient for avoiding for cycle:
-					norm_coeff = median(im_air, axis=1) / (median(im_flat_air, axis=1) + finfo(float32).eps)
-					norm_coeff = tile(norm_coeff, (im.shape[1],1)) 
-					norm_coeff = norm_coeff.T	
-
-				# Create flat and dark images replicating the i-th row the proper number of times:
-				tmp_flat = tile(im_flat[i,:], (im.shape[0],1)) 
-				tmp_dark = tile(im_dark[i,:], (im.shape[0],1)) 								
-
-			# Dead pixel correction:
-			im = _dead_correction(im.astype(float32))
-			tmp_flat = _dead_correction(tmp_flat.astype(float32))
-						
-			# Do actual flat fielding:
-			im = ((im - tmp_dark) / ((tmp_flat - tmp_dark) * norm_coeff + finfo(float32).eps)).astype(float32)	
-	
-			# Correct for afteglow:
-			im = _afterglow_correction(im.astype(float32))
+		im = plan.apply(im, i)
 
 	finally:
 
 		# Return pre-processed image:
-		return im.astype(float32)
\ No newline at end of file
+		return im.astype(float32)
+
+def flat_fielding_slab (block, rows, plan, flat_end, half_half, half_half_line, norm_sx, norm_dx):
+	"""Process a slab of sinograms with conventional flat fielding plus reference 
+	normalization in a single pass. The result is the same of flat_fielding called
+	for each sinogram.
+
+	Parameters
+	----------
+	block : array_like
+		Sinograms stacked along the first axis, i.e. a numpy array with shape 
+		(nr_sinos, nr_projs, det_size) as returned by tdf.read_sinos.
+	rows : array_like
+		Index of each sinogram with reference to the height of a projection.
+	plan : structure or FlatFieldPlan
+		See flat_fielding.
+	flat_end, half_half, half_half_line, norm_sx, norm_dx : 
+		See flat_fielding.
+	   
+	Example (using h5py, tdf.py)
+	--------------------------
+	>>> plan  = FlatFieldPlan(extract_flatdark(f_in, True, 'logfile.txt'), True, True, 900, 0, 0)
+	>>> block = tdf.read_sinos(dset, 512, 528)
+	>>> block = flat_fielding_slab(block, range(512, 528), plan, True, True, 900, 0, 0)  
+
+	"""    
+	# Compile the plan for the required rows only (if required):
+	if not isinstance(plan, FlatFieldPlan):
+		rows = asarray(rows, dtype=int)
+		plan = FlatFieldPlan(plan, flat_end, half_half, half_half_line, norm_sx, norm_dx, 
+			slice(int(rows.min()), int(rows.max()) + 1))
+
+	return plan.apply_slab(block, rows)
@@ -31,13 +31,29 @@ from os.path import exists, dirname, basename, splitext
 from numpy import array, finfo, copy, float32, reshape, fromfile, ndarray
 
 
-def cache2plan(infile, cachepath):
+def _get_key(infile, method):
+	"""Get the prefix of the cached files: plans whose flat/dark images are not reduced
+	with the mean are kept apart.
+
+	"""
+	key = splitext(basename(infile))[0]
+	if (method != 'mean'):
+		key += '@' + method
+
+	return key
+
+
+def cache2plan(infile, cachepath, method='mean'):
 	"""Read from cache the flat/dark images of the input TDF file.
 
     Parameters
     ----------    
     infile : string
 		Absolute path of the input TDF dataset.
+
+	method : string, optional
+		Reduction of the flat/dark images of the plan (default = 'mean', see 
+		extract_flatdark).
 					
 	Returns
 	-------
@@ -46,7 +62,7 @@ def cache2plan(infile, cachepath):
     """
 	#path   = dirname(infile)
 	path   = cachepath
-	infile = splitext(basename(infile))[0]
+	infile = _get_key(infile, method)
 
 	file_flat = [fn for fn in listdir(path) if fn.startswith(infile + '_imflat#')][0]
 	file_flat_after = [fn for fn in listdir(path) if fn.startswith(infile + '_impostflat#')][0]
@@ -82,7 +98,7 @@ def cache2plan(infile, cachepath):
 
 
 
-def plan2cache(corr_plan, infile, cachepath):
+def plan2cache(corr_plan, infile, cachepath, method='mean'):
 	"""Write to cache the flat/dark images of the input TDF file.
 
     Parameters
@@ -92,6 +108,10 @@ def plan2cache(corr_plan, infile, cachepath):
 
 	corr_plan : structure
 		The plan with flat/dark images and flags.
+
+	method : string, optional
+		Reduction of the flat/dark images of the plan (default = 'mean', see 
+		extract_flatdark).
 					
 	Returns
 	-------
@@ -100,7 +120,7 @@ def plan2cache(corr_plan, infile, cachepath):
     """
 	#path   = dirname(infile)
 	path   = cachepath
-	infile = splitext(basename(infile))[0]
+	infile = _get_key(infile, method)
 
 	if (isinstance(corr_plan['im_flat'], ndarray)):
 		im = corr_plan['im_flat'].astype(float32)